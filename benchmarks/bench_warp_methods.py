@@ -0,0 +1,35 @@
+### BENCHMARK: WARPING BACKENDS
+# Compares the runtime of unwarp() for the available warping backends
+# (see WARP_METHODS in _unwarp.py) for increasing numbers of grid points.
+#
+# Run with:
+# python benchmarks/bench_warp_methods.py
+#
+import time
+import numpy as np
+
+from napari_mini_unwarp._helpers import generate_perfect_grid, unwarp
+from napari_mini_unwarp._unwarp import WARP_METHODS
+
+
+def benchmark(image_size=512, grid_sizes=(9, 20, 40), repeats=3, seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.random((image_size, image_size))
+    print(f'Image: {image_size} x {image_size} px')
+    print(f'{"points":>8}' + ''.join(f'{method:>20}' for method in WARP_METHODS))
+    for grid_size in grid_sizes:
+        grid_dots = generate_perfect_grid(image, grid_size, grid_size, start_margin=.1)
+        usr_dots  = grid_dots + rng.normal(0, 2, grid_dots.shape)
+        timings = []
+        for method in WARP_METHODS:
+            runs = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                unwarp(usr_dots, grid_dots, image, method=method)
+                runs.append(time.perf_counter() - start)
+            timings.append(min(runs))
+        print(f'{len(grid_dots):>8}' + ''.join(f'{timing:>19.3f}s' for timing in timings))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,267 @@
+### DISTRIBUTED BATCH UNWARPING
+# Applying a calibration to a backlog of recordings (headless, without napari).
+#
+# - The inverse map of the calibration (2 x rows x cols, float32, see calibration_map()) is
+#   computed once and broadcast to all workers. Tasks only resample.
+# - One task per file x chunk of frames (chunk_frames). The frames of a chunk are sampled together:
+#   interpolation indices and weights are computed once per task and shared by all frames
+#   (see gather_channels() in _kernels.py, as for batched channels in warp_images()).
+# - Results are written straight into chunked (zarr) outputs, one per file. Chunks are aligned
+#   with the tasks, so no two tasks ever write to the same chunk.
+# - Runs as a dask task graph: on a distributed scheduler if one is configured (scheduler_address
+#   or the dask config 'scheduler-address'), on a LocalCluster otherwise - or on local threads
+#   if dask.distributed is not installed. With several nodes, inputs and outputs have to be on a
+#   shared file system.
+# - Every task reports its timings (read, warp, write) and the worker it ran on.
+# dask (with dask.distributed) and zarr are optional dependencies.
+#
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from scipy import ndimage
+from tifffile import TiffFile, imread
+
+from ._unwarp import _convert, _make_inverse_warp
+from ._kernels import gather_channels
+from ._chunked import ZARR_SUFFIXES, ZARR_AVAILABLE, open_ome_zarr, open_hdf5
+
+try:
+    import dask
+    DASK_AVAILABLE = True
+except ImportError:
+    DASK_AVAILABLE = False
+
+try:
+    from distributed import Client, LocalCluster, get_worker
+    DISTRIBUTED_AVAILABLE = True
+except ImportError:
+    DISTRIBUTED_AVAILABLE = False
+
+if ZARR_AVAILABLE:
+    import zarr
+
+CHUNK_FRAMES = 64 # Frames per task (and per chunk of the output)
+TIF_SUFFIXES = ('.tif', '.tiff')
+
+
+def calibration_map(calibration, plane_idx=0):
+    '''
+    Full resolution inverse map of a calibration (see _registry.py):
+    the stored one if there is one, evaluated otherwise
+
+    Parameters
+    ----------
+    calibration : Calibration
+    plane_idx : int : plane of the calibration to use (stacks)
+
+    Returns
+    -------
+    transform : np.array : 2 x rows x cols (float32) source coordinates of every output pixel
+    '''
+    if calibration.inverse_map is not None:
+        transform = calibration.inverse_map
+        transform = transform if transform.ndim == 3 else transform[plane_idx]
+        return np.asarray(transform, dtype=np.float32)
+    usr_dots, grid_dots = calibration.plane(plane_idx)
+    output_region = [0, 0, calibration.image_shape[0], calibration.image_shape[1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        transform = _make_inverse_warp(usr_dots, grid_dots, output_region, 1, calibration.method,
+                                       precision='float32')
+    return np.stack(transform)
+
+
+def _open_chunked(path):
+    path = Path(path)
+    array, axes, _, _ = open_ome_zarr(path) if path.suffix in ZARR_SUFFIXES else open_hdf5(path)
+    if ('t' not in axes) or not (set(axes) <= {'t', 'c', 'y', 'x'}):
+        raise NotImplementedError(f'Axes {axes} not supported - expected t, (c,) y, x')
+    return array, axes
+
+
+def recording_info(path):
+    '''
+    Number of frames, frame shape and dtype of a recording
+    (multi-page .tif, or OME-Zarr / HDF5 with a time axis - first channel only)
+    '''
+    path = Path(path)
+    if path.suffix in TIF_SUFFIXES:
+        with TiffFile(path) as tif:
+            first = tif.pages.first
+            return len(tif.pages), tuple(first.shape), first.dtype
+    array, axes = _open_chunked(path)
+    try:
+        frame_shape = (array.shape[axes.index('y')], array.shape[axes.index('x')])
+        return array.shape[axes.index('t')], frame_shape, array.dtype
+    finally:
+        if hasattr(array, 'file'):
+            # h5py
+            array.file.close()
+
+
+def read_frames(path, start, stop):
+    '''
+    Frames `start` to `stop` of a recording (see recording_info()) as frames x rows x cols
+    '''
+    path = Path(path)
+    if path.suffix in TIF_SUFFIXES:
+        frames = imread(path, key=range(start, stop))
+        return frames.reshape((stop - start,) + frames.shape[-2:])
+    array, axes = _open_chunked(path)
+    try:
+        index = [slice(None)] * len(axes)
+        index[axes.index('t')] = slice(start, stop)
+        if 'c' in axes:
+            index[axes.index('c')] = 0
+        frames = np.asarray(array[tuple(index)])
+    finally:
+        if hasattr(array, 'file'):
+            array.file.close()
+    remaining = [axis for axis in axes if axis != 'c']
+    return np.transpose(frames, [remaining.index(axis) for axis in ['t', 'y', 'x']])
+
+
+def _worker_name():
+    if DISTRIBUTED_AVAILABLE:
+        try:
+            return get_worker().address
+        except ValueError:
+            pass
+    return f'{socket.gethostname()}/{os.getpid()}/{threading.current_thread().name}'
+
+
+def unwarp_chunk(source, start, stop, transform, target, interpolation_order=1):
+    '''
+    One task: unwarp frames `start` to `stop` of `source` and write them to the zarr array `target`
+
+    Returns
+    -------
+    timing : dict : source, start, stop, worker and durations (s) of 'read', 'warp' and 'write'
+    '''
+    t_start = time.perf_counter()
+    frames = read_frames(source, start, stop)
+    t_read = time.perf_counter()
+
+    unwarped = np.empty((len(frames),) + transform.shape[1:], dtype=np.float32)
+    if interpolation_order <= 1:
+        # Indices and weights are shared by all frames of the chunk
+        labels = np.full(len(frames), interpolation_order == 0)
+        gather_channels(frames, transform, unwarped, labels=labels)
+    else:
+        for frame, out in zip(frames, unwarped):
+            ndimage.map_coordinates(frame, transform, order=interpolation_order, output=out)
+    if np.issubdtype(frames.dtype, np.integer):
+        converted = np.empty(unwarped.shape, dtype=frames.dtype)
+        _convert(unwarped, converted)
+        unwarped = converted
+    t_warp = time.perf_counter()
+
+    zarr.open(str(target), mode='r+')[start:stop] = unwarped.astype(frames.dtype, copy=False)
+    t_write = time.perf_counter()
+    return {'source': str(source), 'start': start, 'stop': stop, 'worker': _worker_name(),
+            'read': t_read - t_start, 'warp': t_warp - t_read, 'write': t_write - t_warp}
+
+
+def _get_client(client, scheduler_address, n_workers):
+    '''
+    Client to run on: the given one, one connected to the configured scheduler,
+    or one for a new LocalCluster. None if dask.distributed is not installed.
+
+    Returns
+    -------
+    client : distributed.Client or None
+    owned : bool : True if the client (and cluster) were started here and have to be closed
+    '''
+    if client is not None:
+        return client, False
+    address = scheduler_address or dask.config.get('scheduler-address', None)
+    if not DISTRIBUTED_AVAILABLE:
+        if address:
+            raise ImportError('Connecting to a scheduler requires dask.distributed (pip install distributed)')
+        print('dask.distributed is not installed - running on local threads')
+        return None, False
+    if address:
+        print(f'Connecting to scheduler {address}')
+        return Client(address), True
+    cluster = LocalCluster(n_workers=n_workers)
+    print(f'Started local cluster ({cluster.dashboard_link})')
+    return Client(cluster), True
+
+
+def batch_unwarp(paths,
+                 transform,
+                 output_dir,
+                 chunk_frames=CHUNK_FRAMES,
+                 interpolation_order=1,
+                 client=None,
+                 scheduler_address=None,
+                 n_workers=None,
+                 ):
+    '''
+    Unwarp all frames of a list of recordings with one precomputed transform
+    (see module header)
+
+    Parameters
+    ----------
+    paths : list : recordings (multi-page .tif, OME-Zarr or HDF5, see recording_info())
+    transform : np.array : 2 x rows x cols inverse map (see calibration_map()).
+                           Frames have to be of shape rows x cols
+    output_dir : str or Path : folder for the outputs (<file name>_unwarped.zarr)
+    chunk_frames : int : number of frames per task (and per output chunk)
+    interpolation_order : int : 0 (nearest neighbour), 1 (linear) or spline order
+    client : distributed.Client : run on this client. Default: see scheduler_address
+    scheduler_address : str : address of a running scheduler (e.g. 'tcp://10.0.0.1:8786').
+                              Default: dask config 'scheduler-address', or a new LocalCluster
+    n_workers : int : number of workers of the LocalCluster (default: dask's choice)
+
+    Returns
+    -------
+    outputs : dict : input path -> output (.zarr) path
+    timings : list : one dict per task (see unwarp_chunk())
+    '''
+    if not DASK_AVAILABLE:
+        raise ImportError('Batch unwarping requires dask (pip install "dask[distributed]")')
+    if not ZARR_AVAILABLE:
+        raise ImportError('Batch unwarping writes zarr arrays (pip install zarr)')
+    transform = np.asarray(transform, dtype=np.float32)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Outputs are created up front, with chunks aligned to the tasks
+    outputs, tasks = {}, []
+    for path in paths:
+        num_frames, frame_shape, dtype = recording_info(path)
+        if frame_shape != transform.shape[1:]:
+            raise ValueError(f'{path}: frame shape {frame_shape} does not match the transform {transform.shape[1:]}')
+        target = output_dir / f'{Path(path).stem}_unwarped.zarr'
+        zarr.open(str(target), mode='w', shape=(num_frames,) + frame_shape,
+                  chunks=(chunk_frames,) + frame_shape, dtype=dtype)
+        outputs[str(path)] = target
+        tasks += [(str(path), start, min(start + chunk_frames, num_frames), str(target))
+                  for start in range(0, num_frames, chunk_frames)]
+
+    client, owned = _get_client(client, scheduler_address, n_workers)
+    try:
+        # The transform is a single node of the graph (scattered to all workers once)
+        shared = client.scatter(transform, broadcast=True) if client is not None else dask.delayed(transform)
+        task = dask.delayed(unwarp_chunk, pure=False)
+        graph = [task(source, start, stop, shared, target, interpolation_order)
+                 for source, start, stop, target in tasks]
+        t_start = time.perf_counter()
+        timings = list(dask.compute(*graph, scheduler=client.get if client is not None else 'threads'))
+        wall_time = time.perf_counter() - t_start
+    finally:
+        if owned:
+            cluster = client.cluster
+            client.close()
+            if cluster is not None:
+                cluster.close()
+
+    num_frames = sum(timing['stop'] - timing['start'] for timing in timings)
+    totals = {stage: sum(timing[stage] for timing in timings) for stage in ['read', 'warp', 'write']}
+    print(f'Unwarped {num_frames} frames of {len(outputs)} file(s) in {len(timings)} tasks '
+          f'on {len(set(timing["worker"] for timing in timings))} worker(s) in {wall_time:.1f} s '
+          f'(task time: read {totals["read"]:.1f} s | warp {totals["warp"]:.1f} s | write {totals["write"]:.1f} s)')
+    return outputs, timings
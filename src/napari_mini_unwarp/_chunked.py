@@ -0,0 +1,196 @@
+### CHUNKED INPUT (OME-ZARR / HDF5)
+# Grid recordings that were already converted to chunked formats are opened lazily:
+# nothing is read until the projection over time is computed, and that is done
+# block by block (aligned to the chunks along the time axis) in parallel threads.
+# Only the partial sums (one frame / stack each) are kept in memory.
+#
+# - OME-Zarr: the highest resolution level of the first multiscale image is used.
+#   Axes, pixel sizes and units come from the OME-NGFF metadata.
+# - HDF5: a given dataset, or the first dataset with >= 2 dimensions. Axes are read from an
+#   'axes' attribute or the dimension labels; otherwise (t,) (z,) y, x is assumed.
+#   Pixel sizes from 'element_size_um' (or 'scale').
+# Both zarr and h5py are optional dependencies.
+#
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+try:
+    import zarr
+    ZARR_AVAILABLE = True
+except ImportError:
+    ZARR_AVAILABLE = False
+
+try:
+    import h5py
+    H5PY_AVAILABLE = True
+except ImportError:
+    H5PY_AVAILABLE = False
+
+ZARR_SUFFIXES = ('.zarr',)
+HDF5_SUFFIXES = ('.h5', '.hdf5')
+
+PROJECTION_WORKERS = 4           # Threads computing partial sums over time
+PROJECTION_BLOCK_BYTES = 2**26   # Target size of one block read (along time)
+
+_SPATIAL_AXES = ('z', 'y', 'x')
+
+
+def _default_axes(ndim):
+    return {2: ['y', 'x'], 3: ['t', 'y', 'x'], 4: ['t', 'z', 'y', 'x'], 5: ['t', 'c', 'z', 'y', 'x']}[ndim]
+
+
+def open_ome_zarr(path):
+    '''
+    Open the full resolution array of an OME-Zarr image (lazy)
+
+    Returns
+    -------
+    array : zarr.Array
+    axes : list : axis names (e.g. ['t', 'c', 'z', 'y', 'x'])
+    scale : list : pixel size per axis
+    metadata : dict : units, translation and attributes of the image group
+    '''
+    if not ZARR_AVAILABLE:
+        raise ImportError('Reading OME-Zarr requires zarr (pip install zarr)')
+    group = zarr.open(str(path), mode='r')
+    attrs = dict(group.attrs)
+    if 'ome' in attrs:
+        # OME-NGFF >= 0.5 nests the metadata
+        attrs = {**attrs, **attrs['ome']}
+    if 'multiscales' not in attrs:
+        if hasattr(group, 'shape'):
+            # Plain zarr array
+            return group, _default_axes(group.ndim), [1.] * group.ndim, {'attributes': attrs}
+        raise ValueError(f'{path} is not an OME-Zarr image (no multiscales metadata)')
+    multiscale = attrs['multiscales'][0]
+    dataset = multiscale['datasets'][0]
+    array = group[dataset['path']]
+    axes_meta = multiscale.get('axes', _default_axes(array.ndim))
+    axes = [axis['name'] if isinstance(axis, dict) else axis for axis in axes_meta]
+    units = {axis['name']: axis['unit'] for axis in axes_meta if isinstance(axis, dict) and 'unit' in axis}
+    scale, translation = [1.] * array.ndim, [0.] * array.ndim
+    for transform in dataset.get('coordinateTransformations', []):
+        if transform['type'] == 'scale':
+            scale = [float(s) for s in transform['scale']]
+        elif transform['type'] == 'translation':
+            translation = [float(t) for t in transform['translation']]
+    metadata = {'units': units, 'translation': dict(zip(axes, translation)),
+                'attributes': {k: v for k, v in attrs.items() if k not in ('multiscales', 'ome')}}
+    return array, axes, scale, metadata
+
+
+def open_hdf5(path, dataset=None):
+    '''
+    Open a dataset of an HDF5 file (lazy). The file stays open as long as the dataset is used.
+
+    Parameters
+    ----------
+    path : str or Path : HDF5 file
+    dataset : str : name of the dataset. Default: first dataset with >= 2 dimensions
+
+    Returns
+    -------
+    array : h5py.Dataset
+    axes : list : axis names
+    scale : list : pixel size per axis
+    metadata : dict : attributes of the dataset
+    '''
+    if not H5PY_AVAILABLE:
+        raise ImportError('Reading HDF5 requires h5py (pip install h5py)')
+    h5_file = h5py.File(str(path), 'r')
+    if dataset is None:
+        candidates = []
+        h5_file.visititems(lambda name, obj: candidates.append(name)
+                           if isinstance(obj, h5py.Dataset) and obj.ndim >= 2 else None)
+        if not candidates:
+            h5_file.close()
+            raise ValueError(f'No image dataset found in {path}')
+        dataset = candidates[0]
+    array = h5_file[dataset]
+    attrs = {k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in array.attrs.items()}
+
+    axes = attrs.get('axes')
+    if isinstance(axes, bytes):
+        axes = axes.decode()
+    if axes is None and all(dim.label for dim in array.dims):
+        axes = [dim.label for dim in array.dims]
+    axes = [a.lower() for a in axes] if axes is not None else _default_axes(array.ndim)
+    if len(axes) != array.ndim:
+        raise ValueError(f'Axes {axes} do not match the dataset shape {array.shape}')
+
+    scale = [1.] * array.ndim
+    spatial = [i for i, axis in enumerate(axes) if axis in _SPATIAL_AXES]
+    if 'scale' in attrs:
+        scale = [float(s) for s in np.atleast_1d(attrs['scale'])]
+    elif 'element_size_um' in attrs:
+        # Pixel size of the trailing spatial axes (Fiji / ilastik convention)
+        element_size = np.atleast_1d(attrs['element_size_um'])[-len(spatial):]
+        for i, size in zip(spatial[-len(element_size):], element_size):
+            scale[i] = float(size)
+    metadata = {'units': {axes[i]: 'micrometer' for i in spatial} if 'element_size_um' in attrs else {},
+                'translation': {}, 'attributes': attrs, 'dataset': dataset}
+    return array, axes, scale, metadata
+
+
+def _time_blocks(array, t_axis, block_bytes):
+    ''' (start, stop) ranges along time, aligned to the chunks of `array` '''
+    num_t = array.shape[t_axis]
+    frame_bytes = array.dtype.itemsize * int(np.prod(array.shape)) // max(num_t, 1)
+    chunks = getattr(array, 'chunks', None)
+    chunk_t = chunks[t_axis] if chunks else 1
+    step = chunk_t * max(1, block_bytes // max(frame_bytes * chunk_t, 1))
+    return [(t0, min(t0 + step, num_t)) for t0 in range(0, num_t, step)]
+
+
+def _accumulate(total, futures):
+    for future in futures:
+        partial = future.result()
+        total = partial if total is None else np.add(total, partial, out=total)
+    return total
+
+
+def project_time(array, axes, channel=0, workers=PROJECTION_WORKERS, block_bytes=PROJECTION_BLOCK_BYTES):
+    '''
+    Average projection over the time axis ('t'), computed block by block in parallel.
+    Only one channel ('c') is used.
+
+    Parameters
+    ----------
+    array : array like : lazy array (zarr, h5py, ...)
+    axes : list : axis names
+    channel : int : channel to project (if there is a 'c' axis)
+    workers : int : number of threads
+    block_bytes : int : target size of one block read
+
+    Returns
+    -------
+    projection : np.array : float projection
+    axes : list : axis names of `projection`
+    '''
+    axes = list(axes)
+    index = [slice(None)] * len(axes)
+    if 'c' in axes:
+        index[axes.index('c')] = channel
+    out_axes = [axis for axis in axes if axis != 'c']
+    if 't' not in axes:
+        return np.asarray(array[tuple(index)], dtype=float), out_axes
+
+    t_axis, t_out = axes.index('t'), out_axes.index('t')
+
+    def block_sum(t_range):
+        block_index = list(index)
+        block_index[t_axis] = slice(*t_range)
+        return np.asarray(array[tuple(block_index)], dtype=float).sum(axis=t_out)
+
+    # At most 2 blocks per worker are in flight, so memory does not grow with the recording length
+    workers = max(1, workers)
+    total, pending = None, set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for t_range in _time_blocks(array, t_axis, block_bytes):
+            pending.add(executor.submit(block_sum, t_range))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                total = _accumulate(total, done)
+        total = _accumulate(total, pending)
+    out_axes.remove('t')
+    return total / array.shape[t_axis], out_axes
@@ -1,11 +1,12 @@
 ### HELPER FUNCTIONS
-from collections import OrderedDict
 import numpy as np
+from scipy import ndimage
 from pointpats import PointPattern
-from skimage.registration import phase_cross_correlation
-from napari.utils import progress
 
 from ._unwarp import * 
+from ._unwarp import _U, _L_inverse, _convert, _make_inverse_warp
+from ._tracking import PointPropagator, MAX_ERROR, MAX_DEVIATION
+from ._transform import ThinPlateSpline
 
 def generate_perfect_grid(data, 
                           rows,
@@ -63,7 +64,12 @@ def propagate_cross_corr(grid_image,
                          grid_points_current, 
                          plane_idx_current, 
                          b_box_halfwidth,
-                         upsample_factor = 250
+                         upsample_factor = 250,
+                         pyramid_levels = 2,
+                         prediction = 'linear',
+                         reference = 'anchor',
+                         max_error = MAX_ERROR,
+                         max_deviation = MAX_DEVIATION,
                          ):
 
     '''
@@ -71,7 +77,10 @@ def propagate_cross_corr(grid_image,
     throughout a stack (all grid pictures across all planes). 
     This is achieved by calculating a local cross correlation of 
     size (b_box_halfwidth * 2)**2) around each user chosen point across 
-    adjacent planes, and collecting the extracted offset
+    adjacent planes, and collecting the extracted offset.
+    Every point is tracked coarse-to-fine (see _tracking.py): 
+    integer correlation on a downsampled image pyramid first, then at full resolution,
+    and lastly subpixel refinement with an adaptive upsampling factor.
 
     
     Parameters
@@ -81,115 +90,83 @@ def propagate_cross_corr(grid_image,
     plane_idx_current : int : current plane index that 
                               `grid_points_current` was collected from
     b_box_halfwidth : float : bounding box half width in pixels    
-    upsample_factor : int : Upsampling factor. 
+    upsample_factor : int : Maximum upsampling factor. 
                             Bounding box images will be registered to within 
                             1 / upsample_factor of a pixel 
                             see: skimage.registration.phase_cross_correlation
-                            Value 250 works well without slowing it all down too much
+                            Refinement stops earlier for points whose estimate has converged
+    pyramid_levels : int : Number of downsampled (2x) pyramid levels for the coarse search. 
+                           Drift of up to b_box_halfwidth * 2**pyramid_levels pixels can be caught.
+                           0 disables the coarse search
+    prediction : str : Motion prediction across z used to place the search boxes 
+                       ('none', 'linear' or 'smooth'), see PointPropagator
+    reference : str : 'anchor' (correlate against the user defined plane, default) or 
+                      'previous' (chain plane-to-plane), see PointPropagator
+    max_error : float : Points with a higher correlation error (0: perfect match, 1: no correlation) ...
+    max_deviation : float : ... or a displacement deviating by more than this (pixels) from 
+                            their neighbours' are re-tracked with a larger box (see _tracking.py)
 
     Returns
     -------
     sorted_point_dict : dict : dictionary of 2D points across planes (keys are plane indices)
     '''
 
-    # Initialize dictionary of points
-    dict_points = {}
-    dict_points[plane_idx_current] = grid_points_current
-
-    # There are two arrays of indices, one going towards zero, the other going to grid_image.shape[0]
-    # i.e. going outwards from the user selected plane towards the edges of the stack (plane 0 to plane end)
-    to_end  = np.arange(plane_idx_current, grid_image.shape[0])[1:]
-    to_zero = np.arange(plane_idx_current, -1, -1)[1:]
-
-    # Go to adjacent plane - upwards
-    # ... initialize
-    last_idx    = plane_idx_current
-    last_points = grid_points_current
-
-    if len(to_end): 
-        for idx in progress(to_end): 
-            current_plane = grid_image[last_idx, :, :]  
-            next_plane    = grid_image[idx, :, :]
-            
-            corr_points = []
-            for point in last_points:
-                point_int = np.round(point).astype(int)
-                bound_b_img = current_plane[point_int[0]-b_box_halfwidth:point_int[0]+b_box_halfwidth,
-                                            point_int[1]-b_box_halfwidth:point_int[1]+b_box_halfwidth]
-            
-                bound_b_img_next = next_plane[point_int[0]-b_box_halfwidth:point_int[0]+b_box_halfwidth,
-                                            point_int[1]-b_box_halfwidth:point_int[1]+b_box_halfwidth]
-
-                # get phase corr offset
-                image = bound_b_img
-                offset_image = bound_b_img_next           
-                shift, _, _  = phase_cross_correlation(image, 
-                                                    offset_image,
-                                                    upsample_factor=upsample_factor,
-                                                    normalization=None,
-                                                    )
-                shift_x, shift_y = shift
-                corr_points.append([point_int[0]-shift_x, point_int[1]-shift_y])
-            
-            last_idx = idx
-            corr_points = np.stack(corr_points)
-            dict_points[idx] = corr_points
-            last_points = corr_points
-
-            
-
-    # Go to adjacent plane - to zero
-    # ... initialize
-    last_idx    = plane_idx_current
-    last_points = grid_points_current
-
-    if len(to_zero): 
-        for idx in progress(to_zero): 
-            current_plane = grid_image[last_idx, :, :]
-            next_plane    = grid_image[idx, :, :]
-            
-            corr_points = []
-            for point in last_points:
-                point_int = np.round(point).astype(int)
-                bound_b_img = current_plane[point_int[0]-b_box_halfwidth:point_int[0]+b_box_halfwidth,
-                                            point_int[1]-b_box_halfwidth:point_int[1]+b_box_halfwidth]
-            
-                bound_b_img_next = next_plane[point_int[0]-b_box_halfwidth:point_int[0]+b_box_halfwidth,
-                                            point_int[1]-b_box_halfwidth:point_int[1]+b_box_halfwidth]
-
-                # get phase corr offset
-                image = bound_b_img
-                offset_image = bound_b_img_next
-                shift, _, _  = phase_cross_correlation(image, 
-                                                    offset_image,
-                                                    upsample_factor=upsample_factor,
-                                                    normalization=None,
-                                                    )
-                shift_x, shift_y = shift
-                corr_points.append([point_int[0]-shift_x, point_int[1]-shift_y])
-            
-            last_idx = idx
-            corr_points = np.stack(corr_points)
-            dict_points[idx] = corr_points
-            last_points = corr_points
-    
-    # Sort dictionary by plane index
-    sorted_point_dict = OrderedDict(sorted(dict_points.items()))
+    propagator = PointPropagator(grid_image, 
+                                 b_box_halfwidth,
+                                 upsample_factor=upsample_factor,
+                                 pyramid_levels=pyramid_levels,
+                                 prediction=prediction,
+                                 reference=reference,
+                                 max_error=max_error,
+                                 max_deviation=max_deviation,
+                                 )
+    propagator.propagate(plane_idx_current, grid_points_current)
+    sorted_point_dict = propagator.as_dict()
     return sorted_point_dict
 
 
 def unwarp(usr_dots, 
            grid_dots, 
-           grid_image_original
+           grid_image_original,
+           method = 'tps',
+           tile_size = None,
+           output_dtype = None,
+           out = None,
+           precision = 'float64',
            ):
+    '''
+    Unwarp `grid_image_original` so that `usr_dots` end up on `grid_dots`
+
+    Parameters
+    ----------
+    usr_dots : np.array : user defined grid points (points x 2)
+    grid_dots : np.array : standard grid points (points x 2)
+    grid_image_original : np.array : 2D grid image
+    method : str : warping backend, one of WARP_METHODS (see warp_images())
+    tile_size : int : if given, unwarp in tiles of this size to bound memory usage (see warp_images())
+    output_dtype : dtype : dtype of the unwarped image. Default: same as `grid_image_original`.
+                           Integer outputs are rounded and clipped
+    out : np.array : optional preallocated output (same shape as `grid_image_original`), 
+                     for example one plane of a preallocated stack
+    precision : str : 'float64' or 'float32' compute mode (see warp_images())
 
+    Returns
+    -------
+    unwarped : np.array : unwarped image
+    status : bool : True if none of the image borders is touched by the unwarped image
+    '''
     unwarped = warp_images(
                 from_points   = usr_dots,
                 to_points     = grid_dots,
                 images        = [grid_image_original],
-                output_region = [0, 0, grid_image_original.shape[1], grid_image_original.shape[0]],
+                output_region = [0, 0, grid_image_original.shape[0], grid_image_original.shape[1]],
                 interpolation_order = 1,
                 approximate_grid = 1,
+                method = method,
+                tile_size = tile_size,
+                out = None if out is None else [out],
+                output_dtype = output_dtype,
+                precision = precision,
                 )[0]
     # Check whether margins are free
     col1 = (unwarped[0,:] == 0).all()
@@ -202,12 +179,137 @@ def unwarp(usr_dots,
     return unwarped, status
 
 
+def preview_unwarp(usr_dots, 
+                   grid_dots, 
+                   grid_image_original,
+                   downsample = 4,
+                   approximate_grid = 4,
+                   method = 'tps',
+                   precision = 'float32',
+                   ):
+    '''
+    Fast, low resolution version of unwarp() for interactive previews.
+    The image (and both point sets) are downsampled by block averaging, 
+    and the transform is only evaluated on a coarse grid (see warp_images()). 
+    As long as the standard grid (`grid_dots`) stays the same, 
+    the TPS factorization is cached (see _make_warp()), so only the 
+    right hand side has to be solved for new user points.
+
+    Parameters
+    ----------
+    usr_dots : np.array : user defined grid points (points x 2)
+    grid_dots : np.array : standard grid points (points x 2)
+    grid_image_original : np.array : 2D grid image
+    downsample : int : downsampling factor of the image 
+    approximate_grid : int : see warp_images()
+    method : str : warping backend, one of WARP_METHODS (see warp_images())
+    precision : str : compute mode (see warp_images()). Single precision by default - 
+                      its deviations are far below the resolution of the preview
+
+    Returns
+    -------
+    unwarped : np.array : unwarped, downsampled image.
+                          Show it with scale = (downsample, downsample) 
+                          to overlay it on the original image
+    '''
+    image = _block_average(grid_image_original, downsample)
+    unwarped = warp_images(
+                from_points   = np.asarray(usr_dots) / downsample,
+                to_points     = np.asarray(grid_dots) / downsample,
+                images        = [image],
+                output_region = [0, 0, image.shape[0], image.shape[1]],
+                interpolation_order = 1,
+                approximate_grid = approximate_grid,
+                method = method,
+                precision = precision,
+                )[0]
+    return unwarped
+
+
+def _block_average(image, downsample):
+    image = np.asarray(image, dtype=float)
+    height, width = (image.shape[0] // downsample) * downsample, (image.shape[1] // downsample) * downsample
+    return image[:height, :width].reshape(height//downsample, downsample, 
+                                          width//downsample,  downsample).mean(axis=(1, 3))
+
+
+class IncrementalPreview:
+    '''
+    TPS version of preview_unwarp() for a series of edits of the user points. 
+    The transform (ThinPlateSpline, fitted in reverse from the standard to the user grid, 
+    see _make_inverse_warp()) and its coordinate map on the downsampled image persist between calls:
+    moved user points only change the right-hand side of the fit (ThinPlateSpline.update()),
+    and only the blocks of the map that change noticeably are re-evaluated (update_map()).
+    Every `refresh` incremental updates, the map is evaluated from scratch, so that changes 
+    below the tolerance of update_map() cannot add up.
+
+    Parameters
+    ----------
+    grid_dots : np.array : standard grid points (points x 2)
+    image_shape : tuple : shape of the (2D) grid image
+    downsample : int : downsampling factor of the image 
+    refresh : int : number of incremental updates after which the map is evaluated from scratch
+    block, tolerance : see ThinPlateSpline.update_map() (in pixels of the downsampled image)
+    '''
+
+    def __init__(self, grid_dots, image_shape, downsample=4, refresh=20, block=8, tolerance=.01):
+        self.grid_dots = np.array(grid_dots, dtype=float)
+        self.image_shape = tuple(image_shape)
+        self.downsample = downsample
+        self.refresh = refresh
+        self.block, self.tolerance = block, tolerance
+        height, width = image_shape[0] // downsample, image_shape[1] // downsample
+        # Same output grid as preview_unwarp() (warp_images() with approximate_grid > 1, see output_shape()),
+        # but the map is evaluated at every pixel instead of being interpolated
+        self.x, self.y = np.meshgrid(np.arange(height + 1, dtype=float), np.arange(width + 1, dtype=float), 
+                                     indexing='ij')
+        self.tps = None
+        self.transform = None
+        self._num_updates = 0
+
+    def matches(self, grid_dots, image_shape):
+        ''' True if this preview can be reused for `grid_dots` and images of shape `image_shape` '''
+        return (tuple(image_shape) == self.image_shape) and (np.shape(grid_dots) == self.grid_dots.shape) \
+               and np.array_equal(grid_dots, self.grid_dots)
+
+    def update(self, usr_dots):
+        '''
+        Refit to new user points (incrementally if only some of them moved) and update the map
+
+        Returns
+        -------
+        fraction : float : fraction of the map that was re-evaluated
+        '''
+        usr_dots = np.asarray(usr_dots, dtype=float) / self.downsample
+        if self.tps is not None:
+            moved = np.flatnonzero((usr_dots != self.tps.to_points).any(axis=1))
+            if len(moved) == 0:
+                return 0.
+            if (len(moved) <= len(usr_dots) // 2) and (self._num_updates < self.refresh):
+                self.tps.update(moved, to_points=usr_dots[moved])
+                self._num_updates += 1
+                return self.tps.update_map(self.transform, self.x, self.y, 
+                                           tolerance=self.tolerance, block=self.block)
+        self.tps = ThinPlateSpline(self.grid_dots / self.downsample, usr_dots)
+        self.transform = self.tps.evaluate(self.x, self.y)
+        self._num_updates = 0
+        return 1.
+
+    def __call__(self, usr_dots, grid_image_original):
+        '''
+        Unwarped, downsampled image (see preview_unwarp())
+        '''
+        self.update(usr_dots)
+        return apply_transform(_block_average(grid_image_original, self.downsample), self.transform)
+
+
 def get_optimal_unwarp(status,
                        margin,
                        usr_dots,
                        grid_image_original,
                        no_rows,
                        no_cols,
+                       method = 'tps',
                        ):
 
     '''
@@ -225,6 +327,8 @@ def get_optimal_unwarp(status,
     "status" is output of unwarp() above and determines the initial condition:
     status == False: touching
     status == True:  not touching
+
+    "method" is the warping backend passed on to unwarp() (one of WARP_METHODS, see warp_images())
     
     '''
     if status == True:
@@ -236,7 +340,7 @@ def get_optimal_unwarp(status,
                                                cols = no_cols,
                                                start_margin = margin,
                                               )
-            unwarped, status = unwarp(usr_dots, grid_dots_, grid_image_original)
+            unwarped, status = unwarp(usr_dots, grid_dots_, grid_image_original, method=method)
     else:
         while not status: 
             print(f'Margin now at {margin:.4f}')
@@ -246,6 +350,114 @@ def get_optimal_unwarp(status,
                                                cols = no_cols,
                                                start_margin = margin,
                                                )
-            unwarped, status = unwarp(usr_dots, grid_dots_, grid_image_original)
+            unwarped, status = unwarp(usr_dots, grid_dots_, grid_image_original, method=method)
+
+    return unwarped, margin
 
-    return unwarped, margin
\ No newline at end of file
+def border_status(usr_dots, 
+                  grid_dots, 
+                  grid_images,
+                  method = 'tps',
+                  ):
+    '''
+    Border check of unwarp() for a whole stack at once, without unwarping the full images: 
+    only the border pixels of the unwarped planes are computed.
+    For the thin plate spline, all planes share the standard grid (`grid_dots`), so the 
+    factorization (see _L_inverse()) and the kernel matrix of the border pixels are computed once
+    and the border coordinates of all planes follow from a single matrix product. 
+    Other backends (see WARP_METHODS) evaluate their transform along the four borders plane by plane.
+
+    Parameters
+    ----------
+    usr_dots : np.array : user defined grid points (planes x points x 2)
+    grid_dots : np.array : standard grid points (points x 2)
+    grid_images : np.array : planes x rows x cols grid images
+    method : str : warping backend, one of WARP_METHODS (see warp_images())
+
+    Returns
+    -------
+    status : np.array : boolean per plane, True if none of the image borders 
+                        is touched by the unwarped image (see unwarp())
+    '''
+    usr_dots  = np.asarray(usr_dots, dtype=float)
+    grid_dots = np.asarray(grid_dots, dtype=float)
+    num_planes, height, width = grid_images.shape
+    output_region = [0, 0, height, width]
+
+    # Output pixel indices along the borders: first / last row, then first / last column
+    rows = np.concatenate([np.zeros(width, int), np.full(width, height-1), np.arange(height), np.arange(height)])
+    cols = np.concatenate([np.arange(width), np.arange(width), np.zeros(height, int), np.full(height, width-1)])
+    if method == 'tps':
+        # Same output grid as warp_images() with approximate_grid = 1
+        x = np.linspace(0, height, height)[rows]
+        y = np.linspace(0, width, width)[cols]
+        err = np.seterr(divide='ignore', invalid='ignore')
+        kernel = _U(np.sqrt((x[:, np.newaxis] - grid_dots[:, 0])**2 + (y[:, np.newaxis] - grid_dots[:, 1])**2))
+        np.seterr(**err)
+        kernel = np.concatenate([kernel, np.ones((len(x), 1)), x[:, np.newaxis], y[:, np.newaxis]], axis=1)
+        # reverse transform (standard grid -> user points) for all planes, see _make_coeffs()
+        V = np.zeros((num_planes, len(grid_dots)+3, 2))
+        V[:, :-3] = usr_dots
+        coeffs = np.einsum('ij,pjd->pid', _L_inverse(grid_dots), V)
+        coords = np.einsum('bi,pid->pdb', kernel, coeffs)
+    else:
+        strips = [((0, 1), (0, width)), ((height-1, height), (0, width)), 
+                  ((0, height), (0, 1)), ((0, height), (width-1, width))]
+        coords = np.empty((num_planes, 2, len(rows)))
+        for plane in range(num_planes):
+            transform = [_make_inverse_warp(usr_dots[plane], grid_dots, output_region, 1, method, 
+                                            rows=strip_rows, cols=strip_cols)
+                         for strip_rows, strip_cols in strips]
+            for dim in range(2):
+                coords[plane, dim] = np.concatenate([t[dim].ravel() for t in transform])
+
+    status = np.empty(num_planes, dtype=bool)
+    for plane in range(num_planes):
+        values = ndimage.map_coordinates(grid_images[plane], coords[plane], order=1, output=float)
+        if np.issubdtype(grid_images.dtype, np.integer):
+            # unwarp() rounds and clips integer output 
+            converted = np.empty(values.shape, dtype=grid_images.dtype)
+            _convert(values, converted)
+            values = converted
+        # unwarp(): untouched if every border is zero
+        status[plane] = (values == 0).all()
+    return status
+
+
+def get_optimal_stack_margin(margin,
+                             usr_dots,
+                             grid_images,
+                             no_rows,
+                             no_cols,
+                             method = 'tps',
+                             ):
+    '''
+    Stack-wide counterpart of get_optimal_unwarp(): a single search for the smallest margin 
+    (in steps of 0.005 from `margin` upwards) at which none of the unwarped planes touches 
+    the image border. Every step only computes the borders of all planes (see border_status()).
+    As for per plane optimization of stacks, the margin is never decreased below `margin`. 
+
+    Parameters
+    ----------
+    margin : float : start margin (see generate_perfect_grid())
+    usr_dots : np.array : user defined grid points (planes x points x 2)
+    grid_images : np.array : planes x rows x cols grid images
+    no_rows : int : number of rows of the grid
+    no_cols : int : number of columns of the grid
+    method : str : warping backend, one of WARP_METHODS (see warp_images())
+
+    Returns
+    -------
+    margin : float : optimal margin
+    '''
+    while True:
+        grid_dots_ = generate_perfect_grid(data = grid_images,
+                                           rows = no_rows,
+                                           cols = no_cols,
+                                           start_margin = margin,
+                                          )
+        status = border_status(usr_dots, grid_dots_, grid_images, method=method)
+        if status.all():
+            return margin
+        print(f'Margin now at {margin:.4f} ({(~status).sum()} planes touching the border)')
+        margin += 0.005
@@ -0,0 +1,272 @@
+### FUSED WARP KERNELS
+# warp_images() in _unwarp.py first evaluates the full inverse transform
+# (two float64 coordinate maps, plus the numpy.mgrid grids they are evaluated on),
+# and only then samples the image with ndimage.map_coordinates().
+# At 2048 x 2048 that is > 100 MB of temporary arrays per warp.
+#
+# The kernels here evaluate the thin plate spline and sample the source image bilinearly
+# in one pass, writing straight into a preallocated output, so the coordinate map is never held in memory.
+# - If numba is installed, a JIT compiled kernel is used that runs in parallel across rows (prange).
+# - Otherwise a pure NumPy fallback processes a few rows at a time (`block_rows`),
+#   which keeps temporaries at the size of those rows.
+# Both reproduce ndimage.map_coordinates(..., order=1, mode='constant'): samples outside
+# of the image are set to `cval`, and results are rounded (half away from zero) for integer images.
+#
+# tps_points() evaluates the TPS (and its Jacobian) at arbitrary coordinates, in parallel with numba
+# or in chunks with NumPy (see UnwarpTransform in _transform.py).
+#
+# gather_channels() samples a whole (C x H x W) stack with the same coordinates:
+# interpolation indices and weights are computed once and shared by all channels,
+# with nearest neighbour sampling for label / mask channels.
+#
+import math
+import numpy as np
+from scipy import ndimage
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def tps_warp(image, coeffs, points, x_axis, y_axis, out=None, cval=0., use_numba=None, block_rows=8):
+    '''
+    Evaluate a thin plate spline on the grid spanned by `x_axis` and `y_axis`
+    and sample `image` bilinearly at the resulting coordinates
+
+    Parameters
+    ----------
+    image : np.array : 2D source image
+    coeffs : np.array : (N+3) x 2 TPS coefficients (see _make_warp() in _unwarp.py)
+    points : np.array : N x 2 TPS centers
+    x_axis : np.array : output row coordinates
+    y_axis : np.array : output column coordinates
+    out : np.array : optional preallocated len(x_axis) x len(y_axis) output
+    cval : float : value for samples outside of `image`
+    use_numba : bool : use the JIT compiled kernel. If None, use it if numba is available
+    block_rows : int : number of rows processed at once by the NumPy fallback
+
+    Returns
+    -------
+    out : np.array : warped image (same dtype as `image` if `out` is not given)
+    '''
+    image = np.asarray(image)
+    coeffs = np.ascontiguousarray(coeffs, dtype=float)
+    points = np.ascontiguousarray(points, dtype=float)
+    x_axis = np.ascontiguousarray(x_axis, dtype=float)
+    y_axis = np.ascontiguousarray(y_axis, dtype=float)
+    if out is None:
+        out = np.empty((len(x_axis), len(y_axis)), dtype=image.dtype)
+    elif out.shape != (len(x_axis), len(y_axis)):
+        raise ValueError(f'Output shape {out.shape} does not match {(len(x_axis), len(y_axis))}')
+    if use_numba is None:
+        use_numba = NUMBA_AVAILABLE
+    if use_numba and not NUMBA_AVAILABLE:
+        raise ImportError('numba is not installed')
+
+    if use_numba:
+        _tps_warp_numba(image, coeffs, points, x_axis, y_axis, float(cval),
+                        np.issubdtype(out.dtype, np.integer), out)
+    else:
+        _tps_warp_numpy(image, coeffs, points, x_axis, y_axis, cval, out, block_rows)
+    return out
+
+
+def _tps_warp_numpy(image, coeffs, points, x_axis, y_axis, cval, out, block_rows):
+    '''
+    NumPy fallback of tps_warp(): `block_rows` rows at a time
+    '''
+    w = coeffs[:-3]
+    for start in range(0, len(x_axis), block_rows):
+        x = x_axis[start:start+block_rows, np.newaxis]
+        y = y_axis[np.newaxis, :]
+        transform = [coeffs[-3, dim] + coeffs[-2, dim] * x + coeffs[-1, dim] * y
+                     for dim in range(2)]
+        transform = [np.broadcast_to(t, (len(x), len(y_axis))).copy() for t in transform]
+        for wi, Pi in zip(w, points):
+            r_sq = (x - Pi[0])**2 + (y - Pi[1])**2
+            # r**2 log(r) = r**2 log(r**2) / 2
+            kernel = .5 * r_sq * np.log(np.where(r_sq > 0, r_sq, 1))
+            transform[0] += wi[0] * kernel
+            transform[1] += wi[1] * kernel
+        ndimage.map_coordinates(image, transform, order=1, cval=cval, output=out[start:start+block_rows])
+
+
+def tps_points(coeffs, centers, points, jacobian=False, use_numba=None, chunk_size=2**14):
+    '''
+    Evaluate a thin plate spline (and optionally its Jacobian) at arbitrary points
+
+    Parameters
+    ----------
+    coeffs : np.array : (N+3) x 2 TPS coefficients (see _make_warp() in _unwarp.py)
+    centers : np.array : N x 2 TPS centers
+    points : np.array : M x 2 coordinates
+    jacobian : bool : also return the Jacobian at every point
+    use_numba : bool : use the JIT compiled kernel. If None, use it if numba is available
+    chunk_size : int : number of points evaluated at once by the NumPy fallback
+
+    Returns
+    -------
+    values : np.array : M x 2 transformed points
+    jac : np.array : M x 2 x 2 Jacobian, jac[m, i, j] = d values[m, i] / d points[m, j]
+                     (only if `jacobian`)
+    '''
+    coeffs = np.ascontiguousarray(coeffs, dtype=float)
+    centers = np.ascontiguousarray(centers, dtype=float)
+    points = np.ascontiguousarray(points, dtype=float).reshape(-1, 2)
+    values = np.empty((len(points), 2))
+    jac = np.empty((len(points), 2, 2))
+    if use_numba is None:
+        use_numba = NUMBA_AVAILABLE
+    if use_numba and not NUMBA_AVAILABLE:
+        raise ImportError('numba is not installed')
+
+    if use_numba:
+        _tps_points_numba(coeffs, centers, points, jacobian, values, jac)
+    else:
+        w, affine = coeffs[:-3], coeffs[-3:]
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start+chunk_size]
+            dx = chunk[:, 0, np.newaxis] - centers[np.newaxis, :, 0]
+            dy = chunk[:, 1, np.newaxis] - centers[np.newaxis, :, 1]
+            r_sq = dx**2 + dy**2
+            log_r_sq = np.log(np.where(r_sq > 0, r_sq, 1))
+            values[start:start+chunk_size] = (.5 * r_sq * log_r_sq) @ w + affine[0] + chunk @ affine[1:]
+            if jacobian:
+                # dU/dx = (x - x_i) * (2 log(r) + 1)
+                factor = log_r_sq + 1
+                jac[start:start+chunk_size, :, 0] = (dx * factor) @ w + affine[1]
+                jac[start:start+chunk_size, :, 1] = (dy * factor) @ w + affine[2]
+    if jacobian:
+        return values, jac
+    return values
+
+
+def gather_channels(stack, transform, out, labels=None, cval=0.):
+    '''
+    Sample all channels of `stack` at the coordinates `transform` in one go.
+    Interpolation indices and weights are computed once and shared by all channels.
+    Same result as ndimage.map_coordinates(channel, transform, order=1 (or 0 for labels), mode='constant')
+    for every channel.
+
+    Parameters
+    ----------
+    stack : np.array : C x H x W source channels
+    transform : list : [x, y] coordinate arrays
+    out : np.array : C x (shape of the coordinate arrays) output
+    labels : np.array : optional boolean mask (length C) of label / mask channels,
+                        which are sampled with nearest neighbour interpolation
+    cval : float : value for samples outside of `stack`
+
+    Returns
+    -------
+    out : np.array
+    '''
+    x, y = transform
+    n_rows, n_cols = stack.shape[-2:]
+    flat = stack.reshape(len(stack), -1)
+    labels = np.zeros(len(stack), dtype=bool) if labels is None else np.asarray(labels, dtype=bool)
+    outside = (x < 0) | (y < 0) | (x > n_rows - 1) | (y > n_cols - 1)
+
+    linear = np.flatnonzero(~labels)
+    if len(linear):
+        x0 = np.clip(np.floor(x), 0, max(n_rows - 2, 0)).astype(np.intp)
+        y0 = np.clip(np.floor(y), 0, max(n_cols - 2, 0)).astype(np.intp)
+        fx, fy = x - x0, y - y0
+        dx = np.where(x0 + 1 < n_rows, n_cols, 0)
+        dy = np.where(y0 + 1 < n_cols, 1, 0)
+        index = x0 * n_cols + y0
+        weights = [(1 - fx) * (1 - fy), (1 - fx) * fy, fx * (1 - fy), fx * fy]
+        offsets = [0, dy, dx, dx + dy]
+        for channel in linear:
+            values = flat[channel]
+            result = sum(w * values[index + o] for w, o in zip(weights, offsets))
+            result[outside] = cval
+            if np.issubdtype(out.dtype, np.integer):
+                # rounding of ndimage for integer outputs (half away from zero)
+                result = np.where(result < 0, np.ceil(result - .5), np.floor(result + .5))
+            out[channel] = result
+
+    nearest = np.flatnonzero(labels)
+    if len(nearest):
+        xn = np.clip(np.floor(x + .5), 0, n_rows - 1).astype(np.intp)
+        yn = np.clip(np.floor(y + .5), 0, n_cols - 1).astype(np.intp)
+        index = xn * n_cols + yn
+        for channel in nearest:
+            result = flat[channel][index]
+            result[outside] = cval
+            out[channel] = result
+    return out
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, nogil=True)
+    def _bilinear(image, x, y, cval):
+        n_rows, n_cols = image.shape
+        if (x < 0) or (y < 0) or (x > n_rows - 1) or (y > n_cols - 1):
+            return cval
+        x0 = min(int(x), n_rows - 2) if n_rows > 1 else 0
+        y0 = min(int(y), n_cols - 2) if n_cols > 1 else 0
+        x1 = min(x0 + 1, n_rows - 1)
+        y1 = min(y0 + 1, n_cols - 1)
+        fx, fy = x - x0, y - y0
+        return ((image[x0, y0] * (1 - fy) + image[x0, y1] * fy) * (1 - fx)
+              + (image[x1, y0] * (1 - fy) + image[x1, y1] * fy) * fx)
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _tps_warp_numba(image, coeffs, points, x_axis, y_axis, cval, round_output, out):
+        n = points.shape[0]
+        for row in prange(x_axis.shape[0]):
+            x = x_axis[row]
+            for col in range(y_axis.shape[0]):
+                y = y_axis[col]
+                f_x = coeffs[n, 0] + coeffs[n+1, 0] * x + coeffs[n+2, 0] * y
+                f_y = coeffs[n, 1] + coeffs[n+1, 1] * x + coeffs[n+2, 1] * y
+                for k in range(n):
+                    dx = x - points[k, 0]
+                    dy = y - points[k, 1]
+                    r_sq = dx * dx + dy * dy
+                    if r_sq > 0:
+                        kernel = .5 * r_sq * math.log(r_sq)
+                        f_x += coeffs[k, 0] * kernel
+                        f_y += coeffs[k, 1] * kernel
+                value = _bilinear(image, f_x, f_y, cval)
+                if round_output:
+                    value = math.floor(value + .5) if value >= 0 else math.ceil(value - .5)
+                out[row, col] = value
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _tps_points_numba(coeffs, centers, points, jacobian, values, jac):
+        n = centers.shape[0]
+        for m in prange(points.shape[0]):
+            x, y = points[m, 0], points[m, 1]
+            f_x = coeffs[n, 0] + coeffs[n+1, 0] * x + coeffs[n+2, 0] * y
+            f_y = coeffs[n, 1] + coeffs[n+1, 1] * x + coeffs[n+2, 1] * y
+            j_xx, j_xy = coeffs[n+1, 0], coeffs[n+2, 0]
+            j_yx, j_yy = coeffs[n+1, 1], coeffs[n+2, 1]
+            for k in range(n):
+                dx = x - centers[k, 0]
+                dy = y - centers[k, 1]
+                r_sq = dx * dx + dy * dy
+                if r_sq > 0:
+                    log_r_sq = math.log(r_sq)
+                    kernel = .5 * r_sq * log_r_sq
+                    f_x += coeffs[k, 0] * kernel
+                    f_y += coeffs[k, 1] * kernel
+                    if jacobian:
+                        factor = log_r_sq + 1
+                        j_xx += coeffs[k, 0] * dx * factor
+                        j_xy += coeffs[k, 0] * dy * factor
+                        j_yx += coeffs[k, 1] * dx * factor
+                        j_yy += coeffs[k, 1] * dy * factor
+            values[m, 0] = f_x
+            values[m, 1] = f_y
+            if jacobian:
+                jac[m, 0, 0] = j_xx
+                jac[m, 0, 1] = j_xy
+                jac[m, 1, 0] = j_yx
+                jac[m, 1, 1] = j_yy
+else:
+    _tps_warp_numba = None
+    _tps_points_numba = None
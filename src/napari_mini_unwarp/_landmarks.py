@@ -0,0 +1,95 @@
+### LANDMARKS
+# Canonical representation of (user defined / propagated) grid points across planes.
+#
+# Everything is stored in one (planes x points x 3) array:
+# [..., 0] is the plane index and [..., 1:] the (row, col) position.
+# napari's points layer layout ((planes * points) x 3) is a plain reshape of that array,
+# so converting back and forth does not copy or loop. Point i in plane p
+# sits in row p * num_points + i of the layer data.
+#
+import numpy as np
+
+
+class Landmarks:
+    '''
+    Grid landmarks across planes
+
+    Parameters
+    ----------
+    positions : np.array : planes x points x 2 (row, col) positions,
+                           or points x 2 for single plane data
+    '''
+
+    def __init__(self, positions):
+        positions = np.asarray(positions, dtype=float)
+        if positions.ndim == 2:
+            positions = positions[np.newaxis]
+        if (positions.ndim != 3) or (positions.shape[-1] != 2):
+            raise ValueError(f'Expected planes x points x 2 positions, got {positions.shape}')
+        num_planes, num_points, _ = positions.shape
+        self.data = np.empty((num_planes, num_points, 3))
+        self.data[..., 0]  = np.arange(num_planes)[:, np.newaxis]
+        self.data[..., 1:] = positions
+
+    @classmethod
+    def from_layer_data(cls, layer_data, num_planes=1):
+        '''
+        Create landmarks from napari points layer data
+
+        Parameters
+        ----------
+        layer_data : np.array : (planes * points) x 3 (plane, row, col)
+                                or points x 2 (row, col) for single plane data
+        num_planes : int : number of planes
+
+        Returns
+        -------
+        landmarks : Landmarks
+        '''
+        layer_data = np.asarray(layer_data, dtype=float)
+        if layer_data.shape[-1] == 2:
+            return cls(layer_data.reshape(num_planes, -1, 2))
+        if len(layer_data) % num_planes:
+            raise ValueError(f'{len(layer_data)} points cannot be split evenly across {num_planes} planes')
+        data = layer_data.reshape(num_planes, -1, 3)
+        if not (data[..., 0] == np.arange(num_planes)[:, np.newaxis]).all():
+            raise ValueError('Points are not ordered by plane - were points added or deleted?')
+        landmarks = cls.__new__(cls)
+        landmarks.data = data
+        return landmarks
+
+    @property
+    def positions(self):
+        ''' planes x points x 2 (row, col) view '''
+        return self.data[..., 1:]
+
+    @property
+    def plane_index(self):
+        ''' planes x points view of plane indices '''
+        return self.data[..., 0]
+
+    @property
+    def num_planes(self):
+        return self.data.shape[0]
+
+    @property
+    def num_points(self):
+        return self.data.shape[1]
+
+    @property
+    def layer_data(self):
+        ''' (planes * points) x 3 napari points layer data (view) '''
+        return self.data.reshape(-1, 3)
+
+    def point_index(self, rows):
+        '''
+        Convert row indices of the layer data into (plane indices, point indices)
+        '''
+        return np.divmod(np.asarray(rows), self.num_points)
+
+    def __getitem__(self, plane_idx):
+        ''' points x 2 (row, col) positions in plane `plane_idx` '''
+        return self.positions[plane_idx]
+
+    def __len__(self):
+        return self.num_planes
@@ -0,0 +1,194 @@
+### FOLDER MANIFEST
+# Opening a folder of ScanImage .tif files only needs a few numbers per file
+# (imaging depth, zoom, width, height) to sort and validate the stack.
+# Parsing the full ScanImage header of every file through scanreader dominates
+# the time to first pixel, in particular on network shares.
+#
+# - Only the static ScanImage header block at the start of the file is read
+#   (tifffile.read_scanimage_metadata(), or the tags of the first page for older files),
+#   for all files in parallel.
+# - The results are stored in a sidecar index (MANIFEST_NAME, JSON) in the folder,
+#   keyed by file name and validated against the file stat (size, modification time).
+#   Later opens only re-read new or changed files.
+# - Sorting and the validation checks of tif_reader() run from the manifest alone.
+#
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from tifffile import TiffFile, read_scanimage_metadata, matlabstr2py
+
+MANIFEST_NAME = 'napari_mini_unwarp_manifest.json'
+MANIFEST_VERSION = 2
+MANIFEST_WORKERS = 8 # Headers are read in parallel (I/O bound)
+
+# ScanImage header fields (first match wins)
+_DEPTH_KEYS  = ('SI.hStackManager.zsRelative', 'SI.hStackManager.zs', 'SI.hFastZ.userZs')
+_ZOOM_KEY    = 'SI.hRoiManager.scanZoomFactor'
+_WIDTH_KEY   = 'SI.hRoiManager.pixelsPerLine'
+_HEIGHT_KEY  = 'SI.hRoiManager.linesPerFrame'
+# Frame layout of multi-plane files (see _scanimage.py)
+_CHANNELS_KEY         = 'SI.hChannels.channelSave'
+_FAST_Z_KEY           = 'SI.hFastZ.enable'
+_DISCARD_FLYBACK_KEY  = 'SI.hFastZ.discardFlybackFrames'
+_FLYBACK_FRAMES_KEY   = 'SI.hFastZ.numDiscardFlybackFrames'
+_FRAMES_PER_SLICE_KEY = 'SI.hStackManager.framesPerSlice'
+
+
+def _file_stat(tif_path):
+    stat = os.stat(tif_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _scanimage_frame_data(tif_path):
+    '''
+    Static ScanImage frame data without parsing the image pages
+    '''
+    with open(tif_path, 'rb') as fh:
+        try:
+            frame_data, _, _ = read_scanimage_metadata(fh)
+            return frame_data
+        except ValueError:
+            pass
+    # Older (non BigTIFF) ScanImage files keep the header in the tags of every page:
+    # only the first one is parsed
+    with TiffFile(tif_path) as tif:
+        page = tif.pages.first
+        for text in (page.software, page.description):
+            if text and 'SI.' in text:
+                return matlabstr2py(text)
+    return None
+
+
+def read_header(tif_path):
+    '''
+    Read the header fields needed to sort and validate a folder of ScanImage .tif files
+
+    Parameters
+    ----------
+    tif_path : str or Path : .tif file
+
+    Returns
+    -------
+    entry : dict : 'size' and 'mtime_ns' (file stat), 'scanimage' (bool) and, for ScanImage
+                   files, 'depths' (list of imaging depths), 'zoom', 'width' and 'height',
+                   as well as the frame layout: 'num_channels', 'fast_z', 'flyback_frames' 
+                   and 'frames_per_slice' (see _scanimage.py)
+    '''
+    size, mtime_ns = _file_stat(tif_path)
+    entry = {'size': size, 'mtime_ns': mtime_ns, 'scanimage': False}
+    frame_data = _scanimage_frame_data(tif_path)
+    if frame_data is None:
+        return entry
+    depths = next((frame_data[key] for key in _DEPTH_KEYS if key in frame_data), 0)
+    entry.update({
+        'scanimage' : True,
+        'depths'    : np.atleast_1d(np.asarray(depths, dtype=float)).tolist(),
+        'zoom'      : float(frame_data.get(_ZOOM_KEY, np.nan)),
+        'width'     : int(frame_data.get(_WIDTH_KEY, 0)),
+        'height'    : int(frame_data.get(_HEIGHT_KEY, 0)),
+        'num_channels'     : max(1, int(np.size(frame_data.get(_CHANNELS_KEY, 1)))),
+        'fast_z'           : bool(frame_data.get(_FAST_Z_KEY, False)),
+        'flyback_frames'   : int(frame_data.get(_FLYBACK_FRAMES_KEY, 0)) 
+                             if frame_data.get(_DISCARD_FLYBACK_KEY, True) else 0,
+        'frames_per_slice' : max(1, int(frame_data.get(_FRAMES_PER_SLICE_KEY, 1))),
+        })
+    return entry
+
+
+def load_manifest(folder, workers=MANIFEST_WORKERS, save=True):
+    '''
+    Header information of all .tif files in `folder`, from the sidecar manifest where possible
+
+    Parameters
+    ----------
+    folder : str or Path : folder of .tif files
+    workers : int : number of threads reading headers of new or changed files
+    save : bool : write the updated manifest back to the folder
+                  (failures, e.g. on read-only shares, are reported but not raised)
+
+    Returns
+    -------
+    entries : OrderedDict : file name -> entry (see read_header()), sorted by file name
+    '''
+    folder = Path(folder)
+    manifest_path = folder / MANIFEST_NAME
+    cached = {}
+    if manifest_path.exists():
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                cached = manifest['files']
+        except (OSError, ValueError, KeyError):
+            print(f'Could not read {manifest_path.as_posix()} - rebuilding it')
+
+    entries = OrderedDict()
+    to_read = []
+    for tif_file in sorted(folder.glob(r'*.tif')):
+        entry = cached.get(tif_file.name)
+        if (entry is not None) and ((entry['size'], entry['mtime_ns']) == _file_stat(tif_file)):
+            entries[tif_file.name] = entry
+        else:
+            entries[tif_file.name] = None
+            to_read.append(tif_file)
+
+    if to_read:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for tif_file, entry in zip(to_read, executor.map(read_header, to_read)):
+                entries[tif_file.name] = entry
+
+    if save and (to_read or (set(cached) != set(entries))):
+        try:
+            temp_path = manifest_path.with_suffix('.tmp')
+            with open(temp_path, 'w') as manifest_file:
+                json.dump({'version': MANIFEST_VERSION, 'files': entries}, manifest_file, indent=1)
+            os.replace(temp_path, manifest_path)
+        except OSError as error:
+            print(f'Could not write manifest ({error})')
+    return entries
+
+
+def scanimage_stack(folder, entries=None):
+    '''
+    Sort and validate a folder of ScanImage .tif files from its manifest.
+    Files may contain one or several imaging depths (see _scanimage.py)
+
+    Parameters
+    ----------
+    folder : str or Path : folder of .tif files
+    entries : OrderedDict : output of load_manifest(). Loaded if not given
+
+    Returns
+    -------
+    sorted_zpos : OrderedDict : imaging depth -> file path, sorted by depth.
+                                Multi-plane files appear once per depth
+    zoom : float : zoom level (same for all files)
+    '''
+    folder = Path(folder)
+    entries = load_manifest(folder) if entries is None else entries
+    tif_dict = {}
+    num_planes = 0
+    zooms, widths, heights = [], [], []
+    for name, entry in entries.items():
+        if not entry['scanimage']:
+            raise NotImplementedError('Not a ScanImage .tif file')
+        depths = entry['depths']
+        print(f'{name:<30} ScanImage .tif with zoom {entry["zoom"]}, depth{"s" if len(depths) > 1 else ""} '
+              f'{depths if len(depths) > 1 else depths[0]}')
+        for z_height in depths:
+            tif_dict[z_height] = (folder / name).as_posix()
+        num_planes += len(depths)
+        zooms.append(entry['zoom'])
+        widths.append(entry['width'])
+        heights.append(entry['height'])
+
+    sorted_zpos = OrderedDict(sorted(tif_dict.items()))
+    # Perform checks
+    assert len(sorted_zpos) == num_planes, 'There seem to be duplicates in z position data'
+    assert len(np.unique(zooms)) == 1, f'There seems to be more than one zoom level across tifs {np.unique(zooms)}'
+    assert len(np.unique(widths)) == 1, f'Tif stacks seem to vary in width {np.unique(widths)}'
+    assert len(np.unique(heights)) == 1, f'Tif stacks seem to vary in height {np.unique(heights)}'
+    return sorted_zpos, zooms[0]
@@ -0,0 +1,141 @@
+### PIECEWISE AFFINE WARP
+# Alternative to the thin plate spline in _unwarp.py (see header comment there):
+# the landmarks are triangulated once (Delaunay), and every triangle gets its own affine transform.
+#
+# Evaluation over an output grid does not touch the landmarks at all:
+# 1. Rasterize a triangle-index map over the grid (each triangle only visits the
+#    pixels inside its bounding box).
+# 2. Pixels outside of the convex hull of the landmarks are assigned to the closest
+#    triangle on the hull (extrapolation), by a KD-tree query on the triangle centroids.
+#    This only depends on the pixel position itself, so evaluating the grid in tiles
+#    gives the same result (see _tiling.py).
+# 3. Every pixel is mapped with the affine matrix of its triangle, in one vectorized gather.
+# The cost per pixel is therefore independent of the number of landmarks
+# (unlike the TPS, where every pixel touches every landmark).
+#
+from collections import OrderedDict
+import threading
+import numpy as np
+from scipy.spatial import Delaunay, cKDTree
+
+
+class PiecewiseAffine:
+    '''
+    Piecewise affine transform mapping `from_points` onto `to_points`
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    '''
+
+    def __init__(self, from_points, to_points):
+        self.from_points = np.asarray(from_points, dtype=float)
+        self.to_points   = np.asarray(to_points, dtype=float)
+        self.triangulation = Delaunay(self.from_points)
+        self.affines = self._fit_affines()
+        # Triangles on the convex hull (with a missing neighbour) for extrapolation
+        self.hull_triangles = np.flatnonzero((self.triangulation.neighbors < 0).any(axis=1))
+        centroids = self.from_points[self.triangulation.simplices[self.hull_triangles]].mean(axis=1)
+        self.hull_tree = cKDTree(centroids)
+
+    def _fit_affines(self):
+        '''
+        Affine matrix of every triangle: [x, y, 1] @ affine = [x', y']
+        (triangles x 3 x 2)
+        '''
+        simplices = self.triangulation.simplices
+        src = np.concatenate([self.from_points[simplices],
+                              np.ones((len(simplices), 3, 1))], axis=-1) # triangles x 3 x 3
+        dst = self.to_points[simplices]                                   # triangles x 3 x 2
+        return np.linalg.solve(src, dst)
+
+    def index_map(self, x, y):
+        '''
+        Triangle index of every grid point, rasterized per triangle.
+
+        Parameters
+        ----------
+        x, y : np.array : 2D coordinate grids as produced by numpy.mgrid
+                          (x constant along axis 1, y constant along axis 0)
+
+        Returns
+        -------
+        index : np.array : triangle index for every grid point
+                           (grid points outside the convex hull are assigned to the closest hull triangle)
+        '''
+        x_axis, y_axis = x[:, 0], y[0, :]
+        index = np.full(x.shape, -1, dtype=int)
+        vertices = self.from_points[self.triangulation.simplices] # triangles x 3 x 2
+        transforms = self.triangulation.transform                 # barycentric coordinates
+        eps = 1e-9
+        for tri_idx, (corners, transform) in enumerate(zip(vertices, transforms)):
+            x0, x1 = np.searchsorted(x_axis, [corners[:, 0].min() - eps, corners[:, 0].max() + eps])
+            y0, y1 = np.searchsorted(y_axis, [corners[:, 1].min() - eps, corners[:, 1].max() + eps])
+            if (x1 <= x0) or (y1 <= y0):
+                continue
+            dx = x_axis[x0:x1, np.newaxis] - transform[2, 0]
+            dy = y_axis[np.newaxis, y0:y1] - transform[2, 1]
+            b0 = transform[0, 0] * dx + transform[0, 1] * dy
+            b1 = transform[1, 0] * dx + transform[1, 1] * dy
+            inside = (b0 >= -eps) & (b1 >= -eps) & (1 - b0 - b1 >= -eps)
+            index[x0:x1, y0:y1][inside] = tri_idx
+
+        outside = index < 0
+        if outside.any():
+            _, closest = self.hull_tree.query(np.stack([x[outside], y[outside]], axis=1))
+            index[outside] = self.hull_triangles[closest]
+        return index
+
+    def evaluate(self, x, y, index=None):
+        '''
+        Evaluate the transform on coordinate grids `x`, `y` (see index_map())
+
+        Returns
+        -------
+        [x_warp, y_warp] : list of np.arrays
+        '''
+        if index is None:
+            index = self.index_map(x, y)
+        affines = self.affines[index] # ... x 3 x 2
+        x_warp = affines[..., 0, 0] * x + affines[..., 1, 0] * y + affines[..., 2, 0]
+        y_warp = affines[..., 0, 1] * x + affines[..., 1, 1] * y + affines[..., 2, 1]
+        return [x_warp, y_warp]
+
+
+# The triangle-index map only depends on from_points and the grid. In the inverse warp
+# from_points are the (fixed) standard grid points, so it is cached for the full output grid
+# of _make_inverse_warp() in _unwarp.py, and tiles of that grid (see _tiling.py) slice their part.
+# Tiles can run in parallel threads, so the cache is guarded by a lock. The lock is held while
+# a missing map is built, so that it is built once and the other tiles wait for it.
+_INDEX_CACHE_SIZE = 4
+_index_cache = OrderedDict()
+_index_lock = threading.Lock()
+def _cached_index_map(transform, x_axis, y_axis):
+    key = (transform.from_points.tobytes(), x_axis.dtype.str, x_axis.tobytes(), y_axis.tobytes())
+    with _index_lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+        index = transform.index_map(*np.meshgrid(x_axis, y_axis, indexing='ij'))
+        _index_cache[key] = index
+        if len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+        return index
+
+def make_piecewise_affine_warp(from_points, to_points, x_vals, y_vals, grid=None):
+    '''
+    Piecewise affine counterpart of _make_warp() in _unwarp.py
+
+    grid : tuple : optional (x_axis, y_axis, rows, cols) - the axes of the full grid
+                   that x_vals, y_vals are the (rows, cols) range of. The triangle-index
+                   map of the full grid is then cached. Without it, the map is built
+                   for x_vals, y_vals only.
+    '''
+    transform = PiecewiseAffine(from_points, to_points)
+    if grid is None:
+        index = transform.index_map(x_vals, y_vals)
+    else:
+        x_axis, y_axis, rows, cols = grid
+        index = _cached_index_map(transform, x_axis, y_axis)[slice(*rows), slice(*cols)]
+    return transform.evaluate(x_vals, y_vals, index=index)
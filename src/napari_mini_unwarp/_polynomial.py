@@ -0,0 +1,149 @@
+### POLYNOMIAL DISTORTION MODEL
+# Fast alternative to the thin plate spline in _unwarp.py for smooth distortions
+# (barrel / pincushion plus shear), which a low order 2D polynomial captures well:
+#     f(x, y) = sum_{i + j <= order} c_ij * x**i * y**j
+#
+# - Fitting is a small linear least squares problem (one column per monomial),
+#   so the cost does not depend on the image size.
+# - Evaluation uses a nested Horner scheme (in y for every power of x, then in x),
+#   i.e. a handful of multiply-adds per pixel instead of one kernel evaluation per landmark.
+# - Unlike TPS, the polynomial does not interpolate the landmarks. The residuals at the landmarks
+#   tell whether the model is adequate: select_polynomial_model() returns the lowest order with a
+#   residual below a tolerance (see 'auto' in WARP_METHODS in _unwarp.py, which falls back to TPS otherwise).
+#
+# Coordinates are centered and scaled to [-1, 1] before fitting to keep the problem well conditioned.
+#
+import numpy as np
+
+POLYNOMIAL_ORDERS = (3, 4, 5)  # Orders tried by select_polynomial_model()
+POLYNOMIAL_TOLERANCE = .5      # Maximum RMS residual (in pixels) to accept a polynomial model
+
+
+def _exponents(order):
+    ''' (i, j) exponents of all monomials x**i * y**j with i + j <= order '''
+    return [(i, j) for i in range(order+1) for j in range(order+1-i)]
+
+
+class PolynomialModel:
+    '''
+    2D polynomial transform mapping `from_points` onto `to_points` (least squares)
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    order : int : polynomial order
+    exact : bool : also accept as many landmarks as monomials (the model then interpolates 
+                   the landmarks, and its residuals do not tell whether it is adequate). 
+                   By default, more landmarks than monomials are required
+    '''
+
+    def __init__(self, from_points, to_points, order=3, exact=False):
+        self.from_points = np.asarray(from_points, dtype=float)
+        self.to_points   = np.asarray(to_points, dtype=float)
+        self.order = int(order)
+        exponents = _exponents(self.order)
+        if (len(self.from_points) < len(exponents)) or ((len(self.from_points) == len(exponents)) and not exact):
+            required = f'{len(exponents)}' if exact else f'more than {len(exponents)}'
+            raise ValueError(f'Order {self.order} needs {required} landmarks, got {len(self.from_points)}')
+
+        self.center = self.from_points.mean(axis=0)
+        self.scale  = np.abs(self.from_points - self.center).max(axis=0)
+        self.scale[self.scale == 0] = 1
+        x, y = self._normalize(self.from_points[:, 0], self.from_points[:, 1])
+        design = np.stack([x**i * y**j for i, j in exponents], axis=1)
+        solution, _, rank, _ = np.linalg.lstsq(design, self.to_points, rcond=None)
+        if rank < len(exponents):
+            # e.g. order >= number of rows / columns of a regular grid: exact at the landmarks, 
+            # but arbitrary in between
+            raise ValueError(f'Order {self.order} is not determined by the landmarks '
+                             f'(rank {rank} < {len(exponents)} monomials)')
+
+        # Coefficient matrix: coeffs[i, j, dim] belongs to x**i * y**j
+        self.coeffs = np.zeros((self.order+1, self.order+1, 2))
+        for (i, j), c in zip(exponents, solution):
+            self.coeffs[i, j] = c
+        self.residuals = np.stack(self.evaluate(self.from_points[:, 0], self.from_points[:, 1]), axis=1) - self.to_points
+
+    def _normalize(self, x, y):
+        return (x - self.center[0]) / self.scale[0], (y - self.center[1]) / self.scale[1]
+
+    @property
+    def rms_residual(self):
+        ''' Root mean square (euclidean) residual over all landmarks '''
+        return np.sqrt((self.residuals**2).sum(axis=1).mean())
+
+    @property
+    def max_residual(self):
+        ''' Largest (euclidean) residual over all landmarks '''
+        return np.sqrt((self.residuals**2).sum(axis=1)).max()
+
+    def evaluate(self, x, y):
+        '''
+        Evaluate the transform at coordinates `x`, `y` (arrays of any, but equal, shape)
+
+        Returns
+        -------
+        [x_warp, y_warp] : list of np.arrays
+        '''
+        x, y = self._normalize(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        warped = []
+        for dim in range(2):
+            coeffs = self.coeffs[..., dim]
+            result = np.zeros(x.shape)
+            for i in range(self.order, -1, -1):
+                # Horner in y for the coefficient of x**i ...
+                inner = np.full(y.shape, coeffs[i, self.order-i])
+                for j in range(self.order-i-1, -1, -1):
+                    inner = inner * y + coeffs[i, j]
+                # ... and in x
+                result = result * x + inner
+            warped.append(result)
+        return warped
+
+
+def select_polynomial_model(from_points, to_points, orders=POLYNOMIAL_ORDERS, tolerance=POLYNOMIAL_TOLERANCE):
+    '''
+    Fit polynomial models of increasing order and return the first one
+    whose RMS residual is below `tolerance`
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    orders : iterable : polynomial orders to try (in this order)
+    tolerance : float : maximum RMS residual (in units of `to_points`)
+
+    Returns
+    -------
+    model : PolynomialModel or None : None if no model is accurate enough
+    '''
+    for order in orders:
+        try:
+            model = PolynomialModel(from_points, to_points, order=order)
+        except ValueError:
+            # Not enough (distinct) landmarks for this (and any higher) order
+            break
+        if model.rms_residual < tolerance:
+            return model
+    return None
+
+
+def fit_polynomial_model(from_points, to_points):
+    '''
+    Polynomial model of the highest order in POLYNOMIAL_ORDERS that the landmarks determine
+    (order 1 if none does - an exact affine transform for 3 landmarks), as used by the 'polynomial' backend
+    '''
+    for order in sorted(POLYNOMIAL_ORDERS, reverse=True) + [1]:
+        try:
+            return PolynomialModel(from_points, to_points, order=order)
+        except ValueError:
+            continue
+    return PolynomialModel(from_points, to_points, order=1, exact=True)
+
+
+def make_polynomial_warp(from_points, to_points, x_vals, y_vals):
+    '''
+    Polynomial counterpart of _make_warp() in _unwarp.py (see fit_polynomial_model())
+    '''
+    return fit_polynomial_model(from_points, to_points).evaluate(x_vals, y_vals)
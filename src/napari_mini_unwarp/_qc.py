@@ -0,0 +1,159 @@
+### LANDMARK QC
+# Quantitative feedback on the fitted warp:
+#
+# - Leave-one-out (LOO) residuals: for every landmark, the distance between its position and
+#   the position predicted by a TPS fitted to all *other* landmarks. A dot that was dragged
+#   to the wrong place stands out with a large LOO residual.
+#   Instead of N refits, the closed form for interpolating (kernel + polynomial) systems is used
+#   (Rippa, Adv. Comput. Math. 11, 193-210 (1999)):
+#       residual_i = coeffs_i / (L^-1)_ii
+#   This needs only the inverse of L, which is shared with (cached by) the warp itself.
+#
+# - Jacobian determinant map of the warp, from the analytic derivatives of the TPS.
+#   Values <= 0 mean that the warp folds over itself, values far from 1 indicate strong
+#   local compression / expansion.
+#
+# Both describe the warp of the selected backend (see WARP_METHODS in _unwarp.py). For the other
+# backends there is no closed form: LOO residuals come from N refits (cheap for these backends),
+# and the Jacobian from central differences of the warp (JACOBIAN_STEP pixels).
+# Note that the residuals of the (approximating) polynomial are not zero even with all landmarks.
+#
+import numpy as np
+
+from ._transform import ThinPlateSpline
+from ._unwarp import WARP_METHODS
+
+JACOBIAN_STEP = .5 # Step (pixels) of the central differences for non-TPS backends
+
+
+def leave_one_out_residuals(tps):
+    '''
+    Leave-one-out residuals of all landmarks of a fitted TPS
+
+    Parameters
+    ----------
+    tps : ThinPlateSpline : fitted transform
+
+    Returns
+    -------
+    residuals : np.array : N x 2 difference between each to_point and its
+                           prediction from all other landmarks
+    '''
+    n = len(tps.from_points)
+    diagonal = np.diag(tps.L_inv)[:n]
+    return tps.coeffs[:n] / diagonal[:, np.newaxis]
+
+
+def jacobian_determinant(tps, x, y):
+    '''
+    Determinant of the Jacobian of a fitted TPS at coordinates `x`, `y`
+
+    For U(r) = r**2 log(r): dU/dx = (x - x_i) * (2 log(r) + 1), and 0 at r = 0
+
+    Parameters
+    ----------
+    tps : ThinPlateSpline : fitted transform
+    x, y : np.array : coordinates (arrays of any, but equal, shape)
+
+    Returns
+    -------
+    det : np.array : Jacobian determinant, same shape as `x`
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    coeffs = tps.coeffs
+    # Affine part: [a1, ax, ay] for both output coordinates
+    dfx_dx = np.full(x.shape, coeffs[-2, 0])
+    dfx_dy = np.full(x.shape, coeffs[-1, 0])
+    dfy_dx = np.full(x.shape, coeffs[-2, 1])
+    dfy_dy = np.full(x.shape, coeffs[-1, 1])
+    for (w_x, w_y), point in zip(coeffs[:-3], tps.from_points):
+        dx, dy = x - point[0], y - point[1]
+        r_sq = dx**2 + dy**2
+        factor = np.log(np.where(r_sq > 0, r_sq, 1)) + 1 # 2 log(r) + 1
+        factor[r_sq == 0] = 0
+        dfx_dx += w_x * dx * factor
+        dfx_dy += w_x * dy * factor
+        dfy_dx += w_y * dx * factor
+        dfy_dy += w_y * dy * factor
+    return dfx_dx * dfy_dy - dfx_dy * dfy_dx
+
+
+def leave_one_out_refit(from_points, to_points, method):
+    '''
+    Leave-one-out residuals of any backend, by refitting without each landmark in turn
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    method : str : warping backend, one of WARP_METHODS
+
+    Returns
+    -------
+    residuals : np.array : N x 2 difference between each to_point and its
+                           prediction from all other landmarks
+    '''
+    from_points, to_points = np.asarray(from_points, dtype=float), np.asarray(to_points, dtype=float)
+    residuals = np.zeros_like(to_points)
+    keep = np.ones(len(from_points), dtype=bool)
+    for i, point in enumerate(from_points):
+        keep[i] = False
+        # Evaluated on a 1 x 1 grid, as the backends expect
+        predicted = WARP_METHODS[method](from_points[keep], to_points[keep], 
+                                         np.full((1, 1), point[0]), np.full((1, 1), point[1]))
+        residuals[i] = to_points[i] - np.ravel(predicted)
+        keep[i] = True
+    return residuals
+
+
+def jacobian_determinant_numeric(from_points, to_points, x, y, method, step=JACOBIAN_STEP):
+    '''
+    Determinant of the Jacobian of any backend at grid coordinates `x`, `y`
+    (2D arrays as from np.mgrid), by central differences
+
+    Returns
+    -------
+    det : np.array : Jacobian determinant, same shape as `x`
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    warp = WARP_METHODS[method]
+    fx_plus, fy_plus = warp(from_points, to_points, x + step, y)
+    fx_minus, fy_minus = warp(from_points, to_points, x - step, y)
+    dfx_dx, dfy_dx = (fx_plus - fx_minus) / (2 * step), (fy_plus - fy_minus) / (2 * step)
+    fx_plus, fy_plus = warp(from_points, to_points, x, y + step)
+    fx_minus, fy_minus = warp(from_points, to_points, x, y - step)
+    dfx_dy, dfy_dy = (fx_plus - fx_minus) / (2 * step), (fy_plus - fy_minus) / (2 * step)
+    return dfx_dx * dfy_dy - dfx_dy * dfy_dx
+
+
+def landmark_qc(usr_dots, grid_dots, image_shape, step=8, method='tps'):
+    '''
+    QC of the warp between user defined and standard grid points,
+    as it is used for unwarping (fitted from `grid_dots` to `usr_dots`, see _make_inverse_warp())
+
+    Parameters
+    ----------
+    usr_dots : np.array : user defined grid points (points x 2)
+    grid_dots : np.array : standard grid points (points x 2)
+    image_shape : tuple : shape of the (2D) grid image
+    step : int : spacing in pixels of the grid the Jacobian determinant is evaluated on
+    method : str : warping backend, one of WARP_METHODS (see warp_images())
+
+    Returns
+    -------
+    loo_error : np.array : leave-one-out residual (length in pixels) of every user point
+    jacobian : np.array : Jacobian determinant of the warp on a grid with spacing `step`
+    '''
+    if method not in WARP_METHODS:
+        raise ValueError(f'Unknown warping method "{method}". Choose from {list(WARP_METHODS)}')
+    x, y = np.mgrid[0:image_shape[0]:step, 0:image_shape[1]:step]
+    if method == 'tps':
+        tps = ThinPlateSpline(grid_dots, usr_dots)
+        loo_error = np.linalg.norm(leave_one_out_residuals(tps), axis=1)
+        jacobian = jacobian_determinant(tps, x, y)
+    else:
+        err = np.seterr(divide='ignore', invalid='ignore')
+        loo_error = np.linalg.norm(leave_one_out_refit(grid_dots, usr_dots, method), axis=1)
+        jacobian = jacobian_determinant_numeric(grid_dots, usr_dots, x, y, method)
+        np.seterr(**err)
+    return loo_error, jacobian
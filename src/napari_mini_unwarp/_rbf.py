@@ -0,0 +1,122 @@
+### COMPACTLY SUPPORTED RBF WARP
+# Alternative to the thin plate spline in _unwarp.py for dense calibration grids.
+#
+# The TPS kernel (_U) has global support: the system matrix L is dense ((N+3)**2)
+# and every pixel has to be evaluated against every landmark.
+# Here the kernel is the Wendland C2 function
+#     phi(r) = (1 - r/s)**4 * (4 r/s + 1)   for r < s, 0 otherwise
+# with support radius s (a few grid spacings). Like the TPS, an affine part is added,
+# so affine warps are reproduced exactly.
+#
+# - The system matrix is sparse: only landmark pairs closer than s (found through a KD-tree)
+#   have non-zero entries. It is solved with a sparse LU decomposition.
+# - Evaluation is neighbour-limited: on coordinate grids, every landmark only touches
+#   the pixels within its support, and for arbitrary coordinates the KD-tree
+#   returns the landmarks within reach of every point.
+# The total cost therefore scales close to linearly with the number of landmarks.
+#
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from scipy.spatial import cKDTree
+
+
+def wendland(r, support):
+    '''
+    Wendland C2 kernel with compact support
+    '''
+    q = np.clip(r / support, 0, 1)
+    return (1 - q)**4 * (4 * q + 1)
+
+
+class CompactRBF:
+    '''
+    Compactly supported radial basis function transform mapping `from_points` onto `to_points`
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    support : float : support radius of the kernel (in units of the landmark coordinates).
+                      If None, `support_factor` times the median nearest neighbour distance
+                      of `from_points`
+    support_factor : float : see `support`
+    '''
+
+    def __init__(self, from_points, to_points, support=None, support_factor=6):
+        self.from_points = np.asarray(from_points, dtype=float)
+        self.to_points   = np.asarray(to_points, dtype=float)
+        if self.from_points.shape != self.to_points.shape:
+            raise ValueError(f'Landmark shapes do not match: {self.from_points.shape} vs. {self.to_points.shape}')
+        self.tree = cKDTree(self.from_points)
+        if support is None:
+            distances, _ = self.tree.query(self.from_points, k=2)
+            support = support_factor * np.median(distances[:, 1])
+        self.support = float(support)
+        self.coeffs = self._solve()
+
+    def _solve(self):
+        '''
+        Sparse counterpart of the TPS system (see _make_L_matrix() in _unwarp.py):
+        [[K, P], [P.T, 0]] @ coeffs = [to_points, 0]
+        '''
+        n = len(self.from_points)
+        pairs = self.tree.sparse_distance_matrix(self.tree, self.support, output_type='coo_matrix')
+        K = sparse.coo_matrix((wendland(pairs.data, self.support), (pairs.row, pairs.col)), shape=(n, n))
+        P = sparse.csr_matrix(np.concatenate([np.ones((n, 1)), self.from_points], axis=1))
+        L = sparse.bmat([[K, P], [P.T, None]], format='csc')
+        V = np.zeros((n+3, 2))
+        V[:-3] = self.to_points
+        return spsolve(L, V).reshape(n+3, 2)
+
+    def evaluate(self, x, y, chunk_size=2**16):
+        '''
+        Evaluate the transform at coordinates `x`, `y` (arrays of any, but equal, shape)
+
+        Returns
+        -------
+        [x_warp, y_warp] : list of np.arrays
+        '''
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        coords = np.stack([x.ravel(), y.ravel()], axis=1)
+        warped = self._affine(coords[:, 0], coords[:, 1])
+        for start in range(0, len(coords), chunk_size):
+            chunk = coords[start:start+chunk_size]
+            pairs = cKDTree(chunk).sparse_distance_matrix(self.tree, self.support, output_type='coo_matrix')
+            kernel = wendland(pairs.data, self.support)
+            for dim in range(2):
+                warped[dim][start:start+chunk_size] += np.bincount(pairs.row,
+                                                                   weights=kernel * self.coeffs[pairs.col, dim],
+                                                                   minlength=len(chunk))
+        return [warped[0].reshape(x.shape), warped[1].reshape(x.shape)]
+
+    def evaluate_grid(self, x, y):
+        '''
+        Fast path of evaluate() for coordinate grids as produced by numpy.mgrid
+        (x constant along axis 1, y constant along axis 0):
+        every landmark only adds its kernel to the pixels within its support.
+        '''
+        x_axis, y_axis = x[:, 0], y[0, :]
+        x_warp, y_warp = self._affine(x, y)
+        for point, (w_x, w_y) in zip(self.from_points, self.coeffs[:-3]):
+            x0, x1 = np.searchsorted(x_axis, [point[0] - self.support, point[0] + self.support])
+            y0, y1 = np.searchsorted(y_axis, [point[1] - self.support, point[1] + self.support])
+            if (x1 <= x0) or (y1 <= y0):
+                continue
+            r = np.sqrt((x_axis[x0:x1, np.newaxis] - point[0])**2 + (y_axis[np.newaxis, y0:y1] - point[1])**2)
+            kernel = wendland(r, self.support)
+            x_warp[x0:x1, y0:y1] += w_x * kernel
+            y_warp[x0:x1, y0:y1] += w_y * kernel
+        return [x_warp, y_warp]
+
+    def _affine(self, x, y):
+        a1, ax, ay = self.coeffs[-3:, 0]
+        b1, bx, by = self.coeffs[-3:, 1]
+        return [a1 + ax*x + ay*y, b1 + bx*x + by*y]
+
+
+def make_wendland_warp(from_points, to_points, x_vals, y_vals):
+    '''
+    Compactly supported RBF counterpart of _make_warp() in _unwarp.py
+    '''
+    return CompactRBF(from_points, to_points).evaluate_grid(x_vals, y_vals)
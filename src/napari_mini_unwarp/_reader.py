@@ -1,7 +1,6 @@
 """
 
 """
-from collections import OrderedDict
 from pathlib import Path
 import numpy as np
 from datetime import datetime
@@ -11,6 +10,11 @@ from tifffile import imread
 import scanreader
 from scanreader.exceptions import ScanImageVersionError
 
+from ._manifest import load_manifest, read_header, scanimage_stack
+from ._scanimage import project_planes
+from ._chunked import (ZARR_SUFFIXES, HDF5_SUFFIXES, ZARR_AVAILABLE, H5PY_AVAILABLE, 
+                       open_ome_zarr, open_hdf5, project_time)
+from ._session import Session, is_session
 
 
 # Some naming ... 
@@ -20,8 +24,8 @@ GRID_IMAGE_LAYER = 'Grid image(s)'
 def napari_get_reader(path):
     """
     Decide which file type / reader function you are dealing with. 
-    Here, because we are only dealing with single Tif files, the path is 
-    just checked for suffix .tif 
+    The path is checked for suffix (.tif, .pkl, chunked .zarr / .h5 / .hdf5) 
+    or for a folder of .tif files or a session folder (see _session.py)
 
     Parameters
     ----------
@@ -37,8 +41,24 @@ def napari_get_reader(path):
     """
     path = Path(path)
 
+    # Chunked formats (OME-Zarr stores are folders, too)
+    if path.exists() and (path.suffix in ZARR_SUFFIXES + HDF5_SUFFIXES):
+        if (path.suffix in ZARR_SUFFIXES) and not ZARR_AVAILABLE:
+            print('Reading OME-Zarr requires zarr (pip install zarr)')
+            return None
+        if (path.suffix in HDF5_SUFFIXES) and not H5PY_AVAILABLE:
+            print('Reading HDF5 requires h5py (pip install h5py)')
+            return None
+        print(f'Reading {path.as_posix()}')
+        return chunked_reader
+
+    if path.is_dir() and is_session(path):
+        print(f'Resuming session {path.as_posix()}')
+        return session_reader
+
     if path.is_dir():
-        available_tifs = list(path.glob(r'*.tif'))
+        # Stop at the first .tif - the folder is listed (once) by tif_reader()
+        available_tifs = next(path.glob(r'*.tif'), None) is not None
         if available_tifs: 
             print(f'Reading {path.as_posix()}')
             return tif_reader
@@ -81,6 +101,89 @@ def pkl_raw_reader(path):
     return [(data, add_kwargs, layer_type)]
 
 
+def session_reader(path):
+    '''
+    Reopen the layers of a checkpointed session (see _session.py).
+
+    Arrays are memory mapped and layer settings come from the session, 
+    so nothing is recomputed or re-read from the raw data. 
+    The session path is passed on in the grid image metadata ('session'), 
+    the widget restores the remaining state (parameters, point propagation) from there.
+
+    '''
+    path = Path(path)
+    parameters, arrays = Session(path).load()
+    layers = []
+    for array_name, layer in parameters.get('layers', {}).items():
+        if array_name not in arrays:
+            continue
+        add_kwargs = dict(layer['add_kwargs'])
+        if add_kwargs['name'] == GRID_IMAGE_LAYER:
+            add_kwargs['metadata'] = {**add_kwargs.get('metadata', {}), 'session': path.as_posix()}
+        # Images stay memory mapped, points are edited in place and need to be writable
+        data = arrays[array_name] if layer['layer_type'] == 'image' else np.array(arrays[array_name])
+        layers.append((data, add_kwargs, layer['layer_type']))
+    if not layers:
+        print(f'Session {path.as_posix()} is empty')
+        return None
+    print(f'Restored {len(layers)} layers from session {path.name}')
+    return layers
+
+
+def chunked_reader(path):
+    '''
+    Load grid images from OME-Zarr or HDF5 (see _chunked.py).
+
+    Arrays are opened lazily, and recordings with a time axis are 
+    averaged over time block by block (in parallel), so the recording is 
+    never loaded as a whole. Only one channel (the first) is used.
+    Stacks (z axis) become a multi plane grid image.
+
+    The layer itself stays in pixel units (the widget works in pixels), 
+    the pixel size (and other metadata) is passed on in the layer metadata.
+
+    '''
+    path = Path(path)
+    if path.suffix in ZARR_SUFFIXES:
+        array, axes, scale, source_metadata = open_ome_zarr(path)
+    else:
+        array, axes, scale, source_metadata = open_hdf5(path)
+    print(f'{path.name}: {dict(zip(axes, array.shape))}')
+    try:
+        data, data_axes = project_time(array, axes)
+    finally:
+        if hasattr(array, 'file'):
+            # h5py
+            array.file.close()
+    if 't' in axes:
+        print(f'Created average projection over {array.shape[axes.index("t")]} frames')
+    if not set(data_axes) <= {'z', 'y', 'x'}:
+        raise NotImplementedError(f'Axes {data_axes} not supported')
+
+    pixel_size = dict(zip(axes, scale))
+    metadata = {
+        'source'     : path.as_posix(),
+        'axes'       : data_axes,
+        'pixel_size' : [pixel_size[axis] for axis in data_axes],
+        'units'      : source_metadata.get('units', {}),
+    }
+    attributes = source_metadata.get('attributes', {})
+    for key in ['zoom', 'z_height']:
+        if key in attributes:
+            metadata[key] = str(attributes[key])
+    if 'z' in data_axes:
+        z_start = source_metadata.get('translation', {}).get('z', 0.)
+        metadata['plane_depths'] = (z_start + np.arange(data.shape[0]) * pixel_size['z']).tolist()
+        metadata.setdefault('z_height', 'read from file')
+
+    add_kwargs = {'rgb': False, 'name' : GRID_IMAGE_LAYER, 'metadata': metadata}
+    if data.ndim == 3:
+        # Make sure the scale is [1,1,1], otherwise everything goes haywire ...
+        add_kwargs['scale'] = [1, 1, 1]
+    layer_type = "image"
+    return [(data, add_kwargs, layer_type)]
+
+
 def tif_reader(path):
 
     '''
@@ -103,46 +206,13 @@ def tif_reader(path):
     path = Path(path)
 
     if path.is_dir():
-        tif_dict = {}
-        
-        # Check whether the zoom, width, height property is the same for all files, while reading them in.
-        # A similar check is performed for imaging depth (which should yield unique numbers)
-        # ... add more if you can think of more ... 
-        zooms = []
-        widths = []
-        heights = []
-        
-        for tif_file in path.glob(r'*.tif'):
-            # Extract z position solely from file name 
-            # z_height = re.search(r'(?P<position>\d+)um', str(tif_file))
-            # tif_dict[float(z_height.group('position'))] = tif_file
-
-            # Read file with scanreader (https://github.com/kavli-ntnu/scanreader)
-            # for basic checks
-            try: 
-                scan = scanreader.read_scan(tif_file.as_posix())
-            except ScanImageVersionError:
-                raise NotImplementedError('Not a ScanImage .tif file')
-            if scan.num_scanning_depths > 1: 
-                raise NotImplementedError(f'>1 imaging plane detected in {tif_file.as_posix()}')
-
-
-
-            z_height = scan.scanning_depths_relative[0]
-            print(f'{tif_file.name:<30} ScanImage .tif with {scan.num_frames} frames, zoom {scan.zoom}, depth {z_height}')
-            tif_dict[z_height] = tif_file.as_posix()
-            zooms.append(scan.zoom)
-            widths.append(scan.image_width)
-            heights.append(scan.image_height)
-            
-        # Create sorted dictionary from collected files
-        sorted_zpos = OrderedDict(sorted(tif_dict.items()))
+        # Header information (depth, zoom, width, height) of all files comes from the 
+        # folder manifest (see _manifest.py): only new or changed files are read, and only their 
+        # ScanImage header. Sorting and checks (unique depths, same zoom / width / height) 
+        # run from the manifest alone. 
+        entries = load_manifest(path)
+        sorted_zpos, zoom = scanimage_stack(path, entries)
         print(f'Found {len(sorted_zpos)} matching tif files across z positions [microns]:\n{list(sorted_zpos.keys())}')
-        # Perform checks 
-        assert len(np.unique(list(sorted_zpos.keys()))) == len(sorted_zpos.keys()), 'There seem to be duplicates in z position data'
-        assert len(np.unique(zooms)) == 1, f'There seems to be more than one zoom level across tifs {np.unique(zooms)}'
-        assert len(np.unique(widths)) == 1, f'Tif stacks seem to vary in width {np.unique(widths)}'
-        assert len(np.unique(heights)) == 1, f'Tif stacks seem to vary in height {np.unique(heights)}'
                 
         # else:
         #     # Only if the naming convention is taken as basis for file info extraction
@@ -152,17 +222,26 @@ def tif_reader(path):
 
         # Create layer
         stacked_avg = []
+        multiplane_projections = {}
 
-        for no, tif_path in enumerate(sorted_zpos.values()):
+        for no, (z_height, tif_path) in enumerate(sorted_zpos.items()):
             print(f'Reading ({no+1:<2}/{len(sorted_zpos):<2}) | {tif_path}')
-            scan = scanreader.read_scan(tif_path)
-            average_proj = np.mean(scan, axis=-1).squeeze()
+            entry = entries[Path(tif_path).name]
+            if len(entry['depths']) > 1:
+                # Multi-plane file: all depths are de-interleaved in one pass (see _scanimage.py)
+                if tif_path not in multiplane_projections:
+                    multiplane_projections[tif_path] = project_planes(tif_path, entry)
+                average_proj = multiplane_projections[tif_path][entry['depths'].index(z_height)]
+            else:
+                scan = scanreader.read_scan(tif_path)
+                average_proj = np.mean(scan, axis=-1).squeeze()
             stacked_avg.append(average_proj)
 
         data = np.stack(stacked_avg)
             
         # Make sure the scale is [1,1,1], otherwise everything goes haywire ...
-        metadata = {**sorted_zpos, **{'zoom': str(np.float(np.unique(zooms))), 'z_height' : 'read from file'}}
+        metadata = {**sorted_zpos, **{'zoom': str(float(zoom)), 'z_height' : 'read from file', 
+                                      'plane_depths': list(sorted_zpos.keys())}}
         add_kwargs = {'rgb': False, 'name' : GRID_IMAGE_LAYER, 'metadata': metadata, 'scale': [1, 1, 1]}
         layer_type = "image"  # optional, default is "image"
         
@@ -183,6 +262,15 @@ def tif_reader(path):
     elif path.is_file():
         tif_file = path
 
+        entry = read_header(tif_file)
+        if entry['scanimage'] and (len(entry['depths']) > 1):
+            # Multi-plane ScanImage file: one grid image per depth (see _scanimage.py)
+            print(f'ScanImage .tif with {len(entry["depths"])} imaging depths {entry["depths"]}')
+            data = project_planes(tif_file, entry)
+            metadata = {'zoom': str(entry['zoom']), 'z_height': 'read from file', 'plane_depths': entry['depths']}
+            add_kwargs = {'rgb': False, 'name' : GRID_IMAGE_LAYER, 'metadata': metadata, 'scale': [1, 1, 1]}
+            return [(data, add_kwargs, 'image')]
+
         try: 
             scan = scanreader.read_scan(tif_file.as_posix())
             z_height = scan.scanning_depths_relative[0]
@@ -0,0 +1,337 @@
+### CALIBRATION REGISTRY
+# Local store of unwarping calibrations, keyed by the fields collected in the widget
+# (system, scope, objective, zoom and t-lens / z height).
+#
+# - One SQLite file (standard library, no server). Landmarks, standard grid, TPS coefficients
+#   (TPS calibrations only) and (optionally) the precomputed inverse maps are stored as .npy blobs.
+# - Lookups go through a B-tree index on (system, scope, objective, tlens, zoom):
+#   the nearest t-lens and zoom levels are found with bounded range queries
+#   (ORDER BY ... LIMIT 1 on either side), i.e. in O(log n), and nothing is refitted.
+# - For zoom levels between calibrations, the neighbouring calibrations are rescaled
+#   to the requested zoom and blended (see Calibration.rescaled()).
+#   Zoom scales the scan field, so distances in pixels scale with zoom around the image center.
+#   Rescaled calibrations evaluate their inverse map on first use and keep it (see Calibration.unwarp()).
+#
+import io
+import json
+import sqlite3
+from pathlib import Path
+import numpy as np
+
+from ._unwarp import _make_coeffs, _make_inverse_warp, apply_transform, warp_images
+
+REGISTRY_PATH = Path.home() / '.napari_mini_unwarp' / 'calibrations.sqlite'
+
+_KEYS = ('system', 'scope', 'objective', 'zoom', 'tlens')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calibrations (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    system      TEXT NOT NULL,
+    scope       TEXT NOT NULL,
+    objective   TEXT NOT NULL,
+    zoom        REAL NOT NULL,
+    tlens       REAL NOT NULL,
+    method      TEXT NOT NULL,
+    rows        INTEGER NOT NULL,
+    cols        INTEGER NOT NULL,
+    created     TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    metadata    TEXT,
+    usr_dots    BLOB NOT NULL,
+    grid_dots   BLOB NOT NULL,
+    coeffs      BLOB,
+    inverse_map BLOB
+);
+CREATE INDEX IF NOT EXISTS calibrations_lookup
+    ON calibrations (system, scope, objective, tlens, zoom);
+'''
+
+
+def _to_blob(array):
+    if array is None:
+        return None
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _from_blob(blob):
+    if blob is None:
+        return None
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+class Calibration:
+    '''
+    Stored calibration: user defined (usr_dots) and standard grid points (grid_dots)
+    of one grid image (points x 2) or a stack (planes x points x 2)
+    '''
+
+    def __init__(self, system, scope, objective, zoom, tlens, usr_dots, grid_dots, image_shape,
+                 method='tps', coeffs=None, inverse_map=None, metadata=None, id=None):
+        self.id = id
+        self.system, self.scope, self.objective = system, scope, objective
+        self.zoom, self.tlens = float(zoom), float(tlens)
+        self.usr_dots = np.asarray(usr_dots, dtype=float)
+        self.grid_dots = np.asarray(grid_dots, dtype=float)
+        self.image_shape = tuple(int(s) for s in image_shape)
+        self.method = method
+        self.coeffs = coeffs
+        self.inverse_map = inverse_map
+        self.metadata = {} if metadata is None else metadata
+        self._maps = {} # plane_idx -> inverse map evaluated in unwarp() (if none is stored)
+
+    def __repr__(self):
+        return (f'Calibration(id={self.id}, system={self.system!r}, scope={self.scope!r}, '
+                f'objective={self.objective!r}, zoom={self.zoom}, tlens={self.tlens}, method={self.method!r})')
+
+    @property
+    def num_planes(self):
+        return 1 if self.usr_dots.ndim == 2 else len(self.usr_dots)
+
+    def rescaled(self, zoom):
+        '''
+        Calibration rescaled to another `zoom` level:
+        all points are scaled by zoom / self.zoom around the image center.
+        Stored coefficients and maps do not apply anymore and are dropped
+        (the map is evaluated again on first use, see unwarp()).
+        '''
+        factor = zoom / self.zoom
+        center = (np.array(self.image_shape, dtype=float) - 1) / 2
+        return Calibration(self.system, self.scope, self.objective, zoom, self.tlens,
+                           center + (self.usr_dots - center) * factor,
+                           center + (self.grid_dots - center) * factor,
+                           self.image_shape, method=self.method, metadata=dict(self.metadata),
+                           id=self.id)
+
+    def plane(self, plane_idx):
+        ''' usr_dots and grid_dots of plane `plane_idx` (stacks) '''
+        if self.usr_dots.ndim == 2:
+            return self.usr_dots, self.grid_dots
+        return self.usr_dots[plane_idx], self.grid_dots
+
+    def evaluate_map(self, plane_idx=0):
+        '''
+        Full resolution inverse map of plane `plane_idx`: 2 x rows x cols (float32)
+        source coordinates of every output pixel (see _make_inverse_warp())
+        '''
+        usr_dots, grid_dots = self.plane(plane_idx)
+        output_region = [0, 0, self.image_shape[0], self.image_shape[1]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            transform = _make_inverse_warp(usr_dots, grid_dots, output_region, 1, self.method)
+        return np.stack(transform).astype(np.float32)
+
+    def unwarp(self, image, plane_idx=0, **kwargs):
+        '''
+        Unwarp a 2D `image` with this calibration.
+        Uses the stored inverse map if there is one and it fits the image.
+        Otherwise the map is evaluated once and kept for further calls, 
+        unless tiles (tile_size) are requested to bound memory.
+        The same options apply either way (interpolation_order, precision, 
+        output_dtype, out and label_channels apply to both).
+
+        Parameters
+        ----------
+        image : np.array : 2D image
+        plane_idx : int : plane of the calibration to use (stacks)
+        **kwargs : passed on to warp_images()
+
+        Returns
+        -------
+        unwarped : np.array
+        '''
+        output_region = [0, 0, image.shape[0], image.shape[1]]
+        transform = None
+        if ((self.method == kwargs.get('method', self.method)) and (image.shape == self.image_shape)
+                and kwargs.get('tile_size') is None and kwargs.get('approximate_grid', 1) == 1):
+            if self.inverse_map is not None:
+                transform = self.inverse_map if self.inverse_map.ndim == 3 else self.inverse_map[plane_idx]
+            else:
+                if plane_idx not in self._maps:
+                    self._maps[plane_idx] = self.evaluate_map(plane_idx)
+                transform = self._maps[plane_idx]
+        if transform is not None:
+            label_channels = kwargs.get('label_channels')
+            order = kwargs.get('interpolation_order', 1)
+            if (label_channels is not None) and (0 in np.atleast_1d(label_channels)):
+                order = 0
+            out = kwargs.get('out')
+            return apply_transform(image, transform, order, kwargs.get('precision', 'float64'),
+                                   output_dtype=kwargs.get('output_dtype'), 
+                                   out=None if out is None else out[0])
+        usr_dots, grid_dots = self.plane(plane_idx)
+        kwargs.setdefault('method', self.method)
+        kwargs.setdefault('approximate_grid', 1)
+        return warp_images(usr_dots, grid_dots, [image], output_region, **kwargs)[0]
+
+
+class CalibrationRegistry:
+    '''
+    SQLite backed store of calibrations
+
+    Parameters
+    ----------
+    path : str or Path : database file (created if it does not exist). Default: REGISTRY_PATH
+    '''
+
+    def __init__(self, path=None):
+        self.path = Path(REGISTRY_PATH if path is None else path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path))
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM calibrations').fetchone()[0]
+
+    def add(self, calibration, store_map=False):
+        '''
+        Store a calibration. For TPS calibrations, the coefficients (of the inverse transform) 
+        are fitted once and stored alongside the points. Other methods only store their maps.
+
+        Parameters
+        ----------
+        calibration : Calibration
+        store_map : bool : also store the full resolution inverse map(s) as float32
+                           (2 x rows x cols per plane) for lookups without any evaluation
+
+        Returns
+        -------
+        id : int : row id of the stored calibration
+        '''
+        num_planes = calibration.num_planes
+        usr_dots = calibration.usr_dots.reshape(num_planes, -1, 2)
+        coeffs, inverse_map = None, None
+        if calibration.method == 'tps':
+            err = np.seterr(divide='ignore', invalid='ignore')
+            coeffs = np.stack([_make_coeffs(calibration.grid_dots, dots) for dots in usr_dots])
+            np.seterr(**err)
+        if store_map:
+            inverse_map = np.stack([calibration.evaluate_map(plane_idx) for plane_idx in range(num_planes)])
+        if calibration.usr_dots.ndim == 2:
+            coeffs = None if coeffs is None else coeffs[0]
+            inverse_map = None if inverse_map is None else inverse_map[0]
+
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO calibrations (system, scope, objective, zoom, tlens, method, rows, cols, '
+                'metadata, usr_dots, grid_dots, coeffs, inverse_map) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (calibration.system, calibration.scope, calibration.objective, calibration.zoom,
+                 calibration.tlens, calibration.method, calibration.image_shape[0], calibration.image_shape[1],
+                 json.dumps(calibration.metadata), _to_blob(calibration.usr_dots), _to_blob(calibration.grid_dots),
+                 _to_blob(coeffs), _to_blob(inverse_map)))
+        calibration.id = cursor.lastrowid
+        calibration.coeffs, calibration.inverse_map = coeffs, inverse_map
+        return calibration.id
+
+    def _from_row(self, row):
+        return Calibration(row['system'], row['scope'], row['objective'], row['zoom'], row['tlens'],
+                           _from_blob(row['usr_dots']), _from_blob(row['grid_dots']),
+                           (row['rows'], row['cols']), method=row['method'],
+                           coeffs=_from_blob(row['coeffs']), inverse_map=_from_blob(row['inverse_map']),
+                           metadata=json.loads(row['metadata']) if row['metadata'] else {},
+                           id=row['id'])
+
+    def get(self, id):
+        ''' Calibration with row id `id` '''
+        row = self._connection.execute('SELECT * FROM calibrations WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError(f'No calibration with id {id}')
+        return self._from_row(row)
+
+    def remove(self, id):
+        with self._connection:
+            self._connection.execute('DELETE FROM calibrations WHERE id = ?', (id,))
+
+    def entries(self, **keys):
+        '''
+        Summary (no arrays) of all calibrations, optionally filtered by any of
+        system, scope, objective, zoom, tlens
+        '''
+        unknown = set(keys) - set(_KEYS)
+        if unknown:
+            raise ValueError(f'Unknown keys {sorted(unknown)}. Choose from {list(_KEYS)}')
+        where = ' AND '.join(f'{key} = ?' for key in keys) or '1'
+        rows = self._connection.execute(
+            f'SELECT id, {", ".join(_KEYS)}, method, created FROM calibrations WHERE {where} '
+            'ORDER BY system, scope, objective, tlens, zoom', tuple(keys.values()))
+        return [dict(row) for row in rows]
+
+    def _nearest(self, column, value, where, params):
+        ''' Closest value of `column` on either side of `value` (two indexed range queries) '''
+        below = self._connection.execute(
+            f'SELECT {column} FROM calibrations WHERE {where} AND {column} <= ? ORDER BY {column} DESC LIMIT 1',
+            params + (value,)).fetchone()
+        above = self._connection.execute(
+            f'SELECT {column} FROM calibrations WHERE {where} AND {column} >= ? ORDER BY {column} ASC LIMIT 1',
+            params + (value,)).fetchone()
+        return (None if below is None else below[0]), (None if above is None else above[0])
+
+    def _latest(self, where, params):
+        row = self._connection.execute(
+            f'SELECT * FROM calibrations WHERE {where} ORDER BY id DESC LIMIT 1', params).fetchone()
+        return self._from_row(row)
+
+    def lookup(self, system, scope, objective, zoom, tlens=None, interpolate=True):
+        '''
+        Nearest matching calibration.
+        System, scope and objective have to match. Of those, the calibration(s) at the
+        t-lens setting closest to `tlens` (if given) are used, and within these the
+        zoom level closest to `zoom`. The most recent calibration wins for identical keys.
+
+        Parameters
+        ----------
+        system, scope, objective : str
+        zoom : float : zoom level of the recording
+        tlens : float : t-lens / z height of the recording (optional)
+        interpolate : bool : if `zoom` lies between two calibrated zoom levels,
+                             rescale both to `zoom` and blend them linearly.
+                             Otherwise (or if they are not compatible) the nearest one
+                             is rescaled to `zoom`
+
+        Returns
+        -------
+        calibration : Calibration or None : None if there is no calibration for system / scope / objective
+        '''
+        where, params = 'system = ? AND scope = ? AND objective = ?', (system, scope, objective)
+        if tlens is None:
+            exists = self._connection.execute(f'SELECT 1 FROM calibrations WHERE {where} LIMIT 1', params).fetchone()
+            if exists is None:
+                return None
+            # Nearest zoom across all t-lens settings
+            tlens_where, tlens_params = where, params
+        else:
+            below, above = self._nearest('tlens', float(tlens), where, params)
+            if below is None and above is None:
+                return None
+            candidates = [t for t in (below, above) if t is not None]
+            tlens_match = min(candidates, key=lambda t: abs(t - tlens))
+            tlens_where, tlens_params = where + ' AND tlens = ?', params + (tlens_match,)
+
+        zoom = float(zoom)
+        below, above = self._nearest('zoom', zoom, tlens_where, tlens_params)
+        if below == zoom or above == zoom or below is None or above is None or not interpolate:
+            zoom_match = min([z for z in (below, above) if z is not None], key=lambda z: abs(z - zoom))
+            calibration = self._latest(tlens_where + ' AND zoom = ?', tlens_params + (zoom_match,))
+            return calibration if zoom_match == zoom else calibration.rescaled(zoom)
+
+        lower = self._latest(tlens_where + ' AND zoom = ?', tlens_params + (below,)).rescaled(zoom)
+        upper = self._latest(tlens_where + ' AND zoom = ?', tlens_params + (above,)).rescaled(zoom)
+        weight = (zoom - below) / (above - below)
+        if (lower.usr_dots.shape != upper.usr_dots.shape) or (lower.image_shape != upper.image_shape):
+            return lower if weight < .5 else upper
+        blended = lower
+        blended.usr_dots = (1 - weight) * lower.usr_dots + weight * upper.usr_dots
+        blended.grid_dots = (1 - weight) * lower.grid_dots + weight * upper.grid_dots
+        blended.id = None
+        blended.metadata = {'interpolated_from': [lower.id, upper.id]}
+        return blended
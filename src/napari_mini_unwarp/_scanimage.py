@@ -0,0 +1,75 @@
+### MULTI-PLANE SCANIMAGE FILES
+# Volumetric recordings (fast z with piezo / ETL, or slow stacks) store the frames of all
+# imaging depths interleaved in one file:
+#   - every frame is saved once per channel (channel changes fastest)
+#   - fast z: volumes of `len(depths)` frames, each followed by `flyback_frames` discarded frames
+#   - slow stacks: `frames_per_slice` consecutive frames per depth, repeated for every volume
+# project_planes() walks through the pages once, routes every page to its depth and adds it
+# to a running sum for that depth, so all per-depth projections are built side by side
+# in a single pass. Pages are not cached, so memory only depends on the number of
+# depths and the frame size - not on the recording length.
+# The layout comes from the ScanImage header (see read_header() in _manifest.py).
+#
+import numpy as np
+from tifffile import TiffFile
+
+
+def page_planes(num_pages, entry, channel=0):
+    '''
+    Depth (plane) index of every page of a ScanImage file
+
+    Parameters
+    ----------
+    num_pages : int : number of pages (frames x channels)
+    entry : dict : header fields, see read_header() in _manifest.py
+    channel : int : index of the saved channel to use
+
+    Returns
+    -------
+    planes : np.array : plane index per page, -1 for pages of other channels and flyback frames
+    '''
+    num_depths = len(entry['depths'])
+    num_channels = entry.get('num_channels', 1)
+    if not 0 <= channel < num_channels:
+        raise ValueError(f'Channel {channel} not available ({num_channels} saved channels)')
+    pages = np.arange(num_pages)
+    frames = pages // num_channels
+    if entry.get('fast_z', True):
+        slots = frames % (num_depths + entry.get('flyback_frames', 0))
+    else:
+        slots = (frames // entry.get('frames_per_slice', 1)) % num_depths
+    planes = np.where(slots < num_depths, slots, -1)
+    planes[pages % num_channels != channel] = -1
+    return planes
+
+
+def project_planes(tif_path, entry, channel=0):
+    '''
+    Average projection of every imaging depth of a (multi-plane) ScanImage file,
+    in one streaming pass over the file
+
+    Parameters
+    ----------
+    tif_path : str or Path : ScanImage .tif file
+    entry : dict : header fields, see read_header() in _manifest.py
+    channel : int : index of the saved channel to project
+
+    Returns
+    -------
+    projections : np.array : depths x height x width average projections
+                             (in the order of entry['depths'])
+    '''
+    with TiffFile(tif_path) as tif:
+        tif.pages.cache = False
+        num_pages = len(tif.pages)
+        planes = page_planes(num_pages, entry, channel=channel)
+        first = tif.pages.first
+        sums = np.zeros((len(entry['depths']),) + first.shape, dtype=float)
+        counts = np.zeros(len(entry['depths']), dtype=int)
+        for page_idx in np.flatnonzero(planes >= 0):
+            plane = planes[page_idx]
+            sums[plane] += tif.pages[int(page_idx)].asarray()
+            counts[plane] += 1
+    if not counts.all():
+        raise ValueError(f'No frames found for depth(s) {np.asarray(entry["depths"])[counts == 0]} in {tif_path}')
+    return sums / counts[:, np.newaxis, np.newaxis]
@@ -0,0 +1,200 @@
+### SESSION CHECKPOINTS
+# Calibration work (point edits, propagation, unwarping) is checkpointed to a session
+# folder while working, so that it can be resumed after napari was closed.
+#
+# - Every array (grid image projection, grid points, propagation state, unwarped image, ...)
+#   is one .npy file, parameters and layer settings are in SESSION_FILE (JSON).
+# - Saving is incremental: arrays whose content did not change since the last save
+#   (compared through a digest) are not written again. Files are replaced atomically.
+# - save_async() hands snapshots to a single background thread. Snapshots that arrive
+#   while a save is running are merged, so only the latest state is written.
+# - Loading memory maps the arrays: nothing is recomputed or re-read from the raw data.
+#   Session folders are opened through the reader (see session_reader() in _reader.py).
+#   Digests of loaded arrays are computed on the first save after loading (in the background),
+#   so unchanged arrays - still memory mapped as layer data - are not written again.
+# - Transforms (TPS coefficients, coordinate maps) are not saved: the unwarped image is, and 
+#   the coefficients follow from the saved points within milliseconds (see _make_coeffs() in _unwarp.py).
+# - New sessions are created under SESSION_ROOT (environment variable SESSION_ROOT_ENV overrides it).
+#   Only the MAX_SESSIONS most recently saved sessions are kept there (see prune_sessions()).
+#
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+SESSION_ROOT_ENV = 'NAPARI_MINI_UNWARP_SESSIONS'
+SESSION_ROOT = Path(os.environ.get(SESSION_ROOT_ENV, Path.home() / '.napari_mini_unwarp' / 'sessions'))
+SESSION_FILE = 'session.json'
+MAX_SESSIONS = 10 # Sessions kept under SESSION_ROOT, older ones are deleted when a new one is started
+
+
+def is_session(path):
+    ''' True if `path` is a session folder '''
+    return (Path(path) / SESSION_FILE).is_file()
+
+
+def prune_sessions(root=None, keep=MAX_SESSIONS):
+    '''
+    Delete all but the `keep` most recently saved sessions under `root` (default: SESSION_ROOT).
+    Only session folders (see is_session()) are touched.
+
+    Returns
+    -------
+    removed : list : paths of the deleted sessions
+    '''
+    root = Path(SESSION_ROOT if root is None else root)
+    if not root.is_dir():
+        return []
+    sessions = [path for path in root.iterdir() if path.is_dir() and is_session(path)]
+    sessions.sort(key=lambda path: (path / SESSION_FILE).stat().st_mtime, reverse=True)
+    for path in sessions[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+    return sessions[keep:]
+
+
+def _digest(array):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    digest.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+    return digest.hexdigest()
+
+
+class Session:
+    '''
+    Session folder with incremental (background) checkpoints
+
+    Parameters
+    ----------
+    path : str or Path : session folder (created if it does not exist)
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.parameters = {}
+        if is_session(self.path):
+            with open(self.path / SESSION_FILE, 'r') as session_file:
+                self.parameters = json.load(session_file)
+        self._digests = {}
+        self._loaded = {} # name -> array from load(), whose digest is not computed yet
+        self._lock = threading.Lock()
+        self._pending_arrays = {}
+        self._pending_parameters = {}
+        self._scheduled = False
+        self._executor = None
+
+    @classmethod
+    def new(cls, root=None, keep=MAX_SESSIONS):
+        '''
+        New session in a time stamped folder under `root` (default: SESSION_ROOT).
+        Older sessions are pruned, so that at most `keep` remain (including the new one).
+        '''
+        root = Path(SESSION_ROOT if root is None else root)
+        removed = prune_sessions(root, keep=max(keep - 1, 0))
+        if removed:
+            print(f'Deleted {len(removed)} old session(s) from {root.as_posix()}')
+        return cls(root / datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+
+    def _write(self, target, write):
+        temp = target.with_name(target.name + '.tmp')
+        with open(temp, 'wb') as temp_file:
+            write(temp_file)
+        os.replace(temp, target)
+
+    def save(self, arrays=None, parameters=None):
+        '''
+        Save (changed) arrays and update parameters
+
+        Parameters
+        ----------
+        arrays : dict : name -> np.array. None removes the array from the session
+        parameters : dict : JSON serializable parameters, merged into the saved ones
+
+        Returns
+        -------
+        written : list : names of the arrays that were written
+        '''
+        written = []
+        for name, array in (arrays or {}).items():
+            target = self.path / f'{name}.npy'
+            if array is None:
+                if target.exists():
+                    target.unlink()
+                self._digests.pop(name, None)
+                self._loaded.pop(name, None)
+                continue
+            array = np.asarray(array)
+            digest = _digest(array)
+            if name in self._loaded:
+                self._digests[name] = _digest(self._loaded.pop(name))
+            if (self._digests.get(name) == digest) and target.exists():
+                continue
+            self._write(target, lambda f: np.save(f, array, allow_pickle=False))
+            self._digests[name] = digest
+            written.append(name)
+        if parameters or not is_session(self.path):
+            self.parameters.update(parameters or {})
+            content = json.dumps(self.parameters, indent=1, default=str).encode()
+            self._write(self.path / SESSION_FILE, lambda f: f.write(content))
+        return written
+
+    def save_async(self, arrays=None, parameters=None):
+        '''
+        Save in the background (see save()). Arrays are copied, so they can be changed right away.
+        '''
+        arrays = {name: None if array is None else np.array(array, copy=True)
+                  for name, array in (arrays or {}).items()}
+        with self._lock:
+            self._pending_arrays.update(arrays)
+            self._pending_parameters.update(parameters or {})
+            if self._scheduled:
+                return
+            self._scheduled = True
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not (self._pending_arrays or self._pending_parameters):
+                    self._scheduled = False
+                    return
+                arrays, self._pending_arrays = self._pending_arrays, {}
+                parameters, self._pending_parameters = self._pending_parameters, {}
+            try:
+                self.save(arrays, parameters)
+            except Exception as error:
+                print(f'Checkpoint failed ({error})')
+
+    def flush(self):
+        ''' Wait until all background saves are written '''
+        if self._executor is not None:
+            self._executor.submit(lambda: None).result()
+            while self._scheduled:
+                self._executor.submit(lambda: None).result()
+
+    def load(self, mmap=True):
+        '''
+        Load the session
+
+        Parameters
+        ----------
+        mmap : bool : memory map arrays (read only) instead of reading them
+
+        Returns
+        -------
+        parameters : dict
+        arrays : dict : name -> np.array
+        '''
+        arrays = {}
+        for array_file in sorted(self.path.glob('*.npy')):
+            arrays[array_file.stem] = np.load(array_file, mmap_mode='r' if mmap else None, allow_pickle=False)
+            if array_file.stem not in self._digests:
+                self._loaded[array_file.stem] = arrays[array_file.stem]
+        return dict(self.parameters), arrays
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def landmark_grid():
+    '''
+    Factory of regular square landmark grids (num**2 x 2 points between `start` and `stop`),
+    optionally jittered by gaussian noise with standard deviation `jitter` (as if clicked)
+    '''
+    def make_grid(num=5, start=10., stop=118., jitter=0., seed=0):
+        row_pos, col_pos = np.meshgrid(np.linspace(start, stop, num), np.linspace(start, stop, num), indexing='ij')
+        grid = np.stack([row_pos.ravel(), col_pos.ravel()], axis=1)
+        if jitter:
+            grid = grid + np.random.default_rng(seed).normal(0, jitter, grid.shape)
+        return grid
+    return make_grid
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+pytest.importorskip('dask')
+zarr = pytest.importorskip('zarr')
+
+from napari_mini_unwarp._batch import DISTRIBUTED_AVAILABLE, batch_unwarp, calibration_map, recording_info
+from napari_mini_unwarp._helpers import generate_perfect_grid
+from napari_mini_unwarp._registry import Calibration
+from napari_mini_unwarp._unwarp import apply_transform
+
+
+def _calibration(shape=(48, 64)):
+    grid_dots = generate_perfect_grid(np.zeros(shape), 4, 4, .15)
+    usr_dots = grid_dots + np.random.default_rng(0).normal(0, 1., grid_dots.shape)
+    return Calibration('Emerald', 'Enormous', 'D0213', 1., 0., usr_dots, grid_dots, shape)
+
+
+def test_batch_unwarp(tmp_path):
+    calibration = _calibration()
+    transform = calibration_map(calibration)
+    assert transform.shape == (2, 48, 64) and transform.dtype == np.float32
+
+    rng = np.random.default_rng(1)
+    recordings = {'a': rng.integers(0, 4000, (10, 48, 64)).astype(np.uint16),
+                  'b': rng.random((5, 48, 64)).astype(np.float32)}
+    paths = []
+    for name, frames in recordings.items():
+        imwrite(tmp_path / f'{name}.tif', frames)
+        paths.append(tmp_path / f'{name}.tif')
+    assert recording_info(paths[0]) == (10, (48, 64), np.uint16)
+
+    client = None
+    if DISTRIBUTED_AVAILABLE:
+        # In-process workers (the transform is still scattered, tasks run through the scheduler)
+        from distributed import Client
+        client = Client(processes=False, n_workers=2, dashboard_address=None)
+    try:
+        outputs, timings = batch_unwarp(paths, transform, tmp_path / 'out', chunk_frames=4, client=client)
+    finally:
+        if client is not None:
+            client.close()
+    # One task per file x chunk of frames
+    assert sorted((t['source'], t['start'], t['stop']) for t in timings) == \
+        sorted([(str(paths[0]), 0, 4), (str(paths[0]), 4, 8), (str(paths[0]), 8, 10),
+                (str(paths[1]), 0, 4), (str(paths[1]), 4, 5)])
+    assert all(t['read'] >= 0 and t['warp'] >= 0 and t['write'] >= 0 for t in timings)
+
+    for path, frames in zip(paths, recordings.values()):
+        unwarped = zarr.open(str(outputs[str(path)]), mode='r')
+        assert unwarped.chunks == (4, 48, 64) and unwarped.dtype == frames.dtype
+        expected = np.stack([apply_transform(frame, transform) for frame in frames])
+        np.testing.assert_allclose(unwarped[:], expected, atol=1 if frames.dtype == np.uint16 else 1e-5)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from napari_mini_unwarp._chunked import project_time
+from napari_mini_unwarp._reader import napari_get_reader
+
+
+def _recording():
+    # t, c, z, y, x
+    return np.random.default_rng(0).integers(0, 1000, (23, 2, 3, 16, 20)).astype(np.uint16)
+
+
+def test_project_time():
+    data = _recording()
+    # Small blocks: several blocks in flight
+    projection, axes = project_time(data, ['t', 'c', 'z', 'y', 'x'], channel=1, workers=2, block_bytes=5000)
+    assert axes == ['z', 'y', 'x']
+    np.testing.assert_allclose(projection, data[:, 1].mean(axis=0))
+
+
+def test_ome_zarr_reader(tmp_path):
+    zarr = pytest.importorskip('zarr')
+    data = _recording()
+    path = tmp_path / 'grid.zarr'
+    group = zarr.open_group(str(path), mode='w')
+    group.create_dataset('0', data=data, chunks=(4, 1, 1, 16, 20))
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'axes': [{'name': 't', 'type': 'time'}, {'name': 'c', 'type': 'channel'},
+                 {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                 {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                 {'name': 'x', 'type': 'space', 'unit': 'micrometer'}],
+        'datasets': [{'path': '0', 'coordinateTransformations': [
+            {'type': 'scale', 'scale': [1., 1., 25., .8, .8]},
+            {'type': 'translation', 'translation': [0., 0., 100., 0., 0.]}]}],
+        }]
+    group.attrs['zoom'] = 1.5
+
+    reader = napari_get_reader(str(path))
+    assert reader is not None
+    layer_data, add_kwargs, layer_type = reader(str(path))[0]
+    np.testing.assert_allclose(layer_data, data[:, 0].mean(axis=0))
+    metadata = add_kwargs['metadata']
+    assert metadata['pixel_size'] == [25., .8, .8] and metadata['units']['x'] == 'micrometer'
+    assert metadata['plane_depths'] == [100., 125., 150.]
+    assert metadata['zoom'] == '1.5'
+    assert add_kwargs['scale'] == [1, 1, 1]
+
+
+def test_hdf5_reader(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    data = _recording()[:, 0, 0]
+    path = tmp_path / 'grid.h5'
+    with h5py.File(path, 'w') as h5_file:
+        dataset = h5_file.create_dataset('acquisition/frames', data=data, chunks=(5, 16, 20))
+        dataset.attrs['axes'] = 'tyx'
+        dataset.attrs['element_size_um'] = [.8, .8]
+
+    reader = napari_get_reader(str(path))
+    layer_data, add_kwargs, _ = reader(str(path))[0]
+    np.testing.assert_allclose(layer_data, data.mean(axis=0))
+    assert add_kwargs['metadata']['axes'] == ['y', 'x']
+    assert add_kwargs['metadata']['pixel_size'] == [.8, .8]
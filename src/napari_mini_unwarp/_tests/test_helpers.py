@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from napari_mini_unwarp._helpers import (generate_perfect_grid, preview_unwarp, unwarp, IncrementalPreview,
+                                         border_status, get_optimal_stack_margin)
+from napari_mini_unwarp._unwarp import WARP_METHODS
+
+
+def test_preview_unwarp():
+    image = ndimage.gaussian_filter(np.random.default_rng(0).random((128, 128)), 4)
+    grid_dots = generate_perfect_grid(image, 5, 5, start_margin=.1)
+    usr_dots = grid_dots + np.random.default_rng(1).normal(0, 1.5, grid_dots.shape)
+
+    unwarped, _ = unwarp(usr_dots, grid_dots, image)
+    preview = preview_unwarp(usr_dots, grid_dots, image, downsample=4, approximate_grid=2)
+    assert preview.shape[0] == 128 // 4 + 1
+    # Compare with the block averaged full resolution result (away from the borders)
+    reference = unwarped[:128, :128].reshape(32, 4, 32, 4).mean(axis=(1, 3))
+    np.testing.assert_allclose(preview[4:28, 4:28], reference[4:28, 4:28], atol=.05)
+
+
+def test_incremental_preview():
+    image = ndimage.gaussian_filter(np.random.default_rng(0).random((512, 512)), 4)
+    grid_dots = generate_perfect_grid(image, 7, 7, start_margin=.1)
+    usr_dots = grid_dots + np.random.default_rng(1).normal(0, 1.5, grid_dots.shape)
+    incremental = IncrementalPreview(grid_dots, image.shape, downsample=4)
+    assert incremental.matches(grid_dots, image.shape) and not incremental.matches(grid_dots + 1, image.shape)
+    preview = incremental(usr_dots, image)
+    assert preview.shape == preview_unwarp(usr_dots, grid_dots, image, downsample=4).shape
+
+    # Dragging one point: incremental refit, only part of the map is re-evaluated ...
+    for step in range(5):
+        usr_dots[24] += [1., -.5]
+        assert incremental.update(usr_dots) < 1
+        preview = incremental(usr_dots, image)
+    # ... with the same result as a preview from scratch (away from the borders)
+    fresh = IncrementalPreview(grid_dots, image.shape, downsample=4)(usr_dots, image)
+    np.testing.assert_allclose(preview[8:-8, 8:-8], fresh[8:-8, 8:-8], atol=1e-3)
+    reference = preview_unwarp(usr_dots, grid_dots, image, downsample=4)
+    np.testing.assert_allclose(preview[8:-8, 8:-8], reference[8:-8, 8:-8], atol=.02)
+
+
+def test_unwarp_output_dtype_and_preallocated():
+    image = ndimage.gaussian_filter(np.random.default_rng(0).random((96, 128)), 4)
+    image = (image * 60000).astype(np.uint16)
+    grid_dots = generate_perfect_grid(image, 5, 5, start_margin=.1)
+    usr_dots = grid_dots + np.random.default_rng(1).normal(0, 1.5, grid_dots.shape)
+
+    unwarped, _ = unwarp(usr_dots, grid_dots, image)
+    assert unwarped.dtype == np.uint16 and unwarped.shape == image.shape
+
+    # Float output, and integer output (rounded and clipped) from it
+    unwarped_float, _ = unwarp(usr_dots, grid_dots, image, output_dtype=np.float32)
+    assert unwarped_float.dtype == np.float32
+    shifted = image.astype(float) - 30000
+    unwarped_int8, _ = unwarp(usr_dots, grid_dots, shifted, output_dtype=np.int8)
+    unwarped_float, _ = unwarp(usr_dots, grid_dots, shifted)
+    np.testing.assert_array_equal(unwarped_int8, np.clip(np.rint(unwarped_float), -128, 127))
+
+    # Write into one plane of a preallocated stack
+    stack = np.zeros((3,) + image.shape, dtype=np.uint16)
+    result, _ = unwarp(usr_dots, grid_dots, image, out=stack[1])
+    assert np.shares_memory(result, stack)
+    np.testing.assert_array_equal(stack[1], unwarped)
+    assert not stack[[0, 2]].any()
+    # ... its dtype has to match output_dtype
+    with pytest.raises(ValueError):
+        unwarp(usr_dots, grid_dots, image, out=stack[1], output_dtype=np.float32)
+
+
+def _stack(num_planes=3):
+    # Grid images with a blank border that grows with depth
+    rng = np.random.default_rng(0)
+    grid_images = np.zeros((num_planes, 96, 112), dtype=np.uint16)
+    usr_dots = []
+    for plane in range(num_planes):
+        border = 6 + 3 * plane
+        grid_images[plane, border:-border, border:-border] = 1000
+        dots = generate_perfect_grid(grid_images[plane], 5, 5, start_margin=.15)
+        usr_dots.append(dots + rng.normal(0, 1, dots.shape))
+    return np.stack(usr_dots), grid_images
+
+
+def test_border_status():
+    usr_dots, grid_images = _stack()
+    for margin in [.05, .1, .2]:
+        grid_dots = generate_perfect_grid(grid_images, 5, 5, start_margin=margin)
+        for method in WARP_METHODS:
+            status = border_status(usr_dots, grid_dots, grid_images, method=method)
+            expected = [unwarp(usr_dots[plane], grid_dots, grid_images[plane], method=method)[1] 
+                        for plane in range(len(grid_images))]
+            np.testing.assert_array_equal(status, expected)
+
+
+def test_get_optimal_stack_margin():
+    usr_dots, grid_images = _stack()
+    margin = get_optimal_stack_margin(0., usr_dots, grid_images, 5, 5)
+    grid_dots = generate_perfect_grid(grid_images, 5, 5, start_margin=margin)
+    assert all(unwarp(usr_dots[plane], grid_dots, grid_images[plane])[1] for plane in range(len(grid_images)))
+    grid_dots = generate_perfect_grid(grid_images, 5, 5, start_margin=margin - .005)
+    assert not all(unwarp(usr_dots[plane], grid_dots, grid_images[plane])[1] for plane in range(len(grid_images)))
+    # Never below the start margin
+    assert get_optimal_stack_margin(.3, usr_dots, grid_images, 5, 5) == .3
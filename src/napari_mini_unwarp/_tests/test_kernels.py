@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from napari_mini_unwarp._kernels import tps_warp, tps_points, NUMBA_AVAILABLE
+from napari_mini_unwarp._unwarp import _make_inverse_warp, _make_coeffs, warp_images
+
+
+def _setup(dtype):
+    rng = np.random.default_rng(0)
+    image = (rng.random((64, 64)) * 1000).astype(dtype)
+    row_pos, col_pos = np.meshgrid(np.linspace(6, 58, 5), np.linspace(6, 58, 5), indexing='ij')
+    grid = np.stack([row_pos.ravel(), col_pos.ravel()], axis=1)
+    usr = grid + rng.normal(0, 2, grid.shape)
+    return image, usr, grid
+
+
+@pytest.mark.parametrize('use_numba', [False, 
+                                       pytest.param(True, marks=pytest.mark.skipif(not NUMBA_AVAILABLE, 
+                                                                                   reason='numba not installed'))])
+@pytest.mark.parametrize('dtype', [np.float64, np.uint16])
+def test_tps_warp_matches_map_coordinates(use_numba, dtype):
+    image, usr, grid = _setup(dtype)
+    transform = _make_inverse_warp(usr, grid, [0, 0, 64, 64], 1)
+    expected = ndimage.map_coordinates(image, transform, order=1)
+
+    coeffs = _make_coeffs(grid, usr)
+    axis = np.linspace(0, 64, 64)
+    out = np.zeros((64, 64), dtype=dtype)
+    result = tps_warp(image, coeffs, grid, axis, axis, out=out, use_numba=use_numba, block_rows=5)
+    assert result is out
+    np.testing.assert_allclose(result, expected, atol=1e-6)
+
+
+def test_warp_images_uses_fused_kernel():
+    image, usr, grid = _setup(np.float64)
+    fused = warp_images(usr, grid, [image], [0, 0, 64, 64], approximate_grid=1)[0]
+    transform = _make_inverse_warp(usr, grid, [0, 0, 64, 64], 1)
+    np.testing.assert_allclose(fused, ndimage.map_coordinates(image, transform, order=1), atol=1e-6)
+
+
+def test_batched_channels_match_single_images():
+    image, usr, grid = _setup(np.float64)
+    mask = (image > 500).astype(np.float64)
+    stack = np.stack([image, image[::-1], mask])
+    region = [0, 0, 64, 64]
+
+    batched = warp_images(usr, grid, stack, region, approximate_grid=2, label_channels=[2])
+    assert batched.shape == (3, 65, 65)
+    transform = _make_inverse_warp(usr, grid, region, 2)
+    for channel, order in enumerate([1, 1, 0]):
+        expected = ndimage.map_coordinates(stack[channel], transform, order=order)
+        np.testing.assert_allclose(batched[channel], expected, atol=1e-9)
+    # Masks stay binary
+    assert set(np.unique(batched[2])) <= {0., 1.}
+
+
+@pytest.mark.parametrize('use_numba', [False, 
+                                       pytest.param(True, marks=pytest.mark.skipif(not NUMBA_AVAILABLE, 
+                                                                                   reason='numba not installed'))])
+def test_tps_points_and_jacobian(use_numba):
+    _, usr, grid = _setup(np.float64)
+    coeffs = _make_coeffs(grid, usr)
+    points = np.random.default_rng(3).uniform(0, 64, (500, 2))
+    points[0] = grid[3] # exactly on a center
+    values, jac = tps_points(coeffs, grid, points, jacobian=True, use_numba=use_numba, chunk_size=64)
+
+    transform = _make_inverse_warp(usr, grid, [0, 0, 64, 64], 1)
+    x, y = np.meshgrid(np.linspace(0, 64, 64), np.linspace(0, 64, 64), indexing='ij')
+    np.testing.assert_allclose(tps_points(coeffs, grid, np.stack([x.ravel(), y.ravel()], axis=1), 
+                                          use_numba=use_numba),
+                               np.stack([transform[0].ravel(), transform[1].ravel()], axis=1), atol=1e-8)
+    # Jacobian against central differences
+    eps = 1e-5
+    for dim in range(2):
+        step = np.zeros(2)
+        step[dim] = eps
+        difference = (tps_points(coeffs, grid, points + step, use_numba=use_numba) 
+                      - tps_points(coeffs, grid, points - step, use_numba=use_numba)) / (2 * eps)
+        np.testing.assert_allclose(jac[:, :, dim], difference, atol=1e-5)
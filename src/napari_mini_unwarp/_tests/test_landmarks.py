@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from napari_mini_unwarp._landmarks import Landmarks
+
+
+def test_landmarks_layer_roundtrip():
+    rng = np.random.default_rng(0)
+    positions = rng.random((4, 9, 2)) * 100
+    landmarks = Landmarks(positions)
+
+    layer_data = landmarks.layer_data
+    assert layer_data.shape == (36, 3)
+    np.testing.assert_array_equal(layer_data[:, 0], np.repeat(np.arange(4), 9))
+    np.testing.assert_array_equal(landmarks[2], positions[2])
+
+    # Converting back is a view on the layer data
+    restored = Landmarks.from_layer_data(layer_data, num_planes=4)
+    assert np.shares_memory(restored.data, layer_data)
+    np.testing.assert_array_equal(restored.positions, positions)
+
+    planes, points = restored.point_index([0, 10, 35])
+    np.testing.assert_array_equal(planes, [0, 1, 3])
+    np.testing.assert_array_equal(points, [0, 1, 8])
+
+
+def test_landmarks_single_plane_and_errors():
+    points = np.arange(10.).reshape(5, 2)
+    landmarks = Landmarks.from_layer_data(points)
+    assert landmarks.num_planes == 1 and landmarks.num_points == 5
+    np.testing.assert_array_equal(landmarks[0], points)
+
+    layer_data = Landmarks(np.zeros((3, 4, 2))).layer_data
+    with pytest.raises(ValueError):
+        Landmarks.from_layer_data(layer_data[:-1], num_planes=3)
+    with pytest.raises(ValueError):
+        Landmarks.from_layer_data(layer_data[::-1], num_planes=3)
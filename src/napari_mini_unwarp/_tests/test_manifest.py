@@ -0,0 +1,53 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from napari_mini_unwarp import _manifest
+from napari_mini_unwarp._manifest import MANIFEST_NAME, load_manifest, scanimage_stack
+
+
+def _write_scanimage_header(path, depth, zoom=2., width=64, height=64):
+    # ScanImage BigTIFF header: static frame data right after the TIFF header
+    frame_data = (f'SI.hStackManager.zs = {depth}\nSI.hRoiManager.scanZoomFactor = {zoom}\n'
+                  f'SI.hRoiManager.pixelsPerLine = {width}\nSI.hRoiManager.linesPerFrame = {height}\n').encode() + b'\x00'
+    with open(path, 'wb') as tif_file:
+        tif_file.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+        tif_file.write(struct.pack('<IIII', 0x07030301, 3, len(frame_data), 0))
+        tif_file.write(frame_data)
+
+
+def test_manifest(tmp_path, monkeypatch):
+    for depth in [200, 0, 100]:
+        _write_scanimage_header(tmp_path / f'grid_{depth}um.tif', depth)
+    entries = load_manifest(tmp_path)
+    assert list(entries) == ['grid_0um.tif', 'grid_100um.tif', 'grid_200um.tif']
+    assert entries['grid_100um.tif']['depths'] == [100.] and entries['grid_100um.tif']['zoom'] == 2.
+    with open(tmp_path / MANIFEST_NAME) as manifest_file:
+        assert set(json.load(manifest_file)['files']) == set(entries)
+
+    sorted_zpos, zoom = scanimage_stack(tmp_path)
+    assert list(sorted_zpos) == [0., 100., 200.] and zoom == 2.
+    assert sorted_zpos[100.].endswith('grid_100um.tif')
+
+    # Second open: everything comes from the manifest ...
+    read = []
+    original_read_header = _manifest.read_header
+    monkeypatch.setattr(_manifest, 'read_header', lambda path: read.append(path.name) or original_read_header(path))
+    assert load_manifest(tmp_path) == entries
+    assert read == []
+    # ... except for changed files
+    _write_scanimage_header(tmp_path / 'grid_100um.tif', 100, zoom=3.25)
+    entries = load_manifest(tmp_path)
+    assert read == ['grid_100um.tif']
+    with pytest.raises(AssertionError, match='zoom'):
+        scanimage_stack(tmp_path, entries)
+
+    # Other .tif files are not accepted for stacks
+    imwrite(tmp_path / 'other.tif', np.zeros((8, 8), dtype=np.uint8))
+    entries = load_manifest(tmp_path)
+    assert not entries['other.tif']['scanimage']
+    with pytest.raises(NotImplementedError):
+        scanimage_stack(tmp_path, entries)
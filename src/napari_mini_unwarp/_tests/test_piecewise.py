@@ -0,0 +1,54 @@
+import numpy as np
+
+from napari_mini_unwarp._piecewise import PiecewiseAffine
+from napari_mini_unwarp._unwarp import warp_images, _make_inverse_warp
+
+
+def test_piecewise_affine_exact_for_affine_warps(landmark_grid):
+    # A global affine warp is reproduced everywhere, including outside of the convex hull
+    from_points = landmark_grid(6)
+    A = np.array([[1.05, .02], [-.03, .97]])
+    to_points = from_points @ A.T + 3
+    x, y = np.mgrid[0:127:32j, 0:127:32j]
+    warped = PiecewiseAffine(from_points, to_points).evaluate(x, y)
+    expected = np.stack([x, y], axis=-1) @ A.T + 3
+    np.testing.assert_allclose(warped[0], expected[..., 0], atol=1e-9)
+    np.testing.assert_allclose(warped[1], expected[..., 1], atol=1e-9)
+
+
+def test_piecewise_affine_interpolates_landmarks(landmark_grid):
+    rng = np.random.default_rng(0)
+    from_points = landmark_grid(6)
+    to_points = from_points + rng.normal(0, 1, from_points.shape)
+    transform = PiecewiseAffine(from_points, to_points)
+    index = transform.index_map(*np.mgrid[0:128, 0:128])
+    assert (index >= 0).all()
+    # Grid points that coincide with landmarks map onto their targets
+    x, y = np.mgrid[10:118:6j, 10:118:6j]
+    warped = transform.evaluate(x, y)
+    np.testing.assert_allclose(np.stack(warped, axis=-1).reshape(-1, 2), to_points, atol=1e-9)
+
+    # Both backends agree closely for smooth, small distortions
+    transforms = [_make_inverse_warp(from_points, to_points, [0, 0, 127, 127], 1, method) 
+                  for method in ['tps', 'piecewise_affine']]
+    assert np.abs(transforms[0][0] - transforms[1][0])[10:-10, 10:-10].max() < 2
+    assert np.abs(transforms[0][1] - transforms[1][1])[10:-10, 10:-10].max() < 2
+
+    image = rng.random((128, 128))
+    unwarped = warp_images(from_points, to_points, [image], [0, 0, 127, 127], 
+                           approximate_grid=1, method='piecewise_affine')[0]
+    assert unwarped.shape == transforms[1][0].shape
+
+
+def test_piecewise_affine_tiled_threads(landmark_grid):
+    # Tiles in parallel threads share the cached triangle-index map of the full grid
+    rng = np.random.default_rng(1)
+    from_points = landmark_grid(6)
+    to_points = from_points + rng.normal(0, 1, from_points.shape)
+    image = rng.random((128, 128))
+    expected = warp_images(from_points, to_points, [image], [0, 0, 127, 127], 
+                           approximate_grid=1, method='piecewise_affine')[0]
+    for _ in range(10):
+        tiled = warp_images(from_points, to_points, [image], [0, 0, 127, 127], approximate_grid=1, 
+                            method='piecewise_affine', tile_size=32, workers=8)[0]
+        np.testing.assert_array_equal(tiled, expected)
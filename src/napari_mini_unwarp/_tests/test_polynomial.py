@@ -0,0 +1,63 @@
+import numpy as np
+
+from napari_mini_unwarp._polynomial import PolynomialModel, fit_polynomial_model, select_polynomial_model
+from napari_mini_unwarp._unwarp import _make_warp, WARP_METHODS
+
+
+def _barrel(points, strength=.08):
+    center = np.array([64., 64.])
+    radius_sq = ((points - center)**2).sum(axis=-1, keepdims=True) / 64**2
+    return center + (points - center) * (1 + strength * radius_sq)
+
+
+def test_polynomial_model_fits_smooth_distortion(landmark_grid):
+    from_points = landmark_grid(9, 8, 120)
+    to_points = _barrel(from_points)
+    model = PolynomialModel(from_points, to_points, order=3)
+    # Barrel distortion is a 3rd order polynomial
+    assert model.max_residual < 1e-9
+    x, y = np.mgrid[0:127:32j, 0:127:32j]
+    warped = model.evaluate(x, y)
+    expected = _barrel(np.stack([x, y], axis=-1))
+    np.testing.assert_allclose(warped[0], expected[..., 0], atol=1e-9)
+    np.testing.assert_allclose(warped[1], expected[..., 1], atol=1e-9)
+
+    # Polynomial is selected, and 'auto' uses it
+    assert select_polynomial_model(from_points, to_points).order == 3
+    auto = WARP_METHODS['auto'](from_points, to_points, x, y)
+    np.testing.assert_allclose(auto[0], expected[..., 0], atol=1e-9)
+
+
+def test_polynomial_model_falls_back_to_tps(landmark_grid):
+    from_points = landmark_grid(9, 8, 120)
+    to_points = _barrel(from_points)
+    # Local distortion around a single landmark cannot be captured by a low order polynomial
+    to_points[40] += [4, -4]
+    model = PolynomialModel(from_points, to_points, order=5)
+    assert model.rms_residual > .5
+    assert select_polynomial_model(from_points, to_points) is None
+
+    x, y = np.mgrid[0:127:16j, 0:127:16j]
+    auto = WARP_METHODS['auto'](from_points, to_points, x, y)
+    tps = _make_warp(from_points, to_points, x, y)
+    np.testing.assert_allclose(auto[0], tps[0])
+
+
+def test_polynomial_model_order_determined(landmark_grid):
+    # A regular 5 x 5 grid determines polynomials of order <= 4 only
+    from_points = landmark_grid(5, 8, 120)
+    to_points = from_points @ np.array([[1.1, .1], [-.05, .9]]).T + 3
+    with np.testing.assert_raises(ValueError):
+        PolynomialModel(from_points, to_points, order=5)
+    assert fit_polynomial_model(from_points, to_points).order == 4
+
+    # ... so the 'polynomial' backend stays exact in between the landmarks
+    x, y = np.mgrid[0:127:16j, 0:127:16j]
+    warped = WARP_METHODS['polynomial'](from_points, to_points, x, y)
+    np.testing.assert_allclose(warped[0], 1.1 * x + .1 * y + 3, atol=1e-9)
+
+    # Three landmarks: exact affine transform
+    model = fit_polynomial_model(from_points[[0, 4, 20]], to_points[[0, 4, 20]])
+    assert model.order == 1
+    warped = WARP_METHODS['polynomial'](from_points[[0, 4, 20]], to_points[[0, 4, 20]], x, y)
+    np.testing.assert_allclose(warped[1], -.05 * x + .9 * y + 3, atol=1e-9)
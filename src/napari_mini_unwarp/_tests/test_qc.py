@@ -0,0 +1,59 @@
+import numpy as np
+
+from napari_mini_unwarp._transform import ThinPlateSpline
+from napari_mini_unwarp._qc import (leave_one_out_residuals, leave_one_out_refit, jacobian_determinant,
+                                   jacobian_determinant_numeric, landmark_qc)
+
+
+def test_leave_one_out_matches_refits(landmark_grid):
+    from_points, to_points = landmark_grid(), landmark_grid(jitter=2)
+    residuals = leave_one_out_residuals(ThinPlateSpline(from_points, to_points))
+
+    for i in [0, 7, 12]:
+        others = np.arange(len(from_points)) != i
+        refit = ThinPlateSpline(from_points[others], to_points[others])
+        predicted = np.stack(refit.evaluate(from_points[i:i+1, 0], from_points[i:i+1, 1]), axis=1)[0]
+        np.testing.assert_allclose(residuals[i], to_points[i] - predicted, atol=1e-6)
+
+
+def test_jacobian_determinant(landmark_grid):
+    from_points, to_points = landmark_grid(), landmark_grid(jitter=2)
+    tps = ThinPlateSpline(from_points, to_points)
+    x, y = np.mgrid[5:120:6j, 5:120:6j]
+
+    eps = 1e-4
+    d_dx = (np.stack(tps.evaluate(x+eps, y)) - np.stack(tps.evaluate(x-eps, y))) / (2*eps)
+    d_dy = (np.stack(tps.evaluate(x, y+eps)) - np.stack(tps.evaluate(x, y-eps))) / (2*eps)
+    np.testing.assert_allclose(jacobian_determinant(tps, x, y),
+                               d_dx[0]*d_dy[1] - d_dy[0]*d_dx[1],
+                               atol=1e-5)
+
+
+def test_landmark_qc_flags_outlier(landmark_grid):
+    grid = landmark_grid()
+    usr_dots = grid.copy()
+    usr_dots[12] += [6, -4]
+    loo_error, jacobian = landmark_qc(usr_dots, grid, (128, 128), step=8)
+    assert np.argmax(loo_error) == 12
+    assert jacobian.shape == (16, 16)
+
+
+def test_qc_other_backends(landmark_grid):
+    from_points, to_points = landmark_grid(), landmark_grid(jitter=2, seed=2)
+    # Refits and central differences agree with the closed forms of the TPS
+    tps = ThinPlateSpline(from_points, to_points)
+    np.testing.assert_allclose(leave_one_out_refit(from_points, to_points, 'tps'),
+                               leave_one_out_residuals(tps), atol=1e-6)
+    x, y = np.mgrid[3:128:16, 5:128:16].astype(float)
+    np.testing.assert_allclose(jacobian_determinant_numeric(from_points, to_points, x, y, 'tps'),
+                               jacobian_determinant(tps, x, y), atol=1e-3)
+
+    # An affine distortion is described exactly by the polynomial: no residuals, constant Jacobian
+    matrix = np.array([[1.1, .1], [-.05, .9]])
+    # (warp from the standard grid to the user points, see landmark_qc())
+    loo_error, jacobian = landmark_qc(to_points @ matrix.T + 3, to_points, (128, 128), method='polynomial')
+    np.testing.assert_allclose(loo_error, 0, atol=1e-6)
+    np.testing.assert_allclose(jacobian, np.linalg.det(matrix), atol=1e-6)
+    for method in ['piecewise_affine', 'wendland', 'auto']:
+        loo_error, jacobian = landmark_qc(to_points, from_points, (128, 128), step=16, method=method)
+        assert loo_error.shape == (len(from_points),) and jacobian.shape == (8, 8)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from napari_mini_unwarp._rbf import CompactRBF
+from napari_mini_unwarp._unwarp import _make_warp
+
+
+def _landmarks(grid, seed=0):
+    rng = np.random.default_rng(seed)
+    # Barrel distortion plus some clicking noise
+    center = np.array([64., 64.])
+    radius_sq = ((grid - center)**2).sum(axis=1, keepdims=True) / 64**2
+    return grid, center + (grid - center) * (1 + .08 * radius_sq) + rng.normal(0, .3, grid.shape)
+
+
+def test_compact_rbf_sparse_and_interpolating(landmark_grid):
+    from_points, to_points = _landmarks(landmark_grid(12, 8, 120))
+    rbf = CompactRBF(from_points, to_points)
+    warped = rbf.evaluate(from_points[:, 0], from_points[:, 1])
+    np.testing.assert_allclose(np.stack(warped, axis=1), to_points, atol=1e-6)
+
+    # Grid fast path and generic evaluation agree
+    x, y = np.mgrid[0:127:64j, 0:127:64j]
+    grid_warped = rbf.evaluate_grid(x, y)
+    warped = rbf.evaluate(x, y)
+    np.testing.assert_allclose(grid_warped[0], warped[0], atol=1e-9)
+    np.testing.assert_allclose(grid_warped[1], warped[1], atol=1e-9)
+
+    # Affine warps are reproduced exactly
+    rbf = CompactRBF(from_points, from_points * 1.1 + 2)
+    np.testing.assert_allclose(rbf.evaluate_grid(x, y)[0], x * 1.1 + 2, atol=1e-6)
+
+
+def test_compact_rbf_close_to_tps(landmark_grid):
+    from_points, to_points = _landmarks(landmark_grid(12, 8, 120))
+    x, y = np.mgrid[8:120:57j, 8:120:57j]
+    rbf = CompactRBF(from_points, to_points).evaluate_grid(x, y)
+    tps = _make_warp(from_points, to_points, x, y)
+    assert np.abs(rbf[0] - tps[0]).max() < .5
+    assert np.abs(rbf[1] - tps[1]).max() < .5
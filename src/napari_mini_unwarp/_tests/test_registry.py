@@ -0,0 +1,87 @@
+import numpy as np
+
+from napari_mini_unwarp._registry import Calibration, CalibrationRegistry
+from napari_mini_unwarp._unwarp import warp_images
+
+
+def _calibration(zoom, tlens=0., system='Emerald', shift=0.):
+    row_pos, col_pos = np.meshgrid(np.linspace(8, 56, 5), np.linspace(8, 56, 5), indexing='ij')
+    grid_dots = np.stack([row_pos.ravel(), col_pos.ravel()], axis=1)
+    usr_dots = grid_dots + np.random.default_rng(int(zoom * 10)).normal(0, 1, grid_dots.shape) + shift
+    return Calibration(system, 'Enormous', 'D0213', zoom, tlens, usr_dots, grid_dots, (64, 64))
+
+
+def test_registry_lookup(tmp_path):
+    path = tmp_path / 'calibrations.sqlite'
+    with CalibrationRegistry(path) as registry:
+        low, high = _calibration(1.), _calibration(2.)
+        registry.add(low, store_map=True)
+        registry.add(high)
+        registry.add(_calibration(1., tlens=100.))
+        registry.add(_calibration(1., system='Other'))
+        assert len(registry) == 4
+        plan = registry._connection.execute(
+            'EXPLAIN QUERY PLAN SELECT zoom FROM calibrations WHERE system = ? AND scope = ? AND objective = ? '
+            'AND tlens = ? AND zoom <= ? ORDER BY zoom DESC LIMIT 1', ('Emerald', 'Enormous', 'D0213', 0., 1.5)
+            ).fetchall()
+        assert 'calibrations_lookup' in str([tuple(row) for row in plan])
+
+    # Persisted
+    with CalibrationRegistry(path) as registry:
+        assert len(registry.entries(system='Emerald')) == 3
+        exact = registry.lookup('Emerald', 'Enormous', 'D0213', zoom=1., tlens=10.)
+        assert exact.id == low.id and exact.tlens == 0.
+        np.testing.assert_allclose(exact.usr_dots, low.usr_dots)
+        np.testing.assert_allclose(exact.coeffs, low.coeffs)
+        assert exact.inverse_map.shape == (2, 64, 64)
+        assert registry.lookup('Emerald', 'Enormous', 'D0213', zoom=1., tlens=90.).tlens == 100.
+        assert registry.lookup('Unknown', 'Enormous', 'D0213', zoom=1.) is None
+
+        # Stored map gives the same result as warping from the points
+        image = np.random.default_rng(0).random((64, 64))
+        expected = warp_images(low.usr_dots, low.grid_dots, [image], [0, 0, 64, 64], approximate_grid=1)[0]
+        np.testing.assert_allclose(exact.unwarp(image), expected, atol=1e-5)
+
+        # Between zoom levels: both neighbours rescaled to the requested zoom and blended
+        center = np.array([31.5, 31.5])
+        interpolated = registry.lookup('Emerald', 'Enormous', 'D0213', zoom=1.5, tlens=0.)
+        expected = .5 * (center + (low.usr_dots - center) * 1.5) + .5 * (center + (high.usr_dots - center) * .75)
+        np.testing.assert_allclose(interpolated.usr_dots, expected)
+        assert interpolated.zoom == 1.5 and interpolated.inverse_map is None
+        # ... its map is evaluated on the first call and reused afterwards
+        expected = warp_images(interpolated.usr_dots, interpolated.grid_dots, [image], [0, 0, 64, 64],
+                               approximate_grid=1)[0]
+        np.testing.assert_allclose(interpolated.unwarp(image), expected, atol=1e-4)
+        cached = interpolated._maps[0]
+        interpolated.unwarp(image)
+        assert interpolated._maps[0] is cached
+        # Beyond calibrated zoom levels: nearest one, rescaled
+        rescaled = registry.lookup('Emerald', 'Enormous', 'D0213', zoom=3., tlens=0.)
+        np.testing.assert_allclose(rescaled.grid_dots, center + (high.grid_dots - center) * 1.5)
+
+
+def test_registry_methods(tmp_path):
+    # Coefficients are only stored for TPS calibrations - other methods store their maps only
+    with CalibrationRegistry(tmp_path / 'calibrations.sqlite') as registry:
+        calibration = _calibration(1.)
+        calibration.method = 'polynomial'
+        registry.add(calibration, store_map=True)
+        stored = registry.get(calibration.id)
+        assert stored.coeffs is None and stored.inverse_map.dtype == np.float32
+        image = np.random.default_rng(1).random((64, 64))
+        expected = warp_images(calibration.usr_dots, calibration.grid_dots, [image], [0, 0, 64, 64],
+                               approximate_grid=1, method='polynomial')[0]
+        np.testing.assert_allclose(stored.unwarp(image), expected, atol=1e-4)
+
+        # Options of warp_images() apply to the stored map as well
+        image = (image * 1000).astype(np.uint16)
+        direct = warp_images(calibration.usr_dots, calibration.grid_dots, [image], [0, 0, 64, 64],
+                             approximate_grid=1, method='polynomial', output_dtype=np.float32)[0]
+        unwarped = stored.unwarp(image, output_dtype=np.float32)
+        assert unwarped.dtype == np.float32
+        np.testing.assert_allclose(unwarped, direct, atol=.1)
+        out = np.zeros((64, 64), dtype=np.uint16)
+        assert stored.unwarp(image, out=[out]) is out
+        np.testing.assert_array_equal(out, stored.unwarp(image, tile_size=16))
+        labels = stored.unwarp(image, label_channels=[0])
+        assert np.isin(labels, image).all()
@@ -0,0 +1,50 @@
+import numpy as np
+from tifffile import imwrite
+
+from napari_mini_unwarp._manifest import read_header
+from napari_mini_unwarp._scanimage import page_planes, project_planes
+from napari_mini_unwarp._reader import tif_reader
+
+
+def _write_multiplane(path, depths=(0, 25, 50), num_channels=2, flyback_frames=1, num_volumes=4):
+    # Fast z recording: channels interleaved per frame, flyback frames after every volume
+    header = (f'SI.hStackManager.zs = [{" ".join(str(d) for d in depths)}]\n'
+              f'SI.hChannels.channelSave = [{";".join(str(c+1) for c in range(num_channels))}]\n'
+              f'SI.hFastZ.enable = true\nSI.hFastZ.discardFlybackFrames = true\n'
+              f'SI.hFastZ.numDiscardFlybackFrames = {flyback_frames}\n'
+              f'SI.hRoiManager.scanZoomFactor = 1.5\nSI.hRoiManager.pixelsPerLine = 16\n'
+              f'SI.hRoiManager.linesPerFrame = 12\n')
+    num_pages = num_volumes * (len(depths) + flyback_frames) * num_channels
+    pages = np.random.default_rng(0).integers(0, 2000, (num_pages, 12, 16)).astype(np.int16)
+    imwrite(path, pages, description=header, metadata=None)
+    return pages
+
+
+def test_project_planes(tmp_path):
+    tif_path = tmp_path / 'volume.tif'
+    pages = _write_multiplane(tif_path)
+    entry = read_header(tif_path)
+    assert entry['depths'] == [0., 25., 50.] and entry['num_channels'] == 2
+    assert entry['fast_z'] and entry['flyback_frames'] == 1
+
+    # Pages: volume x (3 depths + 1 flyback) x 2 channels
+    by_frame = pages.reshape(4, 4, 2, 12, 16)
+    projections = project_planes(tif_path, entry)
+    np.testing.assert_allclose(projections, by_frame[:, :3, 0].mean(axis=0))
+    np.testing.assert_allclose(project_planes(tif_path, entry, channel=1), by_frame[:, :3, 1].mean(axis=0))
+
+    # Slow stack: consecutive frames per depth, for every volume
+    slow = dict(entry, fast_z=False, frames_per_slice=2, num_channels=1)
+    assert list(page_planes(8, slow)) == [0, 0, 1, 1, 2, 2, 0, 0]
+    # ... all volumes (here: 16 frames of 2 channels = 2 volumes and 2 frames) are projected
+    slow = dict(entry, fast_z=False, frames_per_slice=2)
+    frames = pages[0::2]
+    depths = (np.arange(len(frames)) // 2) % 3
+    np.testing.assert_allclose(project_planes(tif_path, slow),
+                               [frames[depths == depth].mean(axis=0) for depth in range(3)])
+
+    # Reader returns one grid image per depth
+    data, add_kwargs, layer_type = tif_reader(tif_path)[0]
+    assert data.shape == (3, 12, 16) and layer_type == 'image'
+    assert add_kwargs['metadata']['plane_depths'] == [0., 25., 50.]
+    assert add_kwargs['metadata']['zoom'] == '1.5'
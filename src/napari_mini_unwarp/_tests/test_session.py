@@ -0,0 +1,95 @@
+import os
+import numpy as np
+
+from napari_mini_unwarp._session import Session, is_session, prune_sessions
+from napari_mini_unwarp._reader import napari_get_reader, session_reader
+from napari_mini_unwarp._tracking import PointPropagator
+
+
+def test_session_incremental(tmp_path):
+    session = Session(tmp_path / 'session')
+    image = np.random.default_rng(0).random((3, 32, 32))
+    points = np.zeros((4, 2))
+    assert session.save({'grid_image': image, 'points': points}, {'no_rows': 2}) == ['grid_image', 'points']
+    assert is_session(session.path)
+
+    # Unchanged arrays are not written again
+    points[0] = 1
+    assert session.save({'grid_image': image, 'points': points}) == ['points']
+    # ... and None removes them
+    session.save({'points': None}, {'method': 'tps'})
+
+    resumed = Session(session.path)
+    parameters, arrays = resumed.load()
+    assert parameters == {'no_rows': 2, 'method': 'tps'}
+    assert sorted(arrays) == ['grid_image']
+    assert isinstance(arrays['grid_image'], np.memmap)
+    np.testing.assert_array_equal(arrays['grid_image'], image)
+    # Loaded arrays are not written again after resuming (unless they changed)
+    assert resumed.save({'grid_image': np.array(arrays['grid_image'])}) == []
+    assert resumed.save({'grid_image': image + 1}) == ['grid_image']
+
+
+def test_session_async(tmp_path):
+    session = Session(tmp_path / 'session')
+    points = np.zeros((10, 2))
+    for step in range(20):
+        points[:, 0] = step
+        session.save_async({'points': points}, {'step': step})
+    # Snapshots are copied: changes after save_async() do not end up in the session
+    points[:] = -1
+    session.flush()
+    parameters, arrays = session.load(mmap=False)
+    assert parameters['step'] == 19
+    np.testing.assert_array_equal(arrays['points'][:, 0], 19)
+
+
+def test_session_reader(tmp_path):
+    session = Session(tmp_path / 'session')
+    image = np.random.default_rng(1).random((2, 16, 16))
+    points = np.array([[0, 2., 3.], [1, 4., 5.]])
+    layers = {'grid_image' : {'add_kwargs': {'name': 'Grid image(s)', 'metadata': {'zoom': '1.5'}},
+                              'layer_type': 'image'},
+              'usr_grid'   : {'add_kwargs': {'name': 'Grid', 'size': 3}, 'layer_type': 'points'},
+              'unwarped'   : {'add_kwargs': {'name': 'Unwarped grid image'}, 'layer_type': 'image'}}
+    session.save({'grid_image': image, 'usr_grid': points}, {'layers': layers})
+
+    assert napari_get_reader(str(session.path)) is session_reader
+    layer_data = session_reader(str(session.path))
+    # No unwarped image saved yet
+    assert [add_kwargs['name'] for _, add_kwargs, _ in layer_data] == ['Grid image(s)', 'Grid']
+    data, add_kwargs, layer_type = layer_data[0]
+    np.testing.assert_array_equal(data, image)
+    assert add_kwargs['metadata'] == {'zoom': '1.5', 'session': session.path.as_posix()}
+    data, add_kwargs, layer_type = layer_data[1]
+    assert layer_type == 'points' and data.flags.writeable
+    np.testing.assert_array_equal(data, points)
+
+
+def test_propagator_state():
+    grid_image = np.random.default_rng(2).random((3, 32, 32))
+    propagator = PointPropagator(grid_image, 4, prediction='none')
+    propagator.propagate(1, [[10., 10.], [20., 15.]])
+    parameters, arrays = propagator.state()
+
+    restored = PointPropagator.from_state(grid_image, parameters, arrays)
+    assert restored.prediction == 'none' and restored.b_box_halfwidth == 4
+    for name in ['points', 'shifts', 'sources', 'anchors']:
+        np.testing.assert_array_equal(getattr(restored, name), arrays[name])
+
+
+def test_prune_sessions(tmp_path):
+    paths = []
+    for age in range(4):
+        session = Session.new(tmp_path, keep=10)
+        session.save(parameters={'age': age})
+        # Saved `age` hours ago
+        os.utime(session.path / 'session.json', (0, 1e9 - age * 3600))
+        paths.append(session.path)
+    (tmp_path / 'not_a_session').mkdir()
+
+    assert sorted(prune_sessions(tmp_path, keep=2)) == sorted(paths[2:])
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([paths[0].name, paths[1].name, 'not_a_session'])
+    # A new session counts towards the limit
+    Session.new(tmp_path, keep=2).save()
+    assert [p for p in paths if p.exists()] == [paths[0]]
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from napari_mini_unwarp._tiling import tile_ranges
+from napari_mini_unwarp._unwarp import warp_images, output_shape
+
+
+def _setup():
+    rng = np.random.default_rng(0)
+    image = rng.random((80, 90))
+    row_pos, col_pos = np.meshgrid(np.linspace(8, 72, 5), np.linspace(8, 82, 5), indexing='ij')
+    grid = np.stack([row_pos.ravel(), col_pos.ravel()], axis=1)
+    return image, grid + rng.normal(0, 2, grid.shape), grid
+
+
+def test_tile_ranges_cover_output():
+    covered = np.zeros((50, 70), dtype=int)
+    for (r0, r1), (c0, c1) in tile_ranges(covered.shape, 16):
+        covered[r0:r1, c0:c1] += 1
+    assert (covered == 1).all()
+    with pytest.raises(ValueError):
+        tile_ranges((10, 10), 0)
+
+
+@pytest.mark.parametrize('method, approximate_grid, order', [('tps', 1, 1), 
+                                                             ('tps', 3, 3), 
+                                                             ('piecewise_affine', 2, 1),
+                                                             ('wendland', 1, 0)])
+def test_tiled_warp_matches_untiled(tmp_path, method, approximate_grid, order):
+    image, usr, grid = _setup()
+    region = [0, 0, 80, 90]
+    expected = warp_images(usr, grid, [image], region, order, approximate_grid, method)[0]
+
+    # Memory mapped source and output
+    source = np.lib.format.open_memmap(tmp_path / 'source.npy', mode='w+', dtype=image.dtype, shape=image.shape)
+    source[:] = image
+    out = np.lib.format.open_memmap(tmp_path / 'out.npy', mode='w+', dtype=image.dtype, 
+                                    shape=output_shape(region, approximate_grid))
+    result = warp_images(usr, grid, [source], region, order, approximate_grid, method,
+                         tile_size=17, out=[out], workers=2)[0]
+    assert result is out
+    np.testing.assert_allclose(result, expected, atol=1e-8)
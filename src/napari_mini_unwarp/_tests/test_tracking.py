@@ -0,0 +1,125 @@
+import numpy as np
+from scipy import ndimage
+from skimage.registration import phase_cross_correlation
+
+from napari_mini_unwarp._tracking import (PointPropagator,
+                                          build_pyramid,
+                                          extract_patches,
+                                          refine_shift,
+                                          track_point,
+                                          correlation_error,
+                                          _cross_power_spectrum,
+                                          _integer_shift,
+                                          )
+
+
+def _smooth_image(shape=(256, 256), seed=0):
+    rng = np.random.default_rng(seed)
+    return ndimage.gaussian_filter(rng.random(shape), 3)
+
+
+def _dot_stack(shifts, num_dots=5, shape=(256, 256)):
+    # Stack of grid images, shifted by `shifts` (one per plane)
+    rows, cols = np.meshgrid(np.linspace(.15, .85, num_dots) * shape[0],
+                             np.linspace(.15, .85, num_dots) * shape[1],
+                             indexing='ij')
+    dots = np.round(np.stack([rows.ravel(), cols.ravel()], axis=1))
+    image = np.zeros(shape)
+    image[dots[:, 0].astype(int), dots[:, 1].astype(int)] = 1
+    image = ndimage.gaussian_filter(image, 3)
+    return np.stack([ndimage.shift(image, shift) for shift in shifts]), dots
+
+
+def test_extract_patches_border():
+    image = np.arange(100, dtype=float).reshape(10, 10)
+    centers = np.array([[5, 5], [0, 0], [9, 12]])
+    patches = extract_patches(image, centers, 3)
+    assert patches.shape == (3, 6, 6)
+    assert patches.flags['C_CONTIGUOUS']
+    np.testing.assert_array_equal(patches[0], image[2:8, 2:8])
+    # Zero padding outside of the image
+    np.testing.assert_array_equal(patches[1][3:, 3:], image[:3, :3])
+    assert not patches[1][:3].any() and not patches[1][:, :3].any()
+    np.testing.assert_array_equal(patches[2][:4, :1], image[6:, 9:])
+    assert not patches[2][:, 1:].any()
+
+
+def test_refine_shift_matches_skimage():
+    image = _smooth_image()
+    reference = image[64:128, 64:128]
+    moving = ndimage.shift(image, (0.3, -0.4))[64:128, 64:128]
+
+    cross_power = _cross_power_spectrum(reference, moving)
+    shift, _ = refine_shift(cross_power, _integer_shift(cross_power), tolerance=0)
+    expected, _, _ = phase_cross_correlation(reference,
+                                             moving,
+                                             upsample_factor=250,
+                                             normalization=None,
+                                             )
+    np.testing.assert_allclose(shift, expected, atol=1/250)
+
+
+def test_correlation_error():
+    image = _smooth_image()
+    reference = image[64:128, 64:128]
+    moving = ndimage.shift(image, (0.3, -0.4))[64:128, 64:128]
+    noise = np.random.default_rng(1).random((64, 64))
+    patches = np.stack([reference, reference]), np.stack([moving, noise])
+
+    cross_power = _cross_power_spectrum(*patches)
+    shifts, _ = refine_shift(cross_power, _integer_shift(cross_power))
+    errors = correlation_error(cross_power, shifts, *patches)
+    assert errors[0] < .01
+    assert errors[1] > .9
+
+
+def test_track_point_large_drift():
+    # Drift larger than the bounding box should be caught by the coarse (pyramid) search
+    image = _smooth_image()
+    drift = (14.2, -11.6)
+    shifted = ndimage.shift(image, drift, order=3)
+    point = np.array([128., 128.])
+
+    new_point = track_point(build_pyramid(image, 2),
+                            build_pyramid(shifted, 2),
+                            point,
+                            b_box_halfwidth=16,
+                            )
+    np.testing.assert_allclose(new_point - point, drift, atol=.5)
+
+
+def test_point_propagator_update():
+    shifts = [(1.5 * i, -.7 * i) for i in range(-3, 4)]
+    stack, dots = _dot_stack(shifts)
+    propagator = PointPropagator(stack, 10, reference='anchor')
+    points = propagator.propagate(3, dots)
+    np.testing.assert_allclose(points - dots, np.broadcast_to(np.array(shifts)[:, None], points.shape), atol=.1)
+
+    # Correcting a single point only changes that point
+    before = points.copy()
+    corrected = dots[4] + np.array(shifts[5]) + .5
+    points = propagator.update(5, [4], corrected)
+    assert propagator.anchors[5, 4]
+    np.testing.assert_allclose(points[5, 4], corrected)
+    np.testing.assert_array_equal(np.delete(points, 4, axis=1), np.delete(before, 4, axis=1))
+    # ... and points on the far side of the original anchor plane are untouched
+    np.testing.assert_array_equal(points[:4, 4], before[:4, 4])
+
+
+def test_point_propagator_outliers():
+    shifts = [(1.5 * i, -.7 * i) for i in range(-3, 4)]
+    stack, dots = _dot_stack(shifts)
+    expected = dots + np.array(shifts)[:, None]
+    # Blank out one dot in plane 5: without outlier rejection the point jumps to a neighbouring dot
+    row, col = np.round(expected[5, 7]).astype(int)
+    stack[5, row-8:row+9, col-8:col+9] = 0
+
+    unchecked = PointPropagator(stack, 10, max_error=1., max_deviation=np.inf).propagate(3, dots)
+    assert np.abs(unchecked[5:, 7] - expected[5:, 7]).max() > 10
+
+    propagator = PointPropagator(stack, 10)
+    points = propagator.propagate(3, dots)
+    np.testing.assert_allclose(points, expected, atol=.1)
+    # The lost point was set from its neighbours and flagged, all others pass
+    assert propagator.flagged[5, 7] and (propagator.flagged.sum() == propagator.flagged[5:, 7].sum())
+    assert propagator.errors[~propagator.flagged].max() < .1
@@ -0,0 +1,45 @@
+import numpy as np
+
+from napari_mini_unwarp._transform import ThinPlateSpline, UnwarpTransform
+from napari_mini_unwarp._unwarp import _make_inverse_warp
+
+
+def test_tps_interpolates_landmarks(landmark_grid):
+    from_points, to_points = landmark_grid(6), landmark_grid(6, jitter=2)
+    tps = ThinPlateSpline(from_points, to_points)
+    warped = tps.evaluate(from_points[:, 0], from_points[:, 1])
+    np.testing.assert_allclose(np.stack(warped, axis=1), to_points, atol=1e-6)
+
+
+def test_tps_incremental_update(landmark_grid):
+    from_points, to_points = landmark_grid(6), landmark_grid(6, jitter=2)
+    x, y = np.mgrid[0:128:64j, 0:128:64j]
+    tps = ThinPlateSpline(from_points, to_points)
+    transform = tps.evaluate(x, y)
+
+    # Move a target and two source points
+    tps.update([7], to_points=to_points[7] + [3, -2])
+    tps.update([3, 20], from_points=from_points[[3, 20]] + [[1, 2], [-2, 1]])
+    fraction = tps.update_map(transform, x, y, tolerance=1e-3, block=8)
+    assert 0 < fraction <= 1
+
+    reference = ThinPlateSpline(tps.from_points, tps.to_points)
+    np.testing.assert_allclose(tps.coeffs, reference.coeffs, atol=1e-6)
+    np.testing.assert_allclose(transform, reference.evaluate(x, y), atol=2e-3)
+
+
+def test_unwarp_transform_points(landmark_grid):
+    grid, usr = landmark_grid(6), landmark_grid(6, jitter=2)
+    transform = UnwarpTransform(usr, grid, image_shape=(128, 128))
+
+    # inverse() samples the same map that is used for unwarping images
+    warp_map = _make_inverse_warp(usr, grid, [0, 0, 128, 128], 1)
+    pixels = np.random.default_rng(1).integers(0, 128, (200, 2))
+    expected = np.stack([warp_map[0][pixels[:, 0], pixels[:, 1]], 
+                         warp_map[1][pixels[:, 0], pixels[:, 1]]], axis=1)
+    np.testing.assert_allclose(transform.inverse(pixels), expected, atol=1e-8)
+
+    # forward() is its inverse, and maps user points onto the standard grid
+    points = np.random.default_rng(2).uniform(0, 128, (5000, 2))
+    np.testing.assert_allclose(transform.inverse(transform.forward(points)), points, atol=1e-5)
+    np.testing.assert_allclose(transform.forward(usr) * transform.scale, grid, atol=1e-5)
@@ -0,0 +1,62 @@
+import numpy as np
+from scipy import ndimage
+
+from napari_mini_unwarp import _unwarp
+from napari_mini_unwarp._unwarp import warp_images
+
+
+def test_identity_warp(landmark_grid):
+    image = np.random.default_rng(0).random((64, 64))
+    points = landmark_grid(5, 10, 54)
+    warped = warp_images(points, points, [image], [0, 0, 63, 63], approximate_grid=3)[0]
+    np.testing.assert_allclose(warped[1:-1, 1:-1], image[1:-1, 1:-1], atol=1e-6)
+
+
+def test_factorization_cache(landmark_grid):
+    to_points = landmark_grid(5, 10, 90)
+    from_points = to_points + np.random.default_rng(1).normal(0, 1, to_points.shape)
+    _unwarp._L_inverse_cache.clear()
+    warp_images(from_points, to_points, [np.zeros((100, 100))], [0, 0, 100, 100], approximate_grid=4)
+    # Moving the user points only changes the right-hand side - the factorization is reused
+    warp_images(from_points + 1, to_points, [np.zeros((100, 100))], [0, 0, 100, 100], approximate_grid=4)
+    assert len(_unwarp._L_inverse_cache) == 1
+
+
+def test_float32_precision(landmark_grid):
+    # Single precision compute mode against the float64 path. Documented bound (see warp_images()):
+    # coordinate maps deviate by less than 0.02 pixels for frames up to 4096 x 4096.
+    # 2048 x 2048 keeps the test fast (the deviation grows with the frame size, ~0.003 px here).
+    size = 2048
+    to_points = landmark_grid(10, 10, size-10)
+    from_points = to_points + np.random.default_rng(2).normal(0, 3, to_points.shape)
+    for approximate_grid in [1, 4]:
+        reference = _unwarp._make_inverse_warp(from_points, to_points, [0, 0, size, size], approximate_grid)
+        single = _unwarp._make_inverse_warp(from_points, to_points, [0, 0, size, size], approximate_grid,
+                                            precision='float32')
+        for ref, sgl in zip(reference, single):
+            assert sgl.dtype == np.float32
+            assert np.abs(ref - sgl).max() < .02
+
+    # Resampled images agree to float32 round-off
+    rows, cols = np.mgrid[:256, :256]
+    image = np.sin(rows / 9.) * np.cos(cols / 13.)
+    to_points = landmark_grid(6, 10, 246)
+    from_points = to_points + np.random.default_rng(3).normal(0, 3, to_points.shape)
+    for kwargs in [dict(approximate_grid=1), dict(approximate_grid=2, tile_size=100), dict(interpolation_order=3)]:
+        reference = warp_images(from_points, to_points, [image], [0, 0, 256, 256], **kwargs)[0]
+        single = warp_images(from_points, to_points, [image], [0, 0, 256, 256], precision='float32', **kwargs)[0]
+        np.testing.assert_allclose(single, reference, atol=1e-4)
+
+
+def test_integer_rounding():
+    # Integer outputs are rounded half away from zero on every path, as by ndimage
+    values = np.array([-2.5, -1.5, -.5, .5, 1.5, 2.5, 2.4999, -2.4999])
+    out = np.empty(values.shape, dtype=np.int16)
+    _unwarp._convert(values, out)
+    np.testing.assert_array_equal(out, [-3, -2, -1, 1, 2, 3, 2, -2])
+
+    image = np.tile(np.arange(8, dtype=np.uint16), (8, 1))
+    rows, cols = np.mgrid[0:8, 0:7].astype(float)
+    transform = [rows, cols + .5] # exact .5 values
+    expected = ndimage.map_coordinates(image, transform, order=1, output=np.uint16)
+    np.testing.assert_array_equal(_unwarp.apply_transform(image, transform), expected)
@@ -0,0 +1,62 @@
+import numpy as np
+
+from napari_mini_unwarp._zmodel import DepthModel, select_key_planes
+from napari_mini_unwarp._unwarp import _make_coeffs, warp_images
+
+
+def _stack(grid, num_planes=12):
+    # Barrel distortion that gets stronger with depth, plus a slow drift
+    center = np.array([32., 32.])
+    radius_sq = ((grid - center)**2).sum(axis=-1, keepdims=True) / 32**2
+    depths = np.arange(num_planes)
+    strength = .02 + .06 * np.sin(depths / num_planes * np.pi / 2)
+    positions = center + (grid - center) * (1 + strength[:, None, None] * radius_sq)
+    positions = positions + .1 * depths[:, None, None]
+    return grid, positions
+
+
+def test_depth_model_key_planes(landmark_grid):
+    grid, positions = _stack(landmark_grid(7, 8, 56))
+    key_planes = select_key_planes(positions, tolerance=.05)
+    assert 2 < len(key_planes) < len(positions)
+    assert key_planes[0] == 0 and key_planes[-1] == len(positions) - 1
+
+    model = DepthModel(positions, key_planes=key_planes)
+    assert model.interpolation_error().max() < .05
+    # Key planes are reproduced exactly
+    np.testing.assert_allclose(model.positions(model.depths[key_planes]), positions[key_planes], atol=1e-9)
+
+    # Evenly spaced key planes
+    assert list(DepthModel(positions, key_planes=3).key_planes) == [0, 6, 11]
+
+
+def test_depth_model_interpolates_coefficients(landmark_grid):
+    grid, positions = _stack(landmark_grid(7, 8, 56))
+    model = DepthModel(positions, key_planes=[0, 4, 8, 11])
+    # For a fixed grid, coefficients are linear in the landmarks:
+    # interpolating landmarks is the same as interpolating coefficients
+    key_coeffs = np.stack([_make_coeffs(grid, positions[plane]) for plane in model.key_planes])
+    model_coeffs = np.stack([model.coefficients(depth, grid) for depth in model.depths[model.key_planes]])
+    np.testing.assert_allclose(model_coeffs, key_coeffs, atol=1e-6)
+    depth = 5.5
+    assert model.positions(depth).shape == positions.shape[1:]
+    coeffs = model.coefficients(depth, grid)
+    np.testing.assert_allclose(coeffs, _make_coeffs(grid, model.positions(depth)), atol=1e-9)
+
+    # Unwarping at an intermediate depth, direct and through the cached map
+    image = np.random.default_rng(0).integers(0, 1000, (64, 64)).astype(np.uint16)
+    expected = warp_images(model.positions(depth), grid, [image.astype(float)], [0, 0, 64, 64],
+                           approximate_grid=1)[0]
+    unwarped = model.unwarp(image, depth, grid)
+    cached = model.unwarp(image, depth, grid, cached=True)
+    assert unwarped.dtype == cached.dtype == np.uint16
+    np.testing.assert_allclose(unwarped, np.rint(expected), atol=1)
+    np.testing.assert_array_equal(cached, model.unwarp(image, depth, grid, cached=True))
+    np.testing.assert_allclose(cached, np.rint(expected), atol=1)
+    assert len(model._map_cache) == 1
+
+    # The cached map follows the warping method
+    for method in ['polynomial', 'piecewise_affine']:
+        direct = model.unwarp(image, depth, grid, method=method)
+        np.testing.assert_array_equal(model.unwarp(image, depth, grid, cached=True, method=method), direct)
+    assert len(model._map_cache) == 3
@@ -0,0 +1,96 @@
+### TILED WARPING
+# Execution of warp_images() (see _unwarp.py) tile by tile, for frames that are too large
+# to hold the full coordinate maps (and intermediate arrays) in memory at once.
+#
+# - The output is split into tiles of (at most) tile_size x tile_size pixels.
+# - For every tile, the transform is evaluated on that tile only, and only the bounding box
+#   of the source image the tile maps to (plus an interpolation halo) is read. This way
+#   the source can also be a memory mapped array.
+# - Tiles are written straight into a preallocated (or memory mapped) output and
+#   can be processed in parallel threads (scipy.ndimage and most of NumPy release the GIL).
+# Peak memory is therefore bounded by a few tile-sized arrays per thread.
+#
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+
+from ._kernels import gather_channels
+
+# Spline interpolation (order > 1) prefilters the source. The influence of pixels
+# outside of the halo on the prefiltered values decays geometrically
+# (cubic spline: 0.27**16 < 1e-9), so a halo of 16 pixels makes tiles match the untiled result.
+SPLINE_HALO = 16
+
+
+def tile_ranges(shape, tile_size):
+    '''
+    (start, stop) row and column ranges of all tiles covering `shape`
+
+    Parameters
+    ----------
+    shape : tuple : (rows, cols) of the output
+    tile_size : int : tile edge length in pixels
+
+    Returns
+    -------
+    tiles : list : [((row_start, row_stop), (col_start, col_stop)), ...]
+    '''
+    tile_size = int(tile_size)
+    if tile_size < 1:
+        raise ValueError(f'tile_size must be a positive integer, got {tile_size}')
+    return [((r, min(r + tile_size, shape[0])), (c, min(c + tile_size, shape[1])))
+            for r in range(0, shape[0], tile_size)
+            for c in range(0, shape[1], tile_size)]
+
+
+def run_tiles(shape, tile_size, process_tile, workers=1):
+    '''
+    Call `process_tile(rows, cols)` for every tile of `shape`,
+    optionally in `workers` parallel threads
+    '''
+    tiles = tile_ranges(shape, tile_size)
+    if workers is None or workers <= 1:
+        for rows, cols in tiles:
+            process_tile(rows, cols)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises exceptions from the threads
+        list(executor.map(lambda tile: process_tile(*tile), tiles))
+
+
+def sample_tile(image, transform, order, out, cval=0., labels=None):
+    '''
+    Sample `image` at the coordinates `transform` of one tile, reading only
+    the part of `image` that is needed. Same result as
+    ndimage.map_coordinates(image, transform, order=order, output=out).
+
+    Parameters
+    ----------
+    image : np.array : 2D source image (can be memory mapped), 
+                       or channels x rows x cols stack (order 0 or 1, see gather_channels())
+    transform : list : [x, y] coordinate arrays of the tile
+    order : int : interpolation order
+    out : np.array : output array for the tile (same shape as the coordinate arrays, 
+                     with a leading channel axis for stacks)
+    cval : float : value for samples outside of `image`
+    labels : np.array : boolean mask of label channels of a stack (see gather_channels())
+    '''
+    halo = 1 if order <= 1 else SPLINE_HALO
+    # Source bounding box of the tile (clipped to the image)
+    lower = [max(int(np.floor(np.nanmin(t))) - halo, 0) for t in transform]
+    upper = [min(int(np.ceil(np.nanmax(t))) + halo + 1, image.shape[-2+dim]) for dim, t in enumerate(transform)]
+    if (upper[0] <= lower[0]) or (upper[1] <= lower[1]):
+        # Tile maps completely outside of the source image
+        out[...] = cval
+        return out
+    source = np.asarray(image[..., lower[0]:upper[0], lower[1]:upper[1]])
+    coordinates = [transform[0] - lower[0], transform[1] - lower[1]]
+    if source.ndim == 3:
+        if order > 1:
+            raise NotImplementedError('Stacks of channels are only sampled with order 0 or 1')
+        if order == 0:
+            labels = np.ones(len(source), dtype=bool)
+        gather_channels(source, coordinates, out, labels=labels, cval=cval)
+    else:
+        ndimage.map_coordinates(source, coordinates, order=order, cval=cval, output=out)
+    return out
@@ -0,0 +1,616 @@
+### POINT TRACKING
+# Coarse-to-fine phase correlation used by propagate_cross_corr() in _helpers.py
+#
+# The tracking of a single point from one plane to the next happens in three stages:
+# 1. Coarse: integer phase correlation on a downsampled (block averaged) image pyramid.
+#            This catches large inter-plane drift that the full resolution box would miss.
+# 2. Medium: integer phase correlation at full resolution, with the box placed at the
+#            position predicted by the coarse stage.
+# 3. Fine:   subpixel refinement of the medium stage peak via a matrix-multiply DFT
+#            (Guizar-Sicairos et al., Opt. Lett. 33, 156-158 (2008)),
+#            with an upsampling factor that is increased only until the estimate converges.
+#            Every refinement step only samples the cross correlation in the neighbourhood of the
+#            previous estimate, so the DFT work stays small even at high upsampling factors.
+# All stages work on batches: the patches around all points of a plane are gathered in one go 
+# (zero padded at the image borders, see extract_patches()) and transformed together.
+#
+# PointPropagator (below) builds on this to propagate whole grids through a stack. 
+# It keeps the shift history of every point, places search boxes via a motion prediction across z 
+# and re-tracks only the affected points after user corrections. 
+#
+# Outlier rejection: a point that lands on a blank area or on a neighbouring dot would poison 
+# every later plane in the chain. Every tracked point therefore gets 
+#   - a correlation error (1 - normalized correlation peak**2, as in skimage's phase_cross_correlation)
+#   - a consistency check of its displacement against the median displacement of its 
+#     nearest lattice neighbours (the grid deforms smoothly between planes)
+# Only the points failing either check are tracked again - with a larger box, placed at the 
+# position predicted from their neighbours. Points that still fail are set to that prediction 
+# and flagged (PointPropagator.flagged) for manual inspection.
+#
+from collections import OrderedDict
+import numpy as np
+from scipy import fft
+from scipy.spatial import cKDTree
+
+# Outlier rejection defaults (see PointPropagator)
+MAX_ERROR     = .5  # Maximum correlation error (0: perfect match, 1: no correlation)
+MAX_DEVIATION = 2.  # Maximum deviation (pixels) of a point's displacement from its neighbours' 
+NUM_NEIGHBOURS = 4  # Lattice neighbours used for the consistency check
+RETRY_FACTOR  = 2   # Flagged points are re-tracked with a RETRY_FACTOR x larger box
+
+
+def build_pyramid(image, levels):
+    '''
+    Build an image pyramid by repeated 2x2 block averaging
+
+    Parameters
+    ----------
+    image : np.array : 2D image
+    levels : int : number of downsampled levels (0 returns only the original image)
+
+    Returns
+    -------
+    pyramid : list : [image, image/2, image/4, ...] (length levels + 1)
+    '''
+    pyramid = [np.asarray(image, dtype=float)]
+    for _ in range(levels):
+        last = pyramid[-1]
+        height, width = (last.shape[0] // 2) * 2, (last.shape[1] // 2) * 2
+        if min(height, width) < 2:
+            break
+        last = last[:height, :width]
+        pyramid.append(last.reshape(height//2, 2, width//2, 2).mean(axis=(1, 3)))
+    return pyramid
+
+
+def extract_patches(image, centers, halfwidth):
+    '''
+    Gather (2*halfwidth, 2*halfwidth) patches around all `centers` at once
+
+    The image is zero padded (explicitly) so that every patch has the full size,
+    even for centers close to - or beyond - the image border.
+    All patches are gathered from a sliding window view of the padded image in 
+    a single fancy indexing operation.
+
+    Parameters
+    ----------
+    image : np.array : 2D image
+    centers : np.array : N x 2 integer (row, col) patch centers
+    halfwidth : int : patch half width
+
+    Returns
+    -------
+    patches : np.array : contiguous N x 2*halfwidth x 2*halfwidth batch
+    '''
+    centers = np.asarray(centers, dtype=int).reshape(-1, 2)
+    if not len(centers):
+        return np.zeros((0, 2*halfwidth, 2*halfwidth), dtype=image.dtype)
+    starts = centers - halfwidth
+    # Padding needed on each side to fit all patches
+    pad_before = np.maximum(0, -starts.min(axis=0))
+    pad_after  = np.maximum(0, (starts + 2*halfwidth).max(axis=0) - np.array(image.shape))
+    if pad_before.any() or pad_after.any():
+        image = np.pad(image, list(zip(pad_before, pad_after)), mode='constant')
+        starts = starts + pad_before
+    windows = np.lib.stride_tricks.sliding_window_view(image, (2*halfwidth, 2*halfwidth))
+    return np.ascontiguousarray(windows[starts[:, 0], starts[:, 1]])
+
+
+def _cross_power_spectrum(reference, moving):
+    '''
+    Unnormalized cross power spectrum of two equally sized (batches of) images
+    (equivalent to normalization=None in skimage.registration.phase_cross_correlation)
+    '''
+    return fft.fft2(reference, workers=-1) * fft.fft2(moving, workers=-1).conj()
+
+
+def _integer_shift(cross_power):
+    '''
+    Integer pixel shift from the peak of the cross correlation 
+    (for a single image or batch of images in the last two axes)
+    '''
+    cross_corr = np.abs(fft.ifft2(cross_power, workers=-1))
+    shape = np.array(cross_power.shape[-2:])
+    flat_idx = cross_corr.reshape(*cross_corr.shape[:-2], -1).argmax(axis=-1)
+    maxima = np.stack(np.unravel_index(flat_idx, tuple(shape)), axis=-1).astype(float)
+    midpoints = np.fix(shape / 2)
+    return np.where(maxima > midpoints, maxima - shape, maxima)
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    '''
+    Upsampled DFT of a batch of images `data` (N x H x W) evaluated by matrix 
+    multiplication in a `region_size` x `region_size` neighbourhood 
+    starting at `offsets` (N x 2).
+    Cheaper than zero padding + FFT if region_size is small.
+    '''
+    kernels = []
+    for n_items, offset in zip(data.shape[-2:], offsets.T):
+        kernel = ((np.arange(region_size)[None, :] - offset[:, None])[:, :, None]
+                  * np.fft.fftfreq(n_items, upsample_factor)[None, None, :])
+        kernels.append(np.exp(-2j * np.pi * kernel))
+    row_kernel, col_kernel = kernels
+    return row_kernel @ data @ col_kernel.transpose(0, 2, 1)
+
+
+def refine_shift(cross_power, shift, upsample_factor=250, start_upsample=10, step=5, tolerance=0.01):
+    '''
+    Subpixel refinement of `shift` with an adaptive upsampling factor.
+
+    The upsampling factor starts at `start_upsample` and is multiplied by `step`
+    until either `upsample_factor` is reached or two successive estimates
+    differ by less than `tolerance` pixels (convergence criterion).
+    Points that are already well registered therefore stop early.
+    Works on a single cross power spectrum or a batch (N x H x W); 
+    in the latter case convergence is decided per item.
+
+    Parameters
+    ----------
+    cross_power : np.array : cross power spectrum of reference and moving patch(es)
+    shift : np.array : initial (integer) shift estimate(s)
+    upsample_factor : int : maximum upsampling factor
+    start_upsample : int : first upsampling factor
+    step : int : multiplication factor between successive upsampling factors
+    tolerance : float : convergence criterion in pixels
+
+    Returns
+    -------
+    shift : np.array : refined shift(s) (row, col)
+    final_upsample : int or np.array : upsampling factor(s) at which refinement stopped
+    '''
+    single = cross_power.ndim == 2
+    data  = np.conj(cross_power.reshape(-1, *cross_power.shape[-2:]))
+    shift = np.array(shift, dtype=float).reshape(-1, 2)
+    final_upsample = np.ones(len(shift), dtype=int)
+
+    if upsample_factor > 1:
+        active = np.arange(len(shift))
+        search_radius = 1.5 # pixels around the integer estimate
+        factor = min(start_upsample, upsample_factor)
+        while len(active):
+            region_size = int(np.ceil(factor * search_radius * 2))
+            dftshift = np.fix(region_size / 2.)
+            rounded  = np.round(shift[active] * factor) / factor
+            offsets  = dftshift - rounded * factor
+            cross_corr = np.abs(_upsampled_dft(data[active], region_size, factor, offsets))
+            flat_idx = cross_corr.reshape(len(active), -1).argmax(axis=-1)
+            maxima = np.stack(np.unravel_index(flat_idx, (region_size, region_size)), axis=-1)
+            new_shift = rounded + (maxima - dftshift) / factor
+
+            converged = np.abs(new_shift - shift[active]).max(axis=-1) < tolerance
+            shift[active] = new_shift
+            final_upsample[active] = factor
+            if factor >= upsample_factor:
+                break
+            active = active[~converged]
+            # Next round only has to search around the current estimate
+            search_radius = 1. / factor
+            factor = min(factor * step, upsample_factor)
+
+    if single:
+        return shift[0], final_upsample[0]
+    return shift, final_upsample
+
+
+def correlation_error(cross_power, shifts, reference, moving):
+    '''
+    Correlation error at `shifts` for a batch of patch pairs: 1 - (normalized correlation peak)**2
+    (as the error returned by skimage's phase_cross_correlation, but for mean subtracted patches, 
+    so that a uniform background does not count as a match).
+    0 for a perfect match, close to 1 for patches that do not correlate (e.g. blank areas)
+
+    Parameters
+    ----------
+    cross_power : np.array : N x H x W cross power spectra (see _cross_power_spectrum())
+    shifts : np.array : N x 2 (subpixel) shifts at which the correlation is evaluated
+    reference : np.array : N x H x W reference patches
+    moving : np.array : N x H x W moving patches
+
+    Returns
+    -------
+    errors : np.array : N correlation errors
+    '''
+    height, width = cross_power.shape[-2:]
+    shifts = np.reshape(shifts, (-1, 2))
+    # Correlation at a (subpixel) position = inverse DFT evaluated at that single point.
+    # Leaving out the zero frequency term is the same as subtracting the patch means
+    row_kernel = np.exp(2j * np.pi * shifts[:, :1] * np.fft.fftfreq(height)[None, :])
+    col_kernel = np.exp(2j * np.pi * shifts[:, 1:] * np.fft.fftfreq(width)[None, :])
+    peak = np.einsum('nh,nhw,nw->n', row_kernel, cross_power, col_kernel) - cross_power[:, 0, 0]
+    peak = np.abs(peak) / (height * width)
+    energy = np.sqrt(np.var(reference, axis=(-2, -1)) * np.var(moving, axis=(-2, -1))) * height * width
+    normalized = np.divide(peak, energy, out=np.zeros_like(peak), where=energy > 0)
+    return 1 - np.clip(normalized, 0, 1)**2
+
+
+def track_points(pyramid_current,
+                 pyramid_next,
+                 points,
+                 b_box_halfwidth,
+                 upsample_factor=250,
+                 predicted=None,
+                 return_error=False,
+                 **refine_kwargs,
+                 ):
+    '''
+    Track points from the current to the next plane
+    (coarse-to-fine, see module header). 
+    All points are processed together: patches are gathered in one go 
+    (see extract_patches()) and FFTs run over the whole batch.
+
+    Parameters
+    ----------
+    pyramid_current : list : image pyramid of current plane (see build_pyramid())
+    pyramid_next : list : image pyramid of next plane
+    points : np.array : N x 2 (row, col) positions of points in current plane
+    b_box_halfwidth : int : bounding box half width in (full resolution) pixels
+    upsample_factor : int : maximum upsampling factor for subpixel refinement
+    predicted : np.array : optional N x 2 (row, col) prediction of the positions in the next plane.
+                           The search boxes are placed around them instead of around `points`
+    return_error : bool : also return the correlation error of every point (see correlation_error())
+    **refine_kwargs : passed on to refine_shift()
+
+    Returns
+    -------
+    new_points : np.array : N x 2 (row, col) positions of points in next plane
+    errors : np.array : N correlation errors (only if `return_error`)
+    '''
+    points_int = np.round(np.reshape(points, (-1, 2))).astype(int)
+
+    # 1. Coarse - go from top of pyramid to level 1
+    # displacement estimate at full resolution
+    if predicted is None:
+        offsets = np.zeros_like(points_int)
+    else:
+        offsets = np.round(np.reshape(predicted, (-1, 2)) - points_int).astype(int)
+    for level in range(len(pyramid_current)-1, 0, -1):
+        factor = 2**level
+        centers_current = points_int // factor
+        centers_next    = (points_int + offsets) // factor
+        cross_power = _cross_power_spectrum(
+                            extract_patches(pyramid_current[level], centers_current, b_box_halfwidth),
+                            extract_patches(pyramid_next[level],    centers_next,    b_box_halfwidth),
+                            )
+        shifts = _integer_shift(cross_power)
+        offsets = ((centers_next - shifts - centers_current) * factor).astype(int)
+
+    # 2. Medium - integer search at full resolution around coarse estimate
+    centers_next = points_int + offsets
+    reference = extract_patches(pyramid_current[0], points_int,   b_box_halfwidth)
+    moving    = extract_patches(pyramid_next[0],    centers_next, b_box_halfwidth)
+    cross_power = _cross_power_spectrum(reference, moving)
+    shifts = _integer_shift(cross_power)
+
+    # 3. Fine - adaptive subpixel refinement
+    shifts, _ = refine_shift(cross_power, shifts, upsample_factor=upsample_factor, **refine_kwargs)
+
+    # Patches were centered on rounded positions - add back the subpixel part of `points`
+    new_points = centers_next - shifts + (np.reshape(points, (-1, 2)) - points_int)
+    if return_error:
+        return new_points, correlation_error(cross_power, shifts, reference, moving)
+    return new_points
+
+
+def track_point(pyramid_current,
+                pyramid_next,
+                point,
+                b_box_halfwidth,
+                upsample_factor=250,
+                predicted=None,
+                **refine_kwargs,
+                ):
+    '''
+    Track a single point from the current to the next plane
+    (see track_points())
+
+    Returns
+    -------
+    new_point : np.array : (row, col) position of point in next plane
+    '''
+    return track_points(pyramid_current,
+                        pyramid_next,
+                        point,
+                        b_box_halfwidth,
+                        upsample_factor=upsample_factor,
+                        predicted=predicted,
+                        **refine_kwargs,
+                        )[0]
+
+
+class PointPropagator:
+    '''
+    Incremental propagation of grid points through a stack of grid images
+
+    Keeps the positions of all points across all planes together with their
+    shift history (displacement relative to the plane each point was tracked from),
+    and which positions were set by the user ("anchors").
+    Search boxes are placed via a motion prediction across z, and after a user edit
+    only the edited point is re-tracked - and only up to the next anchor of that point.
+    Tracked points with a high correlation error or a displacement that disagrees with 
+    their neighbours are re-tracked with a larger box (see module header).
+
+    Parameters
+    ----------
+    grid_image : np.array : planes x height x width
+    b_box_halfwidth : int : bounding box half width in pixels
+    upsample_factor : int : maximum upsampling factor (see track_point())
+    pyramid_levels : int : number of pyramid levels for the coarse search (see build_pyramid())
+    prediction : str : 'none'   - search around the position in the previous plane
+                       'linear' - linear extrapolation from the last two planes
+                       'smooth' - quadratic fit across the last `history_length` planes
+    reference : str : 'anchor'   - correlate against the closest anchor plane of each point (default).
+                                   Errors do not accumulate along the chain
+                      'previous' - correlate against the previous plane (chained)
+    history_length : int : number of planes considered for 'smooth' prediction
+    max_error : float : maximum correlation error (see correlation_error()) of accepted points
+    max_deviation : float : maximum deviation (pixels) of the displacement of accepted points 
+                            from the median displacement of their neighbours
+    num_neighbours : int : number of nearest (lattice) neighbours for the consistency check
+    retry_factor : int : flagged points are re-tracked with a `retry_factor` x larger box
+    '''
+
+    # Arrays that make up the tracking state (see state())
+    STATE_ARRAYS = ('points', 'shifts', 'sources', 'anchors', 'errors', 'flagged')
+
+    def __init__(self,
+                 grid_image,
+                 b_box_halfwidth,
+                 upsample_factor = 250,
+                 pyramid_levels = 2,
+                 prediction = 'linear',
+                 reference = 'anchor',
+                 history_length = 5,
+                 max_error = MAX_ERROR,
+                 max_deviation = MAX_DEVIATION,
+                 num_neighbours = NUM_NEIGHBOURS,
+                 retry_factor = RETRY_FACTOR,
+                 ):
+        if prediction not in ['none', 'linear', 'smooth']:
+            raise NotImplementedError(f'Prediction "{prediction}" not implemented')
+        if reference not in ['previous', 'anchor']:
+            raise NotImplementedError(f'Reference "{reference}" not implemented')
+
+        self.grid_image = grid_image
+        self.num_planes = grid_image.shape[0]
+        self.b_box_halfwidth = int(b_box_halfwidth)
+        self.upsample_factor = upsample_factor
+        self.pyramid_levels = pyramid_levels
+        self.prediction = prediction
+        self.reference = reference
+        self.history_length = history_length
+        self.max_error = max_error
+        self.max_deviation = max_deviation
+        self.num_neighbours = num_neighbours
+        self.retry_factor = retry_factor
+
+        self.points  = None # planes x points x 2
+        self.shifts  = None # planes x points x 2 : shift relative to `sources`
+        self.sources = None # planes x points : plane index each point was tracked from (-1: anchor)
+        self.anchors = None # planes x points : bool, True for user defined positions
+        self.errors  = None # planes x points : correlation error (0 for anchors)
+        self.flagged = None # planes x points : bool, True for points that failed the checks twice
+        self._pyramids = {}
+
+    def _pyramid(self, plane_idx):
+        if plane_idx not in self._pyramids:
+            self._pyramids[plane_idx] = build_pyramid(self.grid_image[plane_idx, :, :], self.pyramid_levels)
+        return self._pyramids[plane_idx]
+
+    def _predict(self, plane_idx, start_idx, direction, point_indices):
+        '''
+        Predict positions in plane `plane_idx` from the planes already visited
+        on the way from `start_idx`
+        '''
+        last = self.points[plane_idx - direction, point_indices]
+        if self.prediction == 'none':
+            return last
+        history = [plane_idx - direction * step for step in range(1, self.history_length + 1)]
+        history = [idx for idx in history if (idx - start_idx) * direction >= 0]
+        if self.prediction == 'linear':
+            history = history[:2]
+        if len(history) < 2:
+            return last
+        positions = self.points[history][:, point_indices] # history x points x 2
+        deg = 1 if (self.prediction == 'linear' or len(history) < 4) else 2
+        coeffs = np.polyfit(history, positions.reshape(len(history), -1), deg)
+        return np.polyval(coeffs, plane_idx).reshape(-1, 2)
+
+    def _reference_plane(self, plane_idx, direction, point_idx):
+        '''
+        Plane index to correlate against for a point tracked into `plane_idx`
+        '''
+        previous = plane_idx - direction
+        if self.reference == 'previous':
+            return previous
+        idx = previous
+        while not self.anchors[idx, point_idx]:
+            idx -= direction
+        return idx
+
+    def _track(self, start_idx, direction, point_indices):
+        '''
+        Track `point_indices` from plane `start_idx` outwards in `direction` (+1 / -1),
+        stopping for every point at its next anchor
+        '''
+        point_indices = np.asarray(point_indices)
+        idx = start_idx + direction
+        while len(point_indices) and (0 <= idx < self.num_planes):
+            # Do not overwrite user defined positions
+            point_indices = point_indices[~self.anchors[idx, point_indices]]
+            if not len(point_indices):
+                break
+            predicted = self._predict(idx, start_idx, direction, point_indices)
+            ref_planes = np.array([self._reference_plane(idx, direction, point_idx) 
+                                   for point_idx in point_indices])
+            self._track_batches(idx, point_indices, ref_planes, predicted, self.b_box_halfwidth)
+            self._reject_outliers(idx, direction, point_indices, ref_planes)
+            idx += direction
+
+    def _track_batches(self, idx, point_indices, ref_planes, predicted, b_box_halfwidth):
+        '''
+        Track `point_indices` into plane `idx` - one batch per reference plane
+        '''
+        for ref_idx in np.unique(ref_planes):
+            in_batch = ref_planes == ref_idx
+            batch = point_indices[in_batch]
+            new_points, errors = track_points(self._pyramid(ref_idx),
+                                              self._pyramid(idx),
+                                              self.points[ref_idx, batch],
+                                              b_box_halfwidth,
+                                              upsample_factor=self.upsample_factor,
+                                              predicted=predicted[in_batch],
+                                              return_error=True,
+                                              )
+            self.points[idx, batch]  = new_points
+            self.shifts[idx, batch]  = new_points - self.points[ref_idx, batch]
+            self.sources[idx, batch] = ref_idx
+            self.errors[idx, batch]  = errors
+
+    def _neighbour_displacements(self, idx, direction, point_indices):
+        '''
+        Displacement of `point_indices` from the previously visited plane into plane `idx`,
+        and the median displacement of their nearest neighbours (in the previous plane)
+        '''
+        previous = self.points[idx - direction]
+        displacements = self.points[idx] - previous
+        num_neighbours = min(self.num_neighbours, len(previous) - 1)
+        if num_neighbours < 1:
+            return displacements[point_indices], displacements[point_indices]
+        # First neighbour is the point itself
+        _, neighbours = cKDTree(previous).query(previous[point_indices], k=num_neighbours + 1)
+        expected = np.median(displacements[neighbours[:, 1:]], axis=1)
+        return displacements[point_indices], expected
+
+    def _reject_outliers(self, idx, direction, point_indices, ref_planes):
+        '''
+        Check the points just tracked into plane `idx` (correlation error and consistency 
+        with their neighbours) and re-track only the ones that fail, with a larger box 
+        placed at the position predicted from their neighbours
+        '''
+        self.flagged[idx, point_indices] = False
+        displacements, expected = self._neighbour_displacements(idx, direction, point_indices)
+        deviation = np.linalg.norm(displacements - expected, axis=-1)
+        failed = (self.errors[idx, point_indices] > self.max_error) | (deviation > self.max_deviation)
+        if not failed.any():
+            return
+        retry = point_indices[failed]
+        predicted = self.points[idx - direction, retry] + expected[failed]
+        first_errors = self.errors[idx, retry].copy()
+        self._track_batches(idx, retry, ref_planes[failed], predicted, self.b_box_halfwidth * self.retry_factor)
+
+        displacements, expected = self._neighbour_displacements(idx, direction, retry)
+        deviation = np.linalg.norm(displacements - expected, axis=-1)
+        still_failed = (self.errors[idx, retry] > self.max_error) | (deviation > self.max_deviation)
+        if still_failed.any():
+            # Fall back to the neighbour prediction (keeping the error of the first attempt on record)
+            lost = retry[still_failed]
+            self.points[idx, lost]  = predicted[still_failed]
+            self.shifts[idx, lost]  = predicted[still_failed] - self.points[self.sources[idx, lost], lost]
+            self.errors[idx, lost]  = first_errors[still_failed]
+            self.flagged[idx, lost] = True
+        print(f'Plane {idx}: re-tracked {len(retry)} outlier(s), '
+              f'{np.sum(still_failed)} set from neighbours (flagged)')
+
+    def propagate(self, plane_idx, grid_points):
+        '''
+        Propagate a full set of user defined points from plane `plane_idx`
+        throughout the stack (discards all previous results)
+
+        Parameters
+        ----------
+        plane_idx : int : plane index that `grid_points` were collected from
+        grid_points : np.array : points x 2
+
+        Returns
+        -------
+        points : np.array : planes x points x 2
+        '''
+        grid_points = np.asarray(grid_points, dtype=float)
+        num_points = len(grid_points)
+        self.points  = np.full((self.num_planes, num_points, 2), np.nan)
+        self.shifts  = np.zeros((self.num_planes, num_points, 2))
+        self.sources = np.full((self.num_planes, num_points), -1, dtype=int)
+        self.anchors = np.zeros((self.num_planes, num_points), dtype=bool)
+        self.errors  = np.zeros((self.num_planes, num_points))
+        self.flagged = np.zeros((self.num_planes, num_points), dtype=bool)
+
+        self.points[plane_idx]  = grid_points
+        self.anchors[plane_idx] = True
+        for direction in [1, -1]:
+            self._track(plane_idx, direction, np.arange(num_points))
+        return self.points
+
+    def update(self, plane_idx, point_indices, positions):
+        '''
+        Incorporate user corrections of points in plane `plane_idx`.
+        The corrected positions become anchors, and only the corrected points are
+        re-tracked - outwards from `plane_idx` until they hit their next anchor.
+
+        Parameters
+        ----------
+        plane_idx : int : plane index of corrected points
+        point_indices : list or np.array : indices of corrected points
+        positions : np.array : len(point_indices) x 2 corrected positions
+
+        Returns
+        -------
+        points : np.array : planes x points x 2
+        '''
+        if self.points is None:
+            raise ValueError('Nothing to update - run propagate() first')
+        point_indices = np.atleast_1d(point_indices).astype(int)
+        self.points[plane_idx, point_indices]  = np.reshape(positions, (-1, 2))
+        self.shifts[plane_idx, point_indices]  = 0
+        self.sources[plane_idx, point_indices] = -1
+        self.anchors[plane_idx, point_indices] = True
+        self.errors[plane_idx, point_indices]  = 0
+        self.flagged[plane_idx, point_indices] = False
+        for direction in [1, -1]:
+            self._track(plane_idx, direction, point_indices)
+        return self.points
+
+    def as_dict(self):
+        '''
+        Points as dictionary (keys are plane indices) - see propagate_cross_corr()
+        '''
+        return OrderedDict((idx, self.points[idx]) for idx in range(self.num_planes))
+
+    def state(self):
+        '''
+        Parameters and tracking results (JSON serializable parameters and arrays),
+        to restore the propagator with from_state() without tracking again
+
+        Returns
+        -------
+        parameters : dict
+        arrays : dict : STATE_ARRAYS (None before propagate())
+        '''
+        parameters = {
+            'b_box_halfwidth' : self.b_box_halfwidth,
+            'upsample_factor' : self.upsample_factor,
+            'pyramid_levels'  : self.pyramid_levels,
+            'prediction'      : self.prediction,
+            'reference'       : self.reference,
+            'history_length'  : self.history_length,
+            'max_error'       : self.max_error,
+            'max_deviation'   : self.max_deviation,
+            'num_neighbours'  : self.num_neighbours,
+            'retry_factor'    : self.retry_factor,
+        }
+        arrays = {name: getattr(self, name) for name in self.STATE_ARRAYS}
+        return parameters, arrays
+
+    @classmethod
+    def from_state(cls, grid_image, parameters, arrays):
+        '''
+        Restore a propagator from state() output (arrays are copied)
+        '''
+        propagator = cls(grid_image, **parameters)
+        for name in cls.STATE_ARRAYS:
+            if arrays.get(name) is not None:
+                setattr(propagator, name, np.array(arrays[name]))
+        # Sessions saved before outlier rejection existed
+        if (propagator.points is not None) and (propagator.errors is None):
+            propagator.errors = np.zeros(propagator.anchors.shape)
+            propagator.flagged = np.zeros(propagator.anchors.shape, dtype=bool)
+        return propagator
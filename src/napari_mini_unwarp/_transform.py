@@ -0,0 +1,303 @@
+### TRANSFORM API
+# Stateful thin plate spline transform, built from the pieces in _unwarp.py,
+# that can be refitted incrementally when only a few landmarks move.
+#
+# - Moved to_points only change the right-hand side of the TPS system,
+#   so coefficients are re-solved against the cached inverse of L (O(N * k) for k moved points).
+# - Moved from_points change k rows / columns of L. This is a rank 2k update of L,
+#   and the cached inverse is updated via the Woodbury identity (O(N**2 * k)) instead of
+#   being recomputed from scratch (O(N**3)).
+# - Previously evaluated coordinate maps can be updated in place (update_map()).
+#   The change of the map is first evaluated on a coarse grid of blocks, and only blocks
+#   where it exceeds a tolerance (plus their direct neighbours) are re-evaluated at full resolution.
+#
+# Note that for unwarping, the transform is fitted in reverse (see _make_inverse_warp()):
+# from the standard grid (from_points) to the user defined points (to_points).
+# Dragging user points therefore only changes to_points.
+#
+# UnwarpTransform maps points (ROI centroids, contours, ...) between the original and the 
+# unwarped image directly, without warping label images:
+# - inverse() (unwarped -> original) evaluates the reverse TPS that is used for resampling.
+# - forward() (original -> unwarped) inverts that TPS with a vectorized Newton iteration
+#   (analytic Jacobian), starting from a TPS fitted in the forward direction.
+#   This makes forward() the exact inverse of inverse(), i.e. consistent with the unwarped image.
+#
+import numpy as np
+
+from ._unwarp import _U, _L_inverse, _calculate_f
+from ._kernels import tps_points
+
+
+class ThinPlateSpline:
+    '''
+    Thin plate spline transform mapping `from_points` onto `to_points`
+
+    Parameters
+    ----------
+    from_points : np.array : N x 2 landmarks
+    to_points : np.array : N x 2 landmarks
+    max_updates : int : number of low-rank updates of the cached inverse after which
+                        it is recomputed from scratch (limits accumulation of round-off errors)
+    '''
+
+    def __init__(self, from_points, to_points, max_updates=50):
+        self.max_updates = max_updates
+        self.fit(from_points, to_points)
+
+    def fit(self, from_points, to_points):
+        '''
+        (Re-)fit the transform from scratch
+        '''
+        self.from_points = np.array(from_points, dtype=float)
+        self.to_points   = np.array(to_points, dtype=float)
+        if self.from_points.shape != self.to_points.shape:
+            raise ValueError(f'Landmark shapes do not match: {self.from_points.shape} vs. {self.to_points.shape}')
+        err = np.seterr(divide='ignore', invalid='ignore')
+        # Shared with warp_images() - never modified in place
+        self.L_inv = _L_inverse(self.from_points)
+        np.seterr(**err)
+        self.coeffs = self.L_inv @ self._rhs()
+        self._num_updates = 0
+        self._pending = [] # (centers, coeffs) of changes not yet applied to a map (see update_map())
+        return self
+
+    def _rhs(self):
+        V = np.zeros((len(self.to_points)+3, 2))
+        V[:-3] = self.to_points
+        return V
+
+    def evaluate(self, x, y):
+        '''
+        Evaluate the transform at coordinates `x`, `y` (arrays of any, but equal, shape)
+
+        Returns
+        -------
+        [x_warp, y_warp] : list of np.arrays
+        '''
+        err = np.seterr(divide='ignore', invalid='ignore')
+        warped = [_calculate_f(self.coeffs[:, 0], self.from_points, x, y),
+                  _calculate_f(self.coeffs[:, 1], self.from_points, x, y)]
+        np.seterr(**err)
+        return warped
+
+    def update(self, indices, from_points=None, to_points=None):
+        '''
+        Move a subset of landmarks and refit incrementally
+
+        Parameters
+        ----------
+        indices : list or np.array : indices of moved landmarks
+        from_points : np.array : optional len(indices) x 2 new from_points
+        to_points : np.array : optional len(indices) x 2 new to_points
+
+        Returns
+        -------
+        self
+        '''
+        indices = np.atleast_1d(indices).astype(int)
+        old_coeffs = self.coeffs.copy()
+        old_centers = self.from_points[indices].copy()
+
+        if to_points is not None:
+            to_points = np.reshape(to_points, (-1, 2))
+            delta_V = to_points - self.to_points[indices]
+            self.to_points[indices] = to_points
+            # Only the right-hand side changes
+            self.coeffs = self.coeffs + self.L_inv[:, indices] @ delta_V
+
+        if from_points is not None:
+            from_points = np.reshape(from_points, (-1, 2))
+            old_cols = self._L_columns(indices)
+            self.from_points[indices] = from_points
+            if self._num_updates >= self.max_updates:
+                pending = self._pending
+                self.fit(self.from_points, self.to_points)
+                self._pending = pending
+            else:
+                self._update_inverse(indices, self._L_columns(indices) - old_cols)
+                self.coeffs = self.L_inv @ self._rhs()
+                self._num_updates += 1
+
+        # Record change for update_map() as kernel weights for a set of centers followed by the affine part.
+        # If from_points moved, the old kernels of the moved centers are subtracted explicitly
+        delta = self.coeffs - old_coeffs
+        if from_points is not None:
+            centers = np.concatenate([self.from_points, old_centers])
+            coeffs  = np.concatenate([delta[:-3], -old_coeffs[indices], delta[-3:]])
+            coeffs[indices] = self.coeffs[indices]
+        else:
+            centers, coeffs = self.from_points.copy(), delta
+        self._pending.append((centers, coeffs))
+        return self
+
+    def _L_columns(self, indices):
+        '''
+        Columns `indices` of L (see _make_L_matrix())
+        '''
+        n = len(self.from_points)
+        distances = np.sqrt(((self.from_points[:, np.newaxis, :] 
+                              - self.from_points[indices][np.newaxis])**2).sum(axis=-1))
+        err = np.seterr(divide='ignore', invalid='ignore')
+        columns = np.zeros((n+3, len(indices)))
+        columns[:n]   = _U(distances)
+        columns[n]    = 1
+        columns[n+1:] = self.from_points[indices].T
+        np.seterr(**err)
+        return columns
+
+    def _update_inverse(self, indices, A):
+        '''
+        Woodbury update of L_inv after from_points[indices] moved.
+
+        The change of L (Delta) is symmetric and only non-zero in rows / columns `indices`:
+        Delta = E A.T + A E.T - E A_SS E.T, with E the columns `indices` of the identity,
+        A = Delta[:, indices] and A_SS = A[indices].
+        '''
+        n, k = len(self.L_inv), len(indices)
+        E = np.zeros((n, k))
+        E[indices, np.arange(k)] = 1
+        U = np.concatenate([E, A], axis=1)                 # n x 2k
+        C_inv = np.block([[np.zeros((k, k)), np.eye(k)  ],
+                          [np.eye(k),        A[indices] ]]) # inverse of [[-A_SS, I], [I, 0]]
+        L_inv_U = self.L_inv @ U
+        inner = C_inv + U.T @ L_inv_U
+        self.L_inv = self.L_inv - L_inv_U @ np.linalg.solve(inner, L_inv_U.T)
+
+    def update_map(self, transform, x, y, tolerance=0.01, block=16):
+        '''
+        Apply all changes since the last call to a previously evaluated coordinate map (in place).
+
+        The change of the map is evaluated on the corners of `block` x `block` pixel tiles first.
+        Only tiles where it exceeds `tolerance` (and their direct neighbours) are re-evaluated.
+
+        Parameters
+        ----------
+        transform : list : [x_warp, y_warp] as returned by evaluate(x, y)
+        x, y : np.array : 2D coordinate grids the map was evaluated on
+        tolerance : float : changes below this value (in output units) are ignored
+        block : int : tile size in pixels
+
+        Returns
+        -------
+        fraction : float : fraction of map pixels that were re-evaluated
+        '''
+        if not self._pending:
+            return 0.
+        centers = np.concatenate([c for c, _ in self._pending])
+        # Affine parts of all pending changes can simply be summed up
+        kernel_coeffs = np.concatenate([coeffs[:-3] for _, coeffs in self._pending])
+        affine = np.sum([coeffs[-3:] for _, coeffs in self._pending], axis=0)
+        coeffs = np.concatenate([kernel_coeffs, affine])
+        self._pending = []
+
+        err = np.seterr(divide='ignore', invalid='ignore')
+        # 1. Coarse check on tile corners
+        rows = np.unique(np.r_[np.arange(0, x.shape[0], block), x.shape[0]-1])
+        cols = np.unique(np.r_[np.arange(0, x.shape[1], block), x.shape[1]-1])
+        x_c, y_c = x[np.ix_(rows, cols)], y[np.ix_(rows, cols)]
+        change = np.maximum(np.abs(_calculate_f(coeffs[:, 0], centers, x_c, y_c)),
+                            np.abs(_calculate_f(coeffs[:, 1], centers, x_c, y_c)))
+        corners = change > tolerance
+        # A tile is affected if any of its corners is - dilate by one tile for safety
+        tiles = corners[:-1, :-1] | corners[1:, :-1] | corners[:-1, 1:] | corners[1:, 1:]
+        dilated = tiles.copy()
+        dilated[1:]  |= tiles[:-1]
+        dilated[:-1] |= tiles[1:]
+        dilated[:, 1:]  |= dilated[:, :-1].copy()
+        dilated[:, :-1] |= dilated[:, 1:].copy()
+
+        # 2. Full resolution re-evaluation of affected tiles only
+        tile_rows = np.minimum(np.arange(x.shape[0]) // block, dilated.shape[0]-1)
+        tile_cols = np.minimum(np.arange(x.shape[1]) // block, dilated.shape[1]-1)
+        mask = dilated[np.ix_(tile_rows, tile_cols)]
+        if mask.any():
+            x_m, y_m = x[mask], y[mask]
+            transform[0][mask] += _calculate_f(coeffs[:, 0], centers, x_m, y_m)
+            transform[1][mask] += _calculate_f(coeffs[:, 1], centers, x_m, y_m)
+        np.seterr(**err)
+        return mask.mean()
+
+
+class UnwarpTransform:
+    '''
+    Point mapping between the original and the unwarped image, consistent with unwarp()
+
+    Parameters
+    ----------
+    usr_dots : np.array : user defined grid points (points x 2)
+    grid_dots : np.array : standard grid points (points x 2)
+    image_shape : tuple : shape of the (2D) grid image. If given, coordinates in the unwarped image
+                          are pixel indices of the output of unwarp(), whose output grid 
+                          spans [0, shape] in shape steps (see _make_inverse_warp()).
+                          If None, coordinates are TPS coordinates.
+    tolerance : float : convergence tolerance of forward() (pixels)
+    max_iterations : int : maximum number of Newton iterations in forward()
+    '''
+
+    def __init__(self, usr_dots, grid_dots, image_shape=None, tolerance=1e-6, max_iterations=20):
+        # Used for resampling (unwarped -> original), see _make_inverse_warp()
+        self.reverse_tps = ThinPlateSpline(grid_dots, usr_dots)
+        # Starting point for the Newton iteration in forward() 
+        self.forward_tps = ThinPlateSpline(usr_dots, grid_dots)
+        if image_shape is None:
+            self.scale = np.ones(2)
+        else:
+            shape = np.asarray(image_shape[-2:], dtype=float)
+            self.scale = shape / (shape - 1)
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def inverse(self, points):
+        '''
+        Map points from the unwarped into the original image
+
+        Parameters
+        ----------
+        points : np.array : M x 2 (row, col) coordinates in the unwarped image
+
+        Returns
+        -------
+        mapped : np.array : M x 2 (row, col) coordinates in the original image
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return tps_points(self.reverse_tps.coeffs, self.reverse_tps.from_points, points * self.scale)
+
+    def forward(self, points):
+        '''
+        Map points from the original into the unwarped image
+
+        Parameters
+        ----------
+        points : np.array : M x 2 (row, col) coordinates in the original image
+
+        Returns
+        -------
+        mapped : np.array : M x 2 (row, col) coordinates in the unwarped image.
+                            NaN for points where the iteration did not converge
+                            (e.g. where the warp folds over itself)
+        '''
+        targets = np.asarray(points, dtype=float).reshape(-1, 2)
+        coeffs, centers = self.reverse_tps.coeffs, self.reverse_tps.from_points
+        estimate = tps_points(self.forward_tps.coeffs, self.forward_tps.from_points, targets)
+        active = np.arange(len(targets))
+        for _ in range(self.max_iterations):
+            values, jac = tps_points(coeffs, centers, estimate[active], jacobian=True)
+            residual = values - targets[active]
+            converged = np.abs(residual).max(axis=1) < self.tolerance
+            active, residual, jac = active[~converged], residual[~converged], jac[~converged]
+            if not len(active):
+                break
+            # Newton step: solve the 2 x 2 systems jac @ step = residual
+            det = jac[:, 0, 0] * jac[:, 1, 1] - jac[:, 0, 1] * jac[:, 1, 0]
+            step_x = ( jac[:, 1, 1] * residual[:, 0] - jac[:, 0, 1] * residual[:, 1]) / det
+            step_y = (-jac[:, 1, 0] * residual[:, 0] + jac[:, 0, 0] * residual[:, 1]) / det
+            estimate[active, 0] -= step_x
+            estimate[active, 1] -= step_y
+        else:
+            # Check the last step
+            residual = tps_points(coeffs, centers, estimate[active]) - targets[active]
+            active = active[~(np.abs(residual).max(axis=1) < self.tolerance)]
+        if len(active):
+            print(f'{len(active)} point(s) did not converge')
+            estimate[active] = np.nan
+        return estimate / self.scale
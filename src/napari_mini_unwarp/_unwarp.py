@@ -15,10 +15,19 @@
 # Until this is finished I am taking Zachary's code as is and build around it. 
 
 
+from collections import OrderedDict
+import threading
 from scipy import ndimage
 import numpy
 
-def warp_images(from_points, to_points, images, output_region, interpolation_order = 1, approximate_grid=2):
+from ._piecewise import make_piecewise_affine_warp
+from ._rbf import make_wendland_warp
+from ._polynomial import make_polynomial_warp, select_polynomial_model
+from ._kernels import tps_warp
+from ._tiling import run_tiles, sample_tile
+
+def warp_images(from_points, to_points, images, output_region, interpolation_order = 1, approximate_grid=2, method='tps',
+                tile_size=None, out=None, workers=1, output_dtype=None, label_channels=None, precision='float64'):
     """Define a thin-plate-spline warping transform that warps from the from_points
     to the to_points, and then warp the given images by that transform. This
     transform is described in the paper: "Principal Warps: Thin-Plate Splines and
@@ -26,7 +35,10 @@ def warp_images(from_points, to_points, images, output_region, interpolation_ord
 
     Parameters:
         - from_points and to_points: Nx2 arrays containing N 2D landmark points.
-        - images: list of images to warp with the given warp transform.
+        - images: list of images to warp with the given warp transform, or a 
+                (channels x rows x cols) array. Channels of an array are warped in one batch:
+                interpolation indices and weights are computed once and shared by all 
+                channels (see gather_channels() in _kernels.py), and the result is an array as well.
         - output_region: the (xmin, ymin, xmax, ymax) region of the output
                 image that should be produced. (Note: The region is inclusive, i.e.
                 xmin <= x <= xmax)
@@ -37,44 +49,217 @@ def warp_images(from_points, to_points, images, output_region, interpolation_ord
                 times smaller than the output image region, and then the transform is
                 bilinearly interpolated to the larger region. This is fairly accurate
                 for values up to 10 or so.
+        - method: warping backend, one of WARP_METHODS. 'tps' (thin plate spline, default),
+                'piecewise_affine' (Delaunay triangulation of the landmarks, see _piecewise.py),
+                'wendland' (compactly supported RBF for dense grids, see _rbf.py),
+                'polynomial' (least squares 2D polynomial, see _polynomial.py) or
+                'auto' (polynomial if its residual is small enough, TPS otherwise).
+        - tile_size: if given, the output is computed in tiles of (at most) tile_size x tile_size
+                pixels, and only the part of the source image a tile maps to is read (see _tiling.py).
+                Peak memory is then bounded by the tile size. The result is the same as without tiling.
+        - out: optional list of preallocated output arrays (one per image), for example
+                memory mapped arrays (numpy.lib.format.open_memmap). Shape: see output_shape().
+                For a (channels x rows x cols) input, a single channels x output_shape() array.
+        - workers: number of threads that process tiles in parallel (only with tile_size).
+        - output_dtype: dtype of the (newly allocated) outputs. Default: same as the input image.
+                If `out` is given as well, its dtype has to match.
+                Integer outputs are rounded and clipped to the range of the dtype.
+        - label_channels: indices of images / channels that contain labels or masks. These are
+                always sampled with nearest-neighbor interpolation.
+        - precision: 'float64' (default) or 'float32' (see PRECISIONS). With 'float32', the 
+                coordinate maps are evaluated and the images resampled in single precision, 
+                which halves memory traffic and temporaries. The landmark fit itself stays in 
+                double precision. Coordinates deviate by less than 0.02 pixels from 'float64'
+                for images up to 4096 x 4096 (see test_float32_precision()).
+                The fused TPS path (linear interpolation, approximate_grid 1) never holds the 
+                coordinate maps and is the same for both.
     """
-    transform = _make_inverse_warp(from_points, to_points, output_region, approximate_grid)
-    return [ndimage.map_coordinates(numpy.asarray(image), transform, order=interpolation_order) for image in images]
+    if method not in WARP_METHODS:
+        raise ValueError(f'Unknown warping method "{method}". Choose from {list(WARP_METHODS)}')
+    dtype = _precision_dtype(precision)
+    batched = isinstance(images, numpy.ndarray) and (images.ndim == 3)
+    if not batched:
+        images = [numpy.asarray(image) for image in images] # no copy for (memory mapped) arrays
+    labels = numpy.zeros(len(images), dtype=bool)
+    if label_channels is not None:
+        labels[numpy.asarray(label_channels, dtype=int)] = True
+    orders = [0 if label else interpolation_order for label in labels]
+    shape = output_shape(output_region, approximate_grid)
+    if out is None:
+        dtypes = [image.dtype if output_dtype is None else output_dtype for image in images]
+        if batched:
+            out = numpy.empty((len(images),) + shape, dtype=dtypes[0])
+        else:
+            out = [numpy.empty(shape, dtype=dtype) for dtype in dtypes]
+    for o in out:
+        if o.shape != shape:
+            raise ValueError(f'Output shape {o.shape} does not match {shape}')
+        if (output_dtype is not None) and (o.dtype != numpy.dtype(output_dtype)):
+            raise ValueError(f'Output dtype {o.dtype} does not match output_dtype {numpy.dtype(output_dtype)}')
+
+    # Integer outputs need rounding and clipping, unless linear / nearest neighbour interpolation 
+    # stays within the range of the same integer input dtype. The image is then sampled
+    # into a float buffer first - one tile at a time, so that the buffer stays small.
+    convert = [numpy.issubdtype(o.dtype, numpy.integer) 
+               and not ((image.dtype == o.dtype) and (order <= 1)) 
+               for image, o, order in zip(images, out, orders)]
+    if (any(convert) or batched) and tile_size is None:
+        tile_size = BUFFER_TILE_SIZE
+
+    # For linear interpolation of the exact TPS, the transform is evaluated and the image sampled 
+    # in one pass, without materializing the full coordinate map (see _kernels.py)
+    fused = [(method == 'tps') and (order == 1) and (approximate_grid in (None, 1)) and not batched
+             for order in orders]
+    if any(fused):
+        coeffs, x_axis, y_axis = _fused_tps_setup(from_points, to_points, output_region)
+
+    def warp_tile(rows, cols):
+        tile = (slice(*rows), slice(*cols))
+        tile_shape = (rows[1]-rows[0], cols[1]-cols[0])
+        if not all(fused):
+            transform = _make_inverse_warp(from_points, to_points, output_region, approximate_grid, method, 
+                                           rows=rows, cols=cols, precision=precision)
+        if batched:
+            target = numpy.empty((len(images),) + tile_shape, dtype=dtype) if any(convert) else out[(slice(None),) + tile]
+            if interpolation_order <= 1:
+                sample_tile(images, transform, interpolation_order, target, labels=labels)
+            else:
+                for channel, order in enumerate(orders):
+                    sample_tile(images[channel], transform, order, target[channel])
+            if any(convert):
+                _convert(target, out[(slice(None),) + tile])
+            return
+        for image, o, conv, order, fuse in zip(images, out, convert, orders, fused):
+            target = numpy.empty(tile_shape, dtype=dtype) if conv else o[tile]
+            if fuse:
+                tps_warp(image, coeffs, to_points, x_axis[tile[0]], y_axis[tile[1]], out=target)
+            elif tile_size is None:
+                ndimage.map_coordinates(image, transform, order=order, output=target)
+            else:
+                sample_tile(image, transform, order, target)
+            if conv:
+                _convert(target, o[tile])
+
+    if tile_size is None:
+        warp_tile((0, shape[0]), (0, shape[1]))
+    else:
+        run_tiles(shape, tile_size, warp_tile, workers=workers)
+    return out
+
+# Tile size used for buffered output conversion and batched channels if no tile_size is given
+BUFFER_TILE_SIZE = 512
+
+def _convert(values, out):
+    # round and clip float values into an integer array. 
+    # Rounds half away from zero, like ndimage for integer outputs (and the kernels in _kernels.py)
+    info = numpy.iinfo(out.dtype)
+    out[...] = numpy.clip(numpy.trunc(values + numpy.copysign(.5, values)), info.min, info.max)
+
+def apply_transform(image, transform, interpolation_order=1, precision='float64', output_dtype=None, out=None):
+    # Resample `image` through a precomputed transform (as returned by _make_inverse_warp()),
+    # e.g. a cached or stored map. The result has the dtype of `image` (integers rounded and clipped), 
+    # or `output_dtype`, and is written into `out` if given (see warp_images()).
+    # `precision` is the dtype of the interpolated values (see warp_images()).
+    shape = numpy.shape(transform[0])
+    if out is None:
+        out = numpy.empty(shape, dtype=image.dtype if output_dtype is None else output_dtype)
+    if out.shape != shape:
+        raise ValueError(f'Output shape {out.shape} does not match {shape}')
+    if (output_dtype is not None) and (out.dtype != numpy.dtype(output_dtype)):
+        raise ValueError(f'Output dtype {out.dtype} does not match output_dtype {numpy.dtype(output_dtype)}')
+    values = ndimage.map_coordinates(image, transform, order=interpolation_order, output=_precision_dtype(precision))
+    if numpy.issubdtype(out.dtype, numpy.integer):
+        _convert(values, out)
+    else:
+        out[...] = values
+    return out
 
-def _make_inverse_warp(from_points, to_points, output_region, approximate_grid):
+def output_shape(output_region, approximate_grid):
+    """Shape of the output of warp_images() for the given output_region and approximate_grid."""
+    x_min, y_min, x_max, y_max = output_region
+    if approximate_grid in (None, 1):
+        return (x_max - x_min, y_max - y_min)
+    return (x_max - x_min + 1, y_max - y_min + 1)
+
+def _make_inverse_warp(from_points, to_points, output_region, approximate_grid, method='tps', rows=None, cols=None,
+                       precision='float64'):
+    # rows / cols are optional (start, stop) ranges of the output grid (see output_shape()), 
+    # so that the transform can be computed tile by tile (see warp_images()). 
+    # With approximate_grid > 1, only the nodes of the coarse grid that are needed for the 
+    # requested range are evaluated, so tiles give the same result as the full grid.
+    # The grid (and with it the evaluation of the transform) has the dtype given by `precision`. 
+    # Backends that only evaluate in double precision are cast afterwards.
+    if method not in WARP_METHODS:
+        raise ValueError(f'Unknown warping method "{method}". Choose from {list(WARP_METHODS)}')
+    dtype = _precision_dtype(precision)
     x_min, y_min, x_max, y_max = output_region
     if approximate_grid is None: approximate_grid = 1
     x_steps = (x_max - x_min) // approximate_grid
     y_steps = (y_max - y_min) // approximate_grid
-    x, y = numpy.mgrid[x_min:x_max:x_steps*1j, y_min:y_max:y_steps*1j]
-
-    # make the reverse transform warping from the to_points to the from_points, because we
-    # do image interpolation in this reverse fashion
-    transform = _make_warp(to_points, from_points, x, y)
-
-    if approximate_grid != 1:
-        # linearly interpolate the zoomed transform grid
-        new_x, new_y = numpy.mgrid[x_min:x_max+1, y_min:y_max+1]
-        x_fracs, x_indices = numpy.modf((x_steps-1)*(new_x-x_min)/float(x_max-x_min))
-        y_fracs, y_indices = numpy.modf((y_steps-1)*(new_y-y_min)/float(y_max-y_min))
-        x_indices = x_indices.astype(int)
-        y_indices = y_indices.astype(int)
-        x1 = 1 - x_fracs
-        y1 = 1 - y_fracs
-        ix1 = (x_indices+1).clip(0, x_steps-1)
-        iy1 = (y_indices+1).clip(0, y_steps-1)
-        t00 = transform[0][(x_indices, y_indices)]
-        t01 = transform[0][(x_indices, iy1)]
-        t10 = transform[0][(ix1, y_indices)]
-        t11 = transform[0][(ix1, iy1)]
-        transform_x = t00*x1*y1 + t01*x1*y_fracs + t10*x_fracs*y1 + t11*x_fracs*y_fracs
-        t00 = transform[1][(x_indices, y_indices)]
-        t01 = transform[1][(x_indices, iy1)]
-        t10 = transform[1][(ix1, y_indices)]
-        t11 = transform[1][(ix1, iy1)]
-        transform_y = t00*x1*y1 + t01*x1*y_fracs + t10*x_fracs*y1 + t11*x_fracs*y_fracs
-        transform = [transform_x, transform_y]
-    return transform
+    x_coarse = numpy.linspace(x_min, x_max, x_steps).astype(dtype, copy=False)
+    y_coarse = numpy.linspace(y_min, y_max, y_steps).astype(dtype, copy=False)
+    shape = output_shape(output_region, approximate_grid)
+    r0, r1 = rows if rows is not None else (0, shape[0])
+    c0, c1 = cols if cols is not None else (0, shape[1])
+
+    if approximate_grid == 1:
+        # make the reverse transform warping from the to_points to the from_points, because we
+        # do image interpolation in this reverse fashion
+        return _evaluate_grid(method, to_points, from_points, x_coarse, y_coarse, (r0, r1), (c0, c1), dtype)
+
+    # linearly interpolate the zoomed transform grid
+    new_x = numpy.arange(x_min + r0, x_min + r1)[:, numpy.newaxis]
+    new_y = numpy.arange(y_min + c0, y_min + c1)[numpy.newaxis, :]
+    x_fracs, x_indices = numpy.modf((x_steps-1)*(new_x-x_min)/float(x_max-x_min))
+    y_fracs, y_indices = numpy.modf((y_steps-1)*(new_y-y_min)/float(y_max-y_min))
+    x_indices = x_indices.astype(int)
+    y_indices = y_indices.astype(int)
+    x_fracs, y_fracs = x_fracs.astype(dtype, copy=False), y_fracs.astype(dtype, copy=False)
+    # coarse grid nodes needed for this range
+    i0, i1 = x_indices.min(), min(x_indices.max() + 2, x_steps)
+    j0, j1 = y_indices.min(), min(y_indices.max() + 2, y_steps)
+    transform = _evaluate_grid(method, to_points, from_points, x_coarse, y_coarse, (i0, i1), (j0, j1), dtype)
+    x_indices = x_indices - i0
+    y_indices = y_indices - j0
+
+    x1 = 1 - x_fracs
+    y1 = 1 - y_fracs
+    ix1 = (x_indices+1).clip(0, i1-i0-1)
+    iy1 = (y_indices+1).clip(0, j1-j0-1)
+    t00 = transform[0][(x_indices, y_indices)]
+    t01 = transform[0][(x_indices, iy1)]
+    t10 = transform[0][(ix1, y_indices)]
+    t11 = transform[0][(ix1, iy1)]
+    transform_x = t00*x1*y1 + t01*x1*y_fracs + t10*x_fracs*y1 + t11*x_fracs*y_fracs
+    t00 = transform[1][(x_indices, y_indices)]
+    t01 = transform[1][(x_indices, iy1)]
+    t10 = transform[1][(ix1, y_indices)]
+    t11 = transform[1][(ix1, iy1)]
+    transform_y = t00*x1*y1 + t01*x1*y_fracs + t10*x_fracs*y1 + t11*x_fracs*y_fracs
+    return [transform_x, transform_y]
+
+def _evaluate_grid(method, from_points, to_points, x_axis, y_axis, rows, cols, dtype):
+    # Evaluate a backend on the (rows, cols) range of the grid spanned by x_axis, y_axis.
+    # The piecewise affine backend caches its triangle-index map for the full grid 
+    # and slices the range from it (see _piecewise.py)
+    x, y = numpy.meshgrid(x_axis[slice(*rows)], y_axis[slice(*cols)], indexing='ij')
+    if method == 'piecewise_affine':
+        transform = make_piecewise_affine_warp(from_points, to_points, x, y, grid=(x_axis, y_axis, rows, cols))
+    else:
+        transform = WARP_METHODS[method](from_points, to_points, x, y)
+    return [numpy.asarray(t, dtype=dtype) for t in transform]
+
+def _fused_tps_setup(from_points, to_points, output_region):
+    # Same output grid as _make_inverse_warp() with approximate_grid = 1
+    x_min, y_min, x_max, y_max = output_region
+    x_axis = numpy.linspace(x_min, x_max, x_max - x_min)
+    y_axis = numpy.linspace(y_min, y_max, y_max - y_min)
+    from_points, to_points = numpy.asarray(from_points, dtype=float), numpy.asarray(to_points, dtype=float)
+    err = numpy.seterr(divide='ignore')
+    # reverse transform, see _make_inverse_warp()
+    coeffs = _make_coeffs(to_points, from_points)
+    numpy.seterr(**err)
+    return coeffs, x_axis, y_axis
 
 _small = 1e-100
 def _U(x):
@@ -95,6 +280,8 @@ def _make_L_matrix(points):
     return L
 
 def _calculate_f(coeffs, points, x, y):
+    if x.dtype == numpy.float32:
+        return _calculate_f32(coeffs, points, x, y)
     w = coeffs[:-3]
     a1, ax, ay = coeffs[-3:]
     # The following uses too much RAM:
@@ -105,14 +292,94 @@ def _calculate_f(coeffs, points, x, y):
      summation += wi * _U(numpy.sqrt((x-Pi[0])**2 + (y-Pi[1])**2))
     return a1 + ax*x + ay*y + summation
 
-def _make_warp(from_points, to_points, x_vals, y_vals):
-    from_points, to_points = numpy.asarray(from_points), numpy.asarray(to_points)
-    err = numpy.seterr(divide='ignore')
-    L = _make_L_matrix(from_points)
+def _calculate_f32(coeffs, points, x, y):
+    # Single precision evaluation of _calculate_f(). Summing up r**2 log(r) terms of 
+    # (thousands of) pixels directly in float32 loses too much to cancellation. Instead, 
+    # coordinates are centered on the landmarks and scaled by their extent s (u = (x - c) / s), so that 
+    #   r**2 log(r) = s**2 * rho**2 log(rho) + log(s) * r**2     (rho = r / s)
+    # The second part summed over all landmarks is a quadratic polynomial in u, which is folded 
+    # into the affine part (in double precision). Only bounded rho**2 log(rho) terms are summed in float32.
+    w = coeffs[:-3]
+    a1, ax, ay = coeffs[-3:]
+    center = points.mean(axis=0)
+    scale = max(numpy.abs(points - center).max() * 2, 1.)
+    u = (points - center) / scale
+    log_s = numpy.log(scale) * scale**2
+    wu = (w[:, numpy.newaxis] * u).sum(axis=0)
+    constant = a1 + ax*center[0] + ay*center[1] + log_s * numpy.sum(w * (u**2).sum(axis=1))
+    linear_x = ax*scale - 2*log_s*wu[0]
+    linear_y = ay*scale - 2*log_s*wu[1]
+    quadratic = log_s * w.sum() # 0 up to round-off of the solve
+
+    ux = ((x - center[0]) / scale).astype(numpy.float32)
+    uy = ((y - center[1]) / scale).astype(numpy.float32)
+    result = numpy.float32(constant) + numpy.float32(linear_x)*ux + numpy.float32(linear_y)*uy
+    result += numpy.float32(quadratic) * (ux*ux + uy*uy)
+    half = numpy.float32(.5)
+    for wi, ui in zip((w * scale**2).astype(numpy.float32), u.astype(numpy.float32)):
+        r_sq = (ux - ui[0])**2 + (uy - ui[1])**2
+        # rho**2 log(rho) = rho**2 log(rho**2) / 2
+        result += wi * (half * r_sq * numpy.log(numpy.where(r_sq > 0, r_sq, numpy.float32(1))))
+    return result
+
+# Compute modes of warp_images() (see `precision` there)
+PRECISIONS = ('float64', 'float32')
+
+def _precision_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision "{precision}". Choose from {list(PRECISIONS)}')
+    return numpy.dtype(precision)
+
+# The pseudo-inverse of L only depends on the from_points. In the inverse warp these are the 
+# (fixed) standard grid points, so when only the user points change (dragging, margin search, 
+# live preview) the factorization is reused from this small cache and only the right-hand side changes.
+# Tiles of warp_images() can run in parallel threads, so the cache is guarded by a lock.
+_L_INVERSE_CACHE_SIZE = 8
+_L_inverse_cache = OrderedDict()
+_L_inverse_lock = threading.Lock()
+def _L_inverse(points):
+    key = (points.shape, points.tobytes())
+    with _L_inverse_lock:
+        if key in _L_inverse_cache:
+            _L_inverse_cache.move_to_end(key)
+            return _L_inverse_cache[key]
+    L_inv = numpy.linalg.pinv(_make_L_matrix(points))
+    with _L_inverse_lock:
+        _L_inverse_cache[key] = L_inv
+        if len(_L_inverse_cache) > _L_INVERSE_CACHE_SIZE:
+            _L_inverse_cache.popitem(last=False)
+    return L_inv
+
+def _make_coeffs(from_points, to_points):
     V = numpy.resize(to_points, (len(to_points)+3, 2))
     V[-3:, :] = 0
-    coeffs = numpy.dot(numpy.linalg.pinv(L), V)
+    return numpy.dot(_L_inverse(from_points), V)
+
+def _make_warp(from_points, to_points, x_vals, y_vals):
+    from_points, to_points = numpy.asarray(from_points, dtype=float), numpy.asarray(to_points)
+    err = numpy.seterr(divide='ignore')
+    coeffs = _make_coeffs(from_points, to_points)
     x_warp = _calculate_f(coeffs[:,0], from_points, x_vals, y_vals)
     y_warp = _calculate_f(coeffs[:,1], from_points, x_vals, y_vals)
     numpy.seterr(**err)
     return [x_warp, y_warp]
+
+# Available backends for warp_images(). All share the signature of _make_warp().
+# The piecewise affine warp costs the same per pixel no matter how many landmarks there are, 
+# while the TPS evaluates every landmark for every pixel (see benchmarks/bench_warp_methods.py).
+# The compactly supported RBF ('wendland') stays close to the TPS, but scales (near) linearly 
+# with the number of landmarks. A low order polynomial is the cheapest of all, but only if it 
+# describes the distortion well enough - 'auto' checks its residual and falls back to TPS otherwise.
+def _make_auto_warp(from_points, to_points, x_vals, y_vals):
+    model = select_polynomial_model(from_points, to_points)
+    if model is None:
+        return _make_warp(from_points, to_points, x_vals, y_vals)
+    return model.evaluate(x_vals, y_vals)
+
+WARP_METHODS = OrderedDict([
+    ('tps',              _make_warp),
+    ('piecewise_affine', make_piecewise_affine_warp),
+    ('wendland',         make_wendland_warp),
+    ('polynomial',       make_polynomial_warp),
+    ('auto',             _make_auto_warp),
+    ])
@@ -13,17 +13,30 @@ from qtpy.QtWidgets import (QWidget,
                             QLabel,
                             QMessageBox,
                             QComboBox,
+                            QCheckBox,
                            )
 
 import qtpy.QtCore as qtcore 
 from qtpy.QtGui import QIntValidator, QDoubleValidator
 
+from napari.qt.threading import create_worker
+
 from ._helpers import (generate_perfect_grid, 
                        unwarp, 
+                       preview_unwarp,
+                       IncrementalPreview,
                        get_median_spacing, 
-                       propagate_cross_corr, 
                        get_optimal_unwarp,
+                       get_optimal_stack_margin,
                       )
+from ._tracking import PointPropagator
+from ._landmarks import Landmarks
+from ._qc import landmark_qc
+from ._zmodel import DepthModel
+from ._registry import Calibration, CalibrationRegistry
+from ._unwarp import WARP_METHODS
+from ._polynomial import POLYNOMIAL_TOLERANCE, fit_polynomial_model, select_polynomial_model
+from ._session import Session
 
 # Some naming ... 
 GRID_IMAGE_LAYER = 'Grid image(s)'
@@ -31,6 +44,29 @@ UNWARPED_LAYER = 'Unwarped grid image'
 STANDARD_GRID_LAYER = 'Standard grid'
 USR_GRID_LAYER = 'Grid'
 CORRECTED_POINTS_LAYER = 'Corrected points'
+PREVIEW_LAYER = 'Unwarp preview'
+JACOBIAN_LAYER = 'Jacobian determinant'
+
+# Live preview settings
+PREVIEW_DEBOUNCE_MS = 50 # Wait for this long after the last point edit before re-warping
+PREVIEW_DOWNSAMPLE  = 4  # Downsampling factor of preview image
+
+# Landmark QC 
+QC_STEP = 8 # Jacobian determinant map is evaluated every QC_STEP pixels
+
+# Depth model (see _zmodel.py)
+DEPTH_MODEL_TOLERANCE = .5 # Maximum deviation (pixels) of interpolated from propagated landmarks
+
+# Session checkpoints (see _session.py)
+CHECKPOINT_DEBOUNCE_MS = 500 # Wait for this long after the last edit before saving a checkpoint
+# Layers saved with a checkpoint (array name in the session -> layer name)
+SESSION_LAYERS = {
+    'grid_image'       : GRID_IMAGE_LAYER,
+    'standard_grid'    : STANDARD_GRID_LAYER,
+    'usr_grid'         : USR_GRID_LAYER,
+    'corrected_points' : CORRECTED_POINTS_LAYER,
+    'unwarped'         : UNWARPED_LAYER,
+}
 
 
 class MiniUnwarpWidget(QWidget):
@@ -55,6 +91,26 @@ class MiniUnwarpWidget(QWidget):
         self.state_export_btn = False # "Export" button
         self.state_propagate_btn = False # Propagate points (through stack) button
 
+        self.point_propagator = None # Incremental point propagation (see _propagate_points())
+        self._updating_points = False # Guard against recursive layer data events
+
+        # Live preview (see _request_preview())
+        self._preview_generation = 0 # Incremented on every edit - older results are dropped
+        self._preview_started_generation = 0 # Generation of the last preview run (successful or not)
+        self._preview_worker = None
+        self._incremental_preview = None # TPS previews are updated incrementally (see IncrementalPreview)
+        self._preview_timer = qtcore.QTimer()
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(PREVIEW_DEBOUNCE_MS)
+        self._preview_timer.timeout.connect(self._start_preview)
+
+        # Session checkpoints (see _checkpoint())
+        self.session = None
+        self._checkpoint_timer = qtcore.QTimer()
+        self._checkpoint_timer.setSingleShot(True)
+        self._checkpoint_timer.setInterval(CHECKPOINT_DEBOUNCE_MS)
+        self._checkpoint_timer.timeout.connect(self._checkpoint)
+
         ### Main Layout
         layout = QVBoxLayout()    
         layout.setContentsMargins(0, 0, 0, 0)
@@ -78,6 +134,7 @@ class MiniUnwarpWidget(QWidget):
         layout_start_margin_widget = self._generate_start_margin_layout()
         layout_generate_grid_widget = self._generate_grid_generate_layout()
         layout_propagate_points_widget = self._generate_propagate_layout()
+        layout_method_widget = self._generate_method_layout()
         layout_unwarp_widget = self._generate_unwarp_layout()
         layout_gridspacing = self._generate_gridspacing_layout()
         
@@ -99,6 +156,7 @@ class MiniUnwarpWidget(QWidget):
         layout.addWidget(layout_start_margin_widget)   
         layout.addWidget(layout_generate_grid_widget)
         layout.addWidget(layout_propagate_points_widget)
+        layout.addWidget(layout_method_widget)
         layout.addWidget(layout_unwarp_widget)
 
         # Second info box
@@ -139,6 +197,17 @@ class MiniUnwarpWidget(QWidget):
         layout.setAlignment(qtcore.Qt.AlignTop)
         self.setLayout(layout)
 
+        # Parameter changes are saved with the next checkpoint (only once a session exists)
+        for edit in [self.gridspacing_edit, self.systemname_edit, self.scopename_edit, self.zoomlevel, self.tlens]:
+            edit.editingFinished.connect(self._request_checkpoint)
+        self.method.currentIndexChanged.connect(self._request_checkpoint)
+        self.depth_model_checkbox.stateChanged.connect(self._request_checkpoint)
+
+        # Grid images opened from a session folder: pick up where that session stopped
+        session_path = self.viewer.layers[GRID_IMAGE_LAYER].metadata.get('session')
+        if session_path is not None:
+            self._resume_session(session_path)
+
     
     ##### LAYOUT ELEMENTS #############################################################################
     ###################################################################################################
@@ -220,7 +289,10 @@ class MiniUnwarpWidget(QWidget):
         self.propagate_points_button = QPushButton("Propagate points")
         self.propagate_points_button.clicked.connect(self._propagate_points)
         self.propagate_points_button.setEnabled(self.state_propagate_btn)
-        layout_propagate_points.addWidget(self.propagate_points_button)
+        self.depth_model_checkbox = QCheckBox("Depth model")
+        self.depth_model_checkbox.setEnabled(self.state_propagate_btn)
+        layout_propagate_points.addWidget(self.propagate_points_button, 60)
+        layout_propagate_points.addWidget(self.depth_model_checkbox, 40)
         layout_propagate_points.setContentsMargins(self.left_margins, 
                                                    self.top_margins, 
                                                    self.right_margins, 
@@ -231,6 +303,26 @@ class MiniUnwarpWidget(QWidget):
         return layout_propagate_points_widget
 
 
+    def _generate_method_layout(self):
+        # LAYOUT
+        # Generate warping method QComboBox dropdown (see WARP_METHODS in _unwarp.py)
+        layout_method = QHBoxLayout()  
+        method_label  = QLabel("Warp")
+        self.method   = QComboBox()
+        self.method.addItems(list(WARP_METHODS))
+        self.method.currentIndexChanged.connect(self._method_changed)
+
+        layout_method.addWidget(method_label, 30)
+        layout_method.addWidget(self.method,  70)
+        layout_method.setContentsMargins(self.left_margins, 
+                                         self.top_margins, 
+                                         self.right_margins, 
+                                         self.bottom_margins
+                                         )
+        layout_method_widget =  QWidget()
+        layout_method_widget.setLayout(layout_method)
+        return layout_method_widget
+
     def _generate_unwarp_layout(self):
         # LAYOUT
         # Generate unwarp button
@@ -238,7 +330,11 @@ class MiniUnwarpWidget(QWidget):
         self.unwarp_button = QPushButton("Unwarp!")
         self.unwarp_button.clicked.connect(self._unwarp)
         self.unwarp_button.setEnabled(self.state_unwarp_btn)
-        layout_unwarp.addWidget(self.unwarp_button)
+        self.preview_checkbox = QCheckBox("Live preview")
+        self.preview_checkbox.stateChanged.connect(self._toggle_preview)
+        self.preview_checkbox.setEnabled(self.state_unwarp_btn)
+        layout_unwarp.addWidget(self.unwarp_button, 60)
+        layout_unwarp.addWidget(self.preview_checkbox, 40)
         layout_unwarp.setContentsMargins(self.left_margins, 
                                                 self.top_margins, 
                                                 self.right_margins, 
@@ -468,28 +564,9 @@ class MiniUnwarpWidget(QWidget):
 
         ###### ADD DOTS ##########################################################################
 
-        self.viewer.add_points(data=grid_dots,
-                               name=STANDARD_GRID_LAYER,
-                               edge_width=1, 
-                               edge_color='#000000',  
-                               face_color = 'white',
-                               opacity = .8,    
-                               size=grid_image.shape[-1]/50, # Adapt size of symbol to current data size
-                               blending='translucent',
-                               out_of_slice_display=False,
-                              )
-        self.viewer.add_points(data=grid_dots.copy(),
-                               name=USR_GRID_LAYER, 
-                               edge_width=.4, 
-                               edge_color='orangered',  
-                               face_color = 'white',
-                               opacity = .5,    
-                               size=grid_image.shape[-1]/40, # Adapt size of symbol to current data size
-                               blending='translucent',
-                               out_of_slice_display=False,
-                              )
+        self.viewer.add_points(data=grid_dots, **_points_kwargs(STANDARD_GRID_LAYER, grid_image.shape[-1]))
+        self.viewer.add_points(data=grid_dots.copy(), **_points_kwargs(USR_GRID_LAYER, grid_image.shape[-1]))
         self.viewer.layers[USR_GRID_LAYER].mode ='select'
-        self.viewer.layers[USR_GRID_LAYER].symbol ='x'
 
         self.viewer.layers[STANDARD_GRID_LAYER].visible = False
 
@@ -498,14 +575,25 @@ class MiniUnwarpWidget(QWidget):
         if grid_image.ndim == 3: 
             self.state_propagate_btn = True
             self.propagate_points_button.setEnabled(self.state_propagate_btn)
+            self.depth_model_checkbox.setEnabled(self.state_propagate_btn)
 
         self.state_unwarp_btn = True
         self.unwarp_button.setEnabled(self.state_unwarp_btn)
+        self.preview_checkbox.setEnabled(self.state_unwarp_btn)
+        if self.preview_checkbox.isChecked():
+            self._connect_preview()
 
         # ... and make sure the export button is (still) disabled (until warp is pressed)
         self.state_export_btn = False
         self.export_button.setEnabled(self.state_export_btn)
 
+        # The first grid starts a new session, later ones (re-generating) keep saving into it
+        if self.session is None:
+            self.session = Session.new()
+        print(f'Saving session checkpoints to {self.session.path.as_posix()}')
+        self._connect_checkpoints()
+        self._checkpoint(images=True)
+
         return 
 
     def _propagate_points(self):
@@ -522,6 +610,7 @@ class MiniUnwarpWidget(QWidget):
             # ... and deactivate (why was it activated in the first place?)
             self.state_propagate_btn = False
             self.propagate_points_button.setEnabled(self.state_propagate_btn)
+            self.depth_model_checkbox.setEnabled(self.state_propagate_btn)
             return 
 
         # Built in check for layer existence
@@ -541,48 +630,218 @@ class MiniUnwarpWidget(QWidget):
         plane_idx_current   = self.viewer.dims.current_step[0]
         print(f'Current plane: {plane_idx_current}')
         grid_points_current = self.viewer.layers['Grid'].data
-        num_planes = grid_image.shape[0]
                 
         med_dist = get_median_spacing(grid_points_current)
         b_box_halfwidth = int(med_dist/4)
 
-        sorted_point_dict = propagate_cross_corr(grid_image,
-                                                 grid_points_current, 
-                                                 plane_idx_current, 
-                                                 b_box_halfwidth,
-                                                 )
-
-
-        # To add these points to the viewer we have to jump through some hoops ... 
-        corr_points = np.stack(list(sorted_point_dict.values()))       
-        for no, pt in enumerate(np.moveaxis(corr_points,0,-1)):
-            # Looping over (individual points, 2, number of planes)
-            # Create new point 
-            new_pt = np.vstack((np.arange(num_planes), pt))
-            new_pt = np.moveaxis(new_pt, -1, 0)
-            if no == 0:
-                all_points = new_pt
-            else:
-                all_points = np.vstack((all_points, new_pt))
-
+        # Keep the propagator around, so that later corrections of single points 
+        # only re-track those points (see _on_corrected_points_changed())
+        self.point_propagator = PointPropagator(grid_image, b_box_halfwidth)
+        corr_points = self.point_propagator.propagate(plane_idx_current, grid_points_current)
 
         # Add all points across all planes to viewer
-        self.viewer.add_points(name=CORRECTED_POINTS_LAYER,
-                               data=all_points,
-                               edge_width=.7,
-                               edge_color='#000000',
-                               face_color = 'cornflowerblue',
-                               opacity = .6,
-                               size=grid_image.shape[-1]/50, # Adapt size of symbol to current data size
-                               blending='translucent',
-                               out_of_slice_display=False,
-                               )
+        self.viewer.add_points(data=Landmarks(corr_points).layer_data,
+                               **_points_kwargs(CORRECTED_POINTS_LAYER, grid_image.shape[-1]))
+        self._corrected_points_data = self.viewer.layers[CORRECTED_POINTS_LAYER].data.copy()
+        self.viewer.layers[CORRECTED_POINTS_LAYER].events.data.connect(self._on_corrected_points_changed)
+        # Points that could not be tracked reliably (see PointPropagator) are selected for inspection
+        flagged = np.flatnonzero(self.point_propagator.flagged) # Plane-major, as the layer data
+        if len(flagged):
+            print(f'{len(flagged)} point(s) could not be tracked reliably and are selected - please check')
+            self.viewer.layers[CORRECTED_POINTS_LAYER].selected_data = set(flagged.tolist())
+        if self.preview_checkbox.isChecked():
+            self._connect_preview()
+
         # Switch off the user point layer (because it's confusing at this point)
         self.viewer.layers[USR_GRID_LAYER].visible = False
 
+        self._connect_checkpoints()
+        self._checkpoint()
+        return
+
+    def _on_corrected_points_changed(self, event):
+        '''
+        Callback for data changes in the "Corrected points" layer
+
+        Points that were moved by the user become anchors for the propagation, 
+        and only those points are re-tracked through the stack 
+        (see PointPropagator.update()).
+        
+        '''
+        if self._updating_points or (self.point_propagator is None):
+            return
+        if getattr(event, 'action', None) == 'changing':
+            # Still dragging
+            return
+
+        layer = self.viewer.layers[CORRECTED_POINTS_LAYER]
+        new_data = layer.data
+        old_data = self._corrected_points_data
+        if new_data.shape != old_data.shape:
+            print('Points were added or removed - cannot update propagation incrementally')
+            self._corrected_points_data = new_data.copy()
+            return
+
+        changed = np.where(np.any(new_data != old_data, axis=1))[0]
+        if not len(changed): 
+            return
+
+        try:
+            landmarks = Landmarks.from_layer_data(new_data, self.point_propagator.num_planes)
+        except ValueError as e:
+            print(f'Cannot update propagation incrementally: {e}')
+            self._corrected_points_data = new_data.copy()
+            return
+        planes, points = landmarks.point_index(changed)
+        for plane in np.unique(planes):
+            print(f'Re-tracking {np.sum(planes == plane)} point(s) from plane {plane}')
+            corr_points = self.point_propagator.update(plane, 
+                                                       points[planes == plane], 
+                                                       landmarks[plane][points[planes == plane]],
+                                                       )
+
+        self._updating_points = True
+        try:
+            layer.data = Landmarks(corr_points).layer_data
+        finally:
+            self._updating_points = False
+        self._corrected_points_data = layer.data.copy()
+
+        return
+
+
+
+    def _toggle_preview(self, state):
+        '''
+        Callback for "Live preview" checkbox
+        
+        '''
+        if self.preview_checkbox.isChecked():
+            self._connect_preview()
+        else:
+            self._disconnect_preview()
+            if PREVIEW_LAYER in self.viewer.layers:
+                self.viewer.layers.pop(PREVIEW_LAYER)
         return
 
+    def _connect_preview(self):
+        '''
+        Subscribe to edits of the grid point layers and plane changes
+        
+        '''
+        self._disconnect_preview()
+        for layer_name in [USR_GRID_LAYER, CORRECTED_POINTS_LAYER]:
+            if layer_name in self.viewer.layers:
+                self.viewer.layers[layer_name].events.data.connect(self._request_preview)
+        self.viewer.dims.events.current_step.connect(self._request_preview)
+        self._request_preview()
+
+    def _disconnect_preview(self):
+        for layer_name in [USR_GRID_LAYER, CORRECTED_POINTS_LAYER]:
+            if layer_name in self.viewer.layers:
+                self.viewer.layers[layer_name].events.data.disconnect(self._request_preview)
+        self.viewer.dims.events.current_step.disconnect(self._request_preview)
+        self._preview_timer.stop()
+
+    def _method_changed(self, index):
+        '''
+        Callback for warping method dropdown
+        
+        '''
+        if self.preview_checkbox.isChecked():
+            self._request_preview()
+
+    def _request_preview(self, event=None):
+        '''
+        Debounce: (Re-)start the timer on every edit, 
+        the preview is only calculated once edits pause for PREVIEW_DEBOUNCE_MS
+        
+        '''
+        self._preview_generation += 1
+        self._preview_timer.start()
+
+    def _start_preview(self):
+        '''
+        Warp a downsampled copy of the current plane in a background thread
+        
+        '''
+        if self._preview_worker is not None:
+            # Busy - _preview_finished() will start a new run for the latest edit
+            return
+        grid_image = self.viewer.layers[GRID_IMAGE_LAYER].data
+        if CORRECTED_POINTS_LAYER in self.viewer.layers:
+            plane = self.viewer.dims.current_step[0]
+            try:
+                usr_dots = Landmarks.from_layer_data(self.viewer.layers[CORRECTED_POINTS_LAYER].data, 
+                                                     grid_image.shape[0],
+                                                     )[plane]
+            except ValueError as e:
+                print(f'No preview: {e}')
+                return
+            image = grid_image[plane]
+        elif USR_GRID_LAYER in self.viewer.layers:
+            usr_dots = self.viewer.layers[USR_GRID_LAYER].data[:, -2:]
+            image = grid_image[self.viewer.dims.current_step[0]] if grid_image.ndim == 3 else grid_image
+        else:
+            return
+        if len(usr_dots) != len(self.standard_grid_dots):
+            print(f'No preview: {len(usr_dots)} grid points but {len(self.standard_grid_dots)} '
+                  'standard grid points - were points added or deleted?')
+            return
 
+        method = self.method.currentText()
+        incremental = None
+        if method == 'tps':
+            if (self._incremental_preview is None) or \
+                    not self._incremental_preview.matches(self.standard_grid_dots, image.shape):
+                self._incremental_preview = IncrementalPreview(self.standard_grid_dots, image.shape, 
+                                                               downsample=PREVIEW_DOWNSAMPLE)
+            incremental = self._incremental_preview
+
+        generation = self._preview_generation
+        self._preview_started_generation = generation
+        self._preview_worker = create_worker(_preview_job, 
+                                             generation,
+                                             usr_dots.copy(),
+                                             self.standard_grid_dots,
+                                             np.asarray(image),
+                                             method,
+                                             incremental,
+                                             _connect={'errored': self._preview_failed},
+                                             _start_thread=False,
+                                             )
+        self._preview_worker.returned.connect(self._show_preview)
+        self._preview_worker.finished.connect(self._preview_finished)
+        self._preview_worker.start()
+
+    def _preview_finished(self):
+        self._preview_worker = None
+        if self._preview_generation != self._preview_started_generation:
+            # There were edits while the worker was running
+            self._preview_timer.start()
+
+    def _preview_failed(self, error):
+        # Not retried until the next edit (see _preview_finished())
+        print(f'No preview: {error}')
+        # The incremental state may be half updated
+        self._incremental_preview = None
+
+    def _show_preview(self, result):
+        generation, preview = result
+        if generation != self._preview_generation:
+            # Stale - a newer edit has arrived in the meantime
+            return
+        if not self.preview_checkbox.isChecked():
+            return
+        if PREVIEW_LAYER in self.viewer.layers:
+            self.viewer.layers[PREVIEW_LAYER].data = preview
+        else:
+            self.viewer.add_image(data=preview, 
+                                  rgb=False, 
+                                  name=PREVIEW_LAYER,
+                                  scale=[PREVIEW_DOWNSAMPLE, PREVIEW_DOWNSAMPLE],
+                                  opacity=.8,
+                                  )
 
     def _unwarp(self):
         '''
@@ -634,12 +893,13 @@ class MiniUnwarpWidget(QWidget):
         # User grid pattern
         usr_dots = usr_layer_grid.data
         margin = self.start_margin
+        method = self.method.currentText()
 
 
         # UNWARPING
         if not multiplane: 
             
-            unwarped, status = unwarp(usr_dots, standard_grid, grid_image_original)
+            unwarped, status = unwarp(usr_dots, standard_grid, grid_image_original, method=method)
             # Start optimization
             unwarped, margin = get_optimal_unwarp(status,
                                                   margin,
@@ -647,64 +907,71 @@ class MiniUnwarpWidget(QWidget):
                                                   grid_image_original,
                                                   self.no_rows,
                                                   self.no_cols,
+                                                  method=method,
                                                  )
-            standard_grid = generate_perfect_grid(data = grid_image_original[plane,:,:],
+            standard_grid = generate_perfect_grid(data = grid_image_original,
                                                   rows = self.no_rows,
                                                   cols = self.no_cols,
                                                   start_margin = margin,
                                                 )
+            landmarks = Landmarks.from_layer_data(usr_dots)
 
 
         else: 
-            # Need to jump through some hoops to reformat the data in original 2D representation ... 
-            usr_dots_reshaped = np.reshape(usr_dots,(-1,num_planes,3))
-            usr_dots_reshaped = np.moveaxis(usr_dots_reshaped, 0, -1)
-
-            # Do this twice - once just to get optimal margins across the whole stack
-            # then to actually collect the output at optimal margin
+            landmarks = Landmarks.from_layer_data(usr_dots, num_planes)
+            
+            # With the depth model, landmarks are interpolated in z from a few key planes
+            # (see _zmodel.py), and margins only need to be optimized for those
+            depth_model = None
+            planes = np.arange(num_planes)
+            if self.depth_model_checkbox.isChecked():
+                # Interpolate over the recorded depths (see _reader.py), if they are known. 
+                # Unevenly spaced planes are otherwise treated as evenly spaced
+                depths = grid_image_layer.metadata.get('plane_depths')
+                if (depths is None) or (len(depths) != num_planes) or not np.all(np.diff(depths) > 0):
+                    depths = None
+                depth_model = DepthModel(landmarks.positions, depths=depths, tolerance=DEPTH_MODEL_TOLERANCE)
+                planes = depth_model.key_planes
+                print(f'Depth model key planes: {list(planes)}')
+
+            # Margins are optimized for the whole stack at once: only the borders of 
+            # all unwarped planes are computed per step (see get_optimal_stack_margin())
             print('Optimizing margins ...')
-            for plane in progress(np.arange(num_planes), desc='Optimizing margins'):
-                usr_dots = usr_dots_reshaped[plane, 1:].T # LOVELY! 
-                
-                standard_grid = generate_perfect_grid(data = grid_image_original[plane,:,:],
-                                                      rows = self.no_rows,
-                                                      cols = self.no_cols,
-                                                      start_margin = margin,
-                                                      )
-                unwarped, status = unwarp(usr_dots, standard_grid, grid_image_original[plane,:,:])
-
-                # Start optimization
-                unwarped, margin_ = get_optimal_unwarp(status,
-                                                       margin,
-                                                       usr_dots,
-                                                       grid_image_original[plane,:,:],
-                                                       self.no_rows,
-                                                       self.no_cols,
-                                                    )
-                if margin_ > margin: 
-                    # We are only intereseted in those unwarping results 
-                    # that overshoot the boundaries (loose information over borders):
-                    # Those are the ones that determine the upper bound, i.e. only the max counts here
-                    margin = margin_
-
+            margin = get_optimal_stack_margin(margin,
+                                              landmarks.positions[planes],
+                                              grid_image_original[planes],
+                                              self.no_rows,
+                                              self.no_cols,
+                                              method=method,
+                                              )
             print(f'Selected margin: {margin}')
+            standard_grid = generate_perfect_grid(data = grid_image_original,
+                                                  rows = self.no_rows,
+                                                  cols = self.no_cols,
+                                                  start_margin = margin,
+                                                 )
 
-            # ... now do it for real and collect the output
+            # ... now unwarp every plane (with its own landmarks) once 
             print('Unwarping all planes ...')
-            all_unwarped = []
+            # Every plane is written straight into its slot of the output stack
+            all_unwarped = np.empty(grid_image_original.shape, dtype=grid_image_original.dtype)
             for plane in progress(np.arange(num_planes), desc='Collecting output'):
-                standard_grid = generate_perfect_grid(data = grid_image_original[plane,:,:],
-                                                      rows = self.no_rows,
-                                                      cols = self.no_cols,
-                                                      start_margin = margin,
-                                                     )
-                unwarped, status = unwarp(usr_dots, standard_grid, grid_image_original[plane,:,:])
-                all_unwarped.append(unwarped)
-            unwarped = np.stack(all_unwarped)
+                if depth_model is not None:
+                    usr_dots = depth_model.plane_positions(plane)
+                else:
+                    usr_dots = landmarks[plane]
+                unwarp(usr_dots, standard_grid, grid_image_original[plane,:,:], method=method, 
+                       out=all_unwarped[plane])
+            unwarped = all_unwarped
 
         # Lastly, add the unwarped grid image to the viewer
         self.viewer.add_image(data=unwarped, rgb=False, name=UNWARPED_LAYER)
 
+        # ... which model was fitted ('auto' / 'polynomial')
+        self._report_model(landmarks, standard_grid, method)
+        # ... and QC of the landmarks
+        self._landmark_qc(landmarks, standard_grid, usr_layer_grid, grid_image_original.shape[-2:])
+
 
 
 
@@ -714,16 +981,8 @@ class MiniUnwarpWidget(QWidget):
         # do it now, at the end
 
         self.viewer.layers.pop(STANDARD_GRID_LAYER)
-        self.viewer.add_points(data=standard_grid,
-                               name=STANDARD_GRID_LAYER,
-                               edge_width=1, 
-                               edge_color='#000000',  
-                               face_color = 'white',
-                               opacity = .8,    
-                               size=grid_image_original.shape[-1]/50, # Adapt size of symbol to current data size
-                               blending='translucent',
-                               out_of_slice_display=False,
-                              )
+        self.viewer.add_points(data=standard_grid, 
+                               **_points_kwargs(STANDARD_GRID_LAYER, grid_image_original.shape[-1]))
         self.viewer.layers[STANDARD_GRID_LAYER].visible = False
 
 
@@ -732,6 +991,214 @@ class MiniUnwarpWidget(QWidget):
         self.state_export_btn = True
         self.export_button.setEnabled(self.state_export_btn)
 
+        self._checkpoint(images=True)
+        return
+
+    def _report_model(self, landmarks, standard_grid, method):
+        '''
+        Print the model that the 'auto' and 'polynomial' backends fitted (per plane) 
+        and its residuals at the landmarks. See _polynomial.py
+        
+        '''
+        if method not in ['auto', 'polynomial']:
+            return
+        for plane in range(landmarks.num_planes):
+            prefix = f'Plane {plane}: ' if landmarks.num_planes > 1 else ''
+            # Same fit as the warp (from the standard grid to the user points, see _make_inverse_warp())
+            if method == 'auto':
+                model = select_polynomial_model(standard_grid, landmarks[plane])
+            else:
+                model = fit_polynomial_model(standard_grid, landmarks[plane])
+            if model is None:
+                print(f'{prefix}Warping model ({method}): TPS - no polynomial model with an '
+                      f'RMS residual below {POLYNOMIAL_TOLERANCE} px')
+            else:
+                print(f'{prefix}Warping model ({method}): polynomial of order {model.order} | '
+                      f'RMS residual {model.rms_residual:.2f} px | max {model.max_residual:.2f} px')
+        return
+
+    def _landmark_qc(self, landmarks, standard_grid, usr_layer_grid, image_shape):
+        '''
+        Show leave-one-out residuals of all user points (as point property "loo_error")
+        and the Jacobian determinant of the warp (as image layer). 
+        See _qc.py 
+        
+        '''
+        method = self.method.currentText()
+        loo_errors, jacobians = [], []
+        for plane in range(landmarks.num_planes):
+            loo_error, jacobian = landmark_qc(landmarks[plane], standard_grid, image_shape, step=QC_STEP, 
+                                              method=method)
+            loo_errors.append(loo_error)
+            jacobians.append(jacobian)
+        # Plane-major, i.e. in the same order as the layer data (see Landmarks)
+        loo_error = np.concatenate(loo_errors)
+        worst_plane, worst_point = landmarks.point_index(np.argmax(loo_error))
+        print(f'Leave-one-out residuals ({method}): median {np.median(loo_error):.2f} px | '
+              f'max {loo_error.max():.2f} px (point {worst_point}, plane {worst_plane})')
+
+        usr_layer_grid.properties = {'loo_error': loo_error}
+        usr_layer_grid.face_colormap = 'magma'
+        usr_layer_grid.face_color = 'loo_error'
+
+        jacobian = np.squeeze(np.stack(jacobians))
+        if JACOBIAN_LAYER in self.viewer.layers:
+            self.viewer.layers.pop(JACOBIAN_LAYER)
+        self.viewer.add_image(data=jacobian,
+                              rgb=False,
+                              name=JACOBIAN_LAYER,
+                              scale=[1] * (jacobian.ndim - 2) + [QC_STEP, QC_STEP],
+                              colormap='twilight_shifted',
+                              visible=False,
+                              )
+        if (jacobian <= 0).any():
+            print('Warning: The warp folds over itself (Jacobian determinant <= 0) - check the grid points!')
+        return
+
+    def _connect_checkpoints(self):
+        '''
+        Subscribe to edits of the grid point layers, 
+        so that every edit ends up in the session (see _checkpoint())
+        
+        '''
+        for layer_name in [USR_GRID_LAYER, CORRECTED_POINTS_LAYER]:
+            if layer_name in self.viewer.layers:
+                self.viewer.layers[layer_name].events.data.disconnect(self._request_checkpoint)
+                self.viewer.layers[layer_name].events.data.connect(self._request_checkpoint)
+        return
+
+    def _request_checkpoint(self, event=None):
+        '''
+        Debounce: (Re-)start the timer on every edit, 
+        the checkpoint is only saved once edits pause for CHECKPOINT_DEBOUNCE_MS
+        
+        '''
+        if (self.session is None) or (getattr(event, 'action', None) == 'changing'):
+            return
+        self._checkpoint_timer.start()
+
+    def _session_parameters(self):
+        '''
+        Parameters (and layer settings) saved with every checkpoint
+        
+        '''
+        grid_image_layer = self.viewer.layers[GRID_IMAGE_LAYER]
+        image_width = grid_image_layer.data.shape[-1]
+        layers = {}
+        for array_name, layer_name in SESSION_LAYERS.items():
+            if layer_name not in self.viewer.layers:
+                continue
+            if layer_name == GRID_IMAGE_LAYER:
+                metadata = {k: v for k, v in grid_image_layer.metadata.items() if k != 'session'}
+                add_kwargs = {'rgb': False, 'name': GRID_IMAGE_LAYER, 'metadata': metadata}
+                if grid_image_layer.data.ndim == 3:
+                    add_kwargs['scale'] = [1, 1, 1]
+                layer_type = 'image'
+            elif layer_name == UNWARPED_LAYER:
+                add_kwargs, layer_type = {'rgb': False, 'name': UNWARPED_LAYER}, 'image'
+            else:
+                add_kwargs, layer_type = _points_kwargs(layer_name, image_width), 'points'
+            add_kwargs['visible'] = self.viewer.layers[layer_name].visible
+            layers[array_name] = {'add_kwargs': add_kwargs, 'layer_type': layer_type}
+
+        parameters = {
+            'no_rows'      : self.no_rows,
+            'no_cols'      : self.no_cols,
+            'start_margin' : self.start_margin,
+            'method'       : self.method.currentText(),
+            'depth_model'  : self.depth_model_checkbox.isChecked(),
+            'grid_spacing' : self.gridspacing_edit.text(),
+            'system'       : self.systemname_edit.text(),
+            'scope'        : self.scopename_edit.text(),
+            'objective'    : self.scopename.currentText(),
+            'zoom'         : self.zoomlevel.text(),
+            'tlens'        : self.tlens.text(),
+            'layers'       : layers,
+        }
+        if self.point_propagator is not None:
+            parameters['propagator'] = self.point_propagator.state()[0]
+        return parameters
+
+    def _checkpoint(self, images=False):
+        '''
+        Save the current state to the session in the background. 
+        Unchanged arrays are not written again (see Session.save()).
+
+        Parameters
+        ----------
+        images : bool : also save the grid image and the unwarped image. 
+                        These only change in _generate_grid() and _unwarp(), 
+                        point edits do not need to copy them
+        
+        '''
+        if self.session is None:
+            return
+        self._checkpoint_timer.stop()
+        arrays = {}
+        for array_name, layer_name in SESSION_LAYERS.items():
+            if (layer_name in [GRID_IMAGE_LAYER, UNWARPED_LAYER]) and not images:
+                continue
+            arrays[array_name] = (np.asarray(self.viewer.layers[layer_name].data) 
+                                  if layer_name in self.viewer.layers else None)
+        arrays['generated_grid'] = self.standard_grid_dots
+        if self.point_propagator is not None:
+            for name, array in self.point_propagator.state()[1].items():
+                arrays[f'propagator_{name}'] = array
+        self.session.save_async(arrays, self._session_parameters())
+
+    def _resume_session(self, path):
+        '''
+        Restore parameters and point propagation of a session, 
+        whose layers were opened through the session reader (see session_reader()).
+        Nothing is recomputed. 
+        
+        '''
+        session = Session(path)
+        parameters, arrays = session.load()
+        for edit, key in [(self.no_rows_edit, 'no_rows'), 
+                          (self.no_cols_edit, 'no_cols'), 
+                          (self.start_margin_edit, 'start_margin'), 
+                          (self.gridspacing_edit, 'grid_spacing'), 
+                          (self.systemname_edit, 'system'), 
+                          (self.scopename_edit, 'scope'), 
+                          (self.zoomlevel, 'zoom'), 
+                          (self.tlens, 'tlens')]:
+            if key in parameters:
+                edit.setText(str(parameters[key]))
+        self.method.setCurrentText(parameters.get('method', self.method.currentText()))
+        self.scopename.setCurrentText(parameters.get('objective', self.scopename.currentText()))
+        self.depth_model_checkbox.setChecked(parameters.get('depth_model', False))
+        if 'no_rows' not in parameters:
+            print(f'Session {path} does not contain a grid yet')
+            return 
+        self.no_rows = int(parameters['no_rows'])
+        self.no_cols = int(parameters['no_cols'])
+        self.start_margin = float(parameters['start_margin'])
+        self.standard_grid_dots = np.array(arrays['generated_grid'])
+
+        grid_image = self.viewer.layers[GRID_IMAGE_LAYER].data
+        if ('propagator' in parameters) and (CORRECTED_POINTS_LAYER in self.viewer.layers):
+            state = {name: arrays.get(f'propagator_{name}') for name in PointPropagator.STATE_ARRAYS}
+            self.point_propagator = PointPropagator.from_state(grid_image, parameters['propagator'], state)
+            self._corrected_points_data = self.viewer.layers[CORRECTED_POINTS_LAYER].data.copy()
+            self.viewer.layers[CORRECTED_POINTS_LAYER].events.data.connect(self._on_corrected_points_changed)
+        if USR_GRID_LAYER in self.viewer.layers:
+            self.viewer.layers[USR_GRID_LAYER].mode ='select'
+
+        # Button states as after the last step of the session
+        self.state_propagate_btn = grid_image.ndim == 3
+        self.propagate_points_button.setEnabled(self.state_propagate_btn)
+        self.depth_model_checkbox.setEnabled(self.state_propagate_btn)
+        self.state_unwarp_btn = True
+        self.unwarp_button.setEnabled(self.state_unwarp_btn)
+        self.preview_checkbox.setEnabled(self.state_unwarp_btn)
+        self.state_export_btn = UNWARPED_LAYER in self.viewer.layers
+        self.export_button.setEnabled(self.state_export_btn)
+
+        # Keep checkpointing into the same session
+        self.session = session
+        self._connect_checkpoints()
+        print(f'Resumed session {session.path.as_posix()}')
         return
 
     def _export(self):
@@ -755,22 +1222,105 @@ class MiniUnwarpWidget(QWidget):
         # Standard grid 
         standard_grid_points = self.viewer.layers[STANDARD_GRID_LAYER].data 
         # Corrected grid
-        if CORRECTED_POINTS_LAYER in self.viewer.layers: 
-            # This is only the case for multi plane data (and then the right one to export)
-            corrected_grid_points = self.viewer.layers[CORRECTED_POINTS_LAYER].data
-        elif USR_GRID_LAYER in self.viewer.layers:
-            # ... if only a single layer is available
-            corrected_grid_points = self.viewer.layers[USR_GRID_LAYER].data
-        else:
-            print('No user corrected grid layer was found.')
-            self.state_export_btn = False
-            self.export_button.setEnabled(self.state_export_btn)
+        try:
+            if CORRECTED_POINTS_LAYER in self.viewer.layers: 
+                # This is only the case for multi plane data (and then the right one to export)
+                corrected_grid_points = Landmarks.from_layer_data(self.viewer.layers[CORRECTED_POINTS_LAYER].data,
+                                                                  grid_image.shape[0],
+                                                                  )
+            elif USR_GRID_LAYER in self.viewer.layers:
+                # ... if only a single layer is available (plane index of stacks dropped, see _start_preview())
+                corrected_grid_points = Landmarks.from_layer_data(self.viewer.layers[USR_GRID_LAYER].data[:, -2:])
+            else:
+                print('No user corrected grid layer was found.')
+                self.state_export_btn = False
+                self.export_button.setEnabled(self.state_export_btn)
+                return
+        except ValueError as e:
+            print(f'Export failed: {e}')
             return
-        
+        if corrected_grid_points.positions.shape[1] != len(standard_grid_points):
+            print(f'Export failed: {corrected_grid_points.positions.shape[1]} grid points '
+                  f'but {len(standard_grid_points)} standard grid points - were points added or deleted?')
+            return
+
+        # Zoom and t-lens (z height) are the keys of the calibration
+        metadata = {'grid_spacing_um': float(self.gridspacing_edit.text())}
+        try:
+            zoom = float(self.zoomlevel.text())
+        except ValueError:
+            print(f'Export failed: zoom level "{self.zoomlevel.text()}" is not a number')
+            return
+        plane_depths = self.viewer.layers[GRID_IMAGE_LAYER].metadata.get('plane_depths')
+        try:
+            tlens = float(self.tlens.text())
+        except ValueError:
+            if not plane_depths:
+                print(f'Export failed: t-lens "{self.tlens.text()}" is not a number')
+                return
+            # Stacks (z height 'read from file'): keyed by the depth of the first plane
+            tlens = float(plane_depths[0])
+        if plane_depths:
+            metadata['plane_depths'] = [float(depth) for depth in plane_depths]
+
         # path = 
         print('EXPORTING')
 
+        # Store the calibration (keyed by system / scope / objective / zoom / tlens) 
+        # so that it can be looked up later without refitting (see _registry.py)
+        calibration = Calibration(system = self.systemname_edit.text(),
+                                  scope = self.scopename_edit.text(),
+                                  objective = self.scopename.currentText(),
+                                  zoom = zoom,
+                                  tlens = tlens,
+                                  usr_dots = np.squeeze(corrected_grid_points.positions, axis=0) 
+                                             if corrected_grid_points.num_planes == 1 
+                                             else corrected_grid_points.positions,
+                                  grid_dots = standard_grid_points,
+                                  image_shape = grid_image.shape[-2:],
+                                  method = self.method.currentText(),
+                                  metadata = metadata,
+                                  )
+        with CalibrationRegistry() as registry:
+            calibration_id = registry.add(calibration, store_map=True)
+        print(f'Saved calibration {calibration_id} to {registry.path}')
+
         # with open(path/'export_timestamp_something.pkl', "wb") as export_file:
         #     print('Saving all results into ')
         #     pickle.dump(save_dict, export_file)
 
+
+
+def _points_kwargs(name, image_width):
+    '''
+    Display settings of the points layers. 
+    Also stored with session checkpoints, so that the session reader restores them.
+
+    Parameters
+    ----------
+    name : str : layer name (STANDARD_GRID_LAYER, USR_GRID_LAYER or CORRECTED_POINTS_LAYER)
+    image_width : int : width of the grid image - symbol sizes are adapted to it
+
+    Returns
+    -------
+    add_kwargs : dict : keyword arguments for viewer.add_points()
+    '''
+    styles = {
+        STANDARD_GRID_LAYER    : {'edge_width': 1,  'edge_color': '#000000',   'face_color': 'white', 
+                                  'opacity': .8, 'size': image_width/50},
+        USR_GRID_LAYER         : {'edge_width': .4, 'edge_color': 'orangered', 'face_color': 'white', 
+                                  'opacity': .5, 'size': image_width/40, 'symbol': 'x'},
+        CORRECTED_POINTS_LAYER : {'edge_width': .7, 'edge_color': '#000000',   'face_color': 'cornflowerblue', 
+                                  'opacity': .6, 'size': image_width/50},
+    }
+    return {'name': name, **styles[name], 'blending': 'translucent', 'out_of_slice_display': False}
+
+
+def _preview_job(generation, usr_dots, grid_dots, image, method, incremental=None):
+    '''
+    Runs in a background thread (see MiniUnwarpWidget._start_preview()).
+    Only one job runs at a time, so `incremental` (IncrementalPreview) is never updated concurrently.
+    '''
+    if incremental is not None:
+        return generation, incremental(usr_dots, image)
+    return generation, preview_unwarp(usr_dots, grid_dots, image, downsample=PREVIEW_DOWNSAMPLE, method=method)
@@ -0,0 +1,147 @@
+### DEPTH MODEL
+# The distortion of the grid images varies smoothly with depth (which is also what
+# the plane-to-plane tracking in _tracking.py relies on). Instead of fitting every plane
+# independently, the landmarks of a few key planes are interpolated in z with a spline.
+#
+# - For a fixed standard grid, the TPS coefficients are linear in the user defined points
+#   (coeffs = L^-1 @ V, see _make_warp() in _unwarp.py). Interpolating landmark positions in z
+#   is therefore the same as interpolating the coefficients of the key planes - and it
+#   does not depend on the standard grid (margin), so it also works during margin search.
+# - Transforms can be evaluated at any depth, also between or beyond calibrated planes.
+# - Key planes are picked greedily (select_key_planes()): starting from the first and last plane,
+#   the plane with the largest interpolation error is added until all planes are within tolerance.
+# - Inverse maps (for unwarping) are cached per depth (and warping method).
+#
+from collections import OrderedDict
+import numpy as np
+from scipy.interpolate import make_interp_spline
+
+from ._unwarp import _make_inverse_warp, _make_coeffs, apply_transform, warp_images
+
+_MAP_CACHE_SIZE = 8
+
+
+def _fit_spline(depths, positions):
+    ''' Interpolating spline in z (cubic if there are enough key planes) '''
+    return make_interp_spline(depths, positions, k=min(3, len(depths) - 1), axis=0)
+
+
+def select_key_planes(positions, depths=None, tolerance=.5, max_planes=None):
+    '''
+    Greedy selection of key planes that describe landmarks across depth within `tolerance`
+
+    Parameters
+    ----------
+    positions : np.array : planes x points x 2 landmark positions (see Landmarks)
+    depths : np.array : depth of every plane. Default: plane index
+    tolerance : float : maximum interpolation error of any landmark (pixels)
+    max_planes : int : optional upper bound for the number of key planes
+
+    Returns
+    -------
+    key_planes : np.array : sorted indices of key planes
+    '''
+    positions = np.asarray(positions, dtype=float)
+    num_planes = len(positions)
+    depths = np.arange(num_planes, dtype=float) if depths is None else np.asarray(depths, dtype=float)
+    max_planes = num_planes if max_planes is None else min(max_planes, num_planes)
+    key_planes = sorted({0, num_planes - 1})
+    while len(key_planes) < max_planes:
+        spline = _fit_spline(depths[key_planes], positions[key_planes])
+        error = np.linalg.norm(spline(depths) - positions, axis=-1).max(axis=-1)
+        if error.max() < tolerance:
+            break
+        key_planes = sorted(key_planes + [int(np.argmax(error))])
+    return np.array(key_planes)
+
+
+class DepthModel:
+    '''
+    Landmarks (and the resulting transforms) as a smooth function of depth
+
+    Parameters
+    ----------
+    positions : np.array : planes x points x 2 landmark positions (see Landmarks)
+    depths : np.array : depth of every plane. Default: plane index
+    key_planes : int or list : indices of planes that the model is fitted on,
+                               or the number of (evenly spaced) key planes.
+                               Default: selected with select_key_planes()
+    tolerance : float : see select_key_planes()
+    '''
+
+    def __init__(self, positions, depths=None, key_planes=None, tolerance=.5):
+        self.data = np.asarray(positions, dtype=float)
+        num_planes = len(self.data)
+        self.depths = np.arange(num_planes, dtype=float) if depths is None else np.asarray(depths, dtype=float)
+        if key_planes is None:
+            key_planes = select_key_planes(self.data, self.depths, tolerance)
+        elif np.isscalar(key_planes):
+            key_planes = np.unique(np.linspace(0, num_planes - 1, int(key_planes)).round().astype(int))
+        self.key_planes = np.unique(np.asarray(key_planes, dtype=int))
+        self._spline = _fit_spline(self.depths[self.key_planes], self.data[self.key_planes])
+        self._map_cache = OrderedDict()
+
+    def positions(self, depth):
+        '''
+        Interpolated landmark positions at `depth` (scalar: points x 2, array: depths x points x 2)
+        '''
+        return self._spline(depth)
+
+    def plane_positions(self, plane_idx):
+        '''
+        Landmark positions of plane `plane_idx` as used by the model
+        '''
+        return self.positions(self.depths[plane_idx])
+
+    def interpolation_error(self):
+        '''
+        Largest deviation (pixels) between the model and the given landmarks, for every plane
+        '''
+        return np.linalg.norm(self.positions(self.depths) - self.data, axis=-1).max(axis=-1)
+
+    def coefficients(self, depth, grid_dots):
+        '''
+        TPS coefficients at `depth` of the (reverse) transform used for unwarping,
+        see _make_inverse_warp()
+        '''
+        return _make_coeffs(np.asarray(grid_dots, dtype=float), self.positions(depth))
+
+    def inverse_map(self, depth, grid_dots, output_region, approximate_grid=1, method='tps'):
+        '''
+        Cached coordinate map for unwarping at `depth` (see _make_inverse_warp())
+        '''
+        grid_dots = np.asarray(grid_dots, dtype=float)
+        key = (float(depth), grid_dots.tobytes(), tuple(output_region), approximate_grid, method)
+        if key in self._map_cache:
+            self._map_cache.move_to_end(key)
+            return self._map_cache[key]
+        transform = _make_inverse_warp(self.positions(depth), grid_dots, output_region, approximate_grid, method)
+        self._map_cache[key] = transform
+        if len(self._map_cache) > _MAP_CACHE_SIZE:
+            self._map_cache.popitem(last=False)
+        return transform
+
+    def unwarp(self, image, depth, grid_dots, cached=False, **kwargs):
+        '''
+        Unwarp a 2D `image` recorded at `depth`
+
+        Parameters
+        ----------
+        image : np.array : 2D image
+        depth : float : depth of the image (same units as the model depths)
+        grid_dots : np.array : standard grid points (points x 2)
+        cached : bool : resample through the cached inverse_map() (faster for repeated
+                        unwarping at the same depth, but holds the full map in memory)
+        **kwargs : passed on to warp_images()
+
+        Returns
+        -------
+        unwarped : np.array
+        '''
+        output_region = [0, 0, image.shape[0], image.shape[1]]
+        if cached:
+            transform = self.inverse_map(depth, grid_dots, output_region, method=kwargs.get('method', 'tps'))
+            return apply_transform(image, transform, kwargs.get('interpolation_order', 1),
+                                   kwargs.get('precision', 'float64'))
+        kwargs.setdefault('approximate_grid', 1)
+        return warp_images(self.positions(depth), grid_dots, [image], output_region, **kwargs)[0]